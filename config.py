@@ -16,17 +16,61 @@ n_classes = len(letters) + 1
 batch_size = 32
 max_length = 18
 pred_length = 40
+width_stride = 4  # Image width per RNN time step, the product of the CRNN horizontal pooling sizes
+bucket_widths = None  # Network input widths images are bucketed into by aspect ratio, e.g. (48, 88, 128, 168), None for img_width only
 
 n_epochs = 20
+loader_workers = 4  # Threads or processes decoding images and assembling training batches
+loader_multiprocessing = False  # Assemble training batches in processes instead of threads
+prefetch_batches = 8  # Max number of training batches prepared ahead
 
 beam_width = 10
+lm_mode = 'Words'  # Word beam search LM scoring: 'Words', 'NGrams' or 'NGramsForecast'
+predict_batch_size = 64
+sliding_window = False  # Predict images wider than img_width as overlapping img_width windows at their aspect ratio instead of squeezing them
+window_overlap = 48  # Pixels neighbouring windows share, at least 4 * width_stride, time steps near window edges are dropped
+max_windows = 32  # Max windows per image, wider images are squeezed to the width of max_windows windows
+# Optional decoding shortcuts, None disables each of them
+decode_blank_threshold = None  # Runs of frames with blank prob above it are decoded as one frame, e.g. 0.999
+decode_char_threshold = None  # Runs of frames with the same letter above this prob are decoded as one frame, e.g. 0.999
+best_path_threshold = None  # Best path text is returned without beam search if it is in the dictionary and every frame's top prob is above it, e.g. 0.99
+
+max_image_size = 20 * 1024 ** 2  # Max bytes of one uploaded image
+predict_batch_max_images = 1000  # Max number of images sent to /predict_batch at once, csv files are streamed
+line_min_gap = 0.2  # Min blank gap between two words of a line image, relative to its height, when /predict_line finds them
+line_ink_threshold = 0.02  # Max share of inked pixels in a blank column of a line image
+line_max_separators = 200  # Max number of word separators a /predict_line request may give
+batch_max_size = 32  # Max number of /predict requests served by one forward pass
+batch_max_wait = 0.005  # Max seconds a /predict request waits for others to join its batch
+best_path_queue_depth = None  # /predict decodes by best path instead of beam search while at least this many requests are queued, e.g. 64
+worker_startup_grace = 120  # Seconds after its start within which a --workers process failing stops the server instead of being restarted
+
+job_executor = 'thread'  # Pool running training and evaluation jobs, 'thread' or 'process'
+job_workers = 1
+job_sync_interval = 1.0  # Seconds between writes of running jobs' progress to job_path, for the other server workers
+
+latency_metrics = True  # Time prediction stages for /metrics and the Server-Timing header
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Histogram bounds in seconds
+latency_window = 1024  # Latest durations of each stage the p50/p95/p99 latencies are computed from
+
+cache_size = 10000  # Max number of predictions kept in the result cache, 0 disables it
+cache_ttl = None  # Seconds a cached prediction stays valid, None for no expiry
+cache_path = None  # JSON file to persist the result cache across restarts, e.g. os.path.join(data_path, 'cache.json')
+cache_quantization_bits = 0  # Low bits of each pixel ignored when hashing images, > 0 matches near-identical images
 
 dir_path = os.path.dirname(__file__)
 data_path = os.path.join(dir_path, 'data')
 csv_path = os.path.join(data_path, 'csv')
 checkpoint_path = os.path.join(data_path, 'checkpoints')
+dataset_path = os.path.join(data_path, 'compiled')  # Preprocessed splits, see libs/prepare/dataset.py
+evaluation_path = os.path.join(data_path, 'evaluations')  # Checkpoints and error files of evaluation jobs
+job_path = os.path.join(data_path, 'jobs')  # State of every job as JSON, so each server worker answers for all jobs
+benchmark_path = os.path.join(data_path, 'benchmarks')  # Reports and recorded softmax matrices of libs/benchmark
 
 pretrained_model = os.path.join(data_path, 'models/vn_model.h5')
+inference_backend = 'keras'  # 'frozen' predicts with the graph exported by libs/models/export.py, if up to date
+inference_precision = 'float32'  # Exported graph used by the 'frozen' backend: 'float32', 'float16' or 'int8' (libs/models/quantize.py)
+lm_path = os.path.join(data_path, 'lm')  # Compiled language model, built from corpus.txt
 
 download_data_url = 'https://drive.google.com/uc?id=1dVO8yyqvyGVeWnQ78C5WYOdjCwaa7mUr'
 download_model_url = 'https://drive.google.com/uc?id=1-jxcAlRsv5Dr67iZ414vVHFlfGDFq5aU'
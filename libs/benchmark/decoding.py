@@ -0,0 +1,88 @@
+import os
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')  # benchmark on CPU
+
+import argparse
+import numpy as np
+import pandas as pd
+
+from datetime import datetime
+
+from libs.models.CRNNModel import CRNNModel
+from libs.utils import utils
+from libs.utils.utils import read_image, resize_image, decode_label, prune_frames
+from config import pretrained_model, csv_path, data_path
+
+
+def predict_outputs(model, images):
+    """
+    Run the network over decoded images and return the softmax output of each image, decoding is left out
+    """
+    outs = utils.predict_outputs(model.backend, [resize_image(img) / 255 for img in images])
+    return [out[np.newaxis] for out in outs]
+
+
+def decode_benchmark(lm, outs, labels, settings):
+    """
+    Decode the same network outputs with each setting (name, blank_threshold, char_threshold, fast_threshold)
+    and return time, accuracy and decoded frames of each run, relative to the first one
+    """
+    results = []
+    for name, blank_threshold, char_threshold, fast_threshold in settings:
+        start = datetime.now()
+        predicteds = [decode_label(lm, out, blank_threshold=blank_threshold, char_threshold=char_threshold,
+                                   fast_threshold=fast_threshold) for out in outs]
+        seconds = (datetime.now() - start).total_seconds()
+        frames = np.mean([len(prune_frames(out[0, 2:], blank_threshold, char_threshold)) for out in outs])
+        result = {
+            'name': name,
+            'time': seconds,
+            'images_per_sec': len(outs) / seconds,
+            'accuracy': np.mean([p == l for p, l in zip(predicteds, labels)]) * 100,
+            'frames': frames,
+            'predicteds': predicteds
+        }
+        if results:
+            base = results[0]
+            result['speedup'] = base['time'] / seconds
+            result['accuracy_delta'] = result['accuracy'] - base['accuracy']
+            result['changed'] = sum(p != b for p, b in zip(predicteds, base['predicteds']))
+        else:
+            result.update(speedup=1.0, accuracy_delta=0.0, changed=0)
+        results.append(result)
+        print("{:12s} {:8.2f} images/sec  speedup {:5.2f}x  accuracy {:6.2f} % ({:+.2f})  "
+              "{:5.1f} frames  {} changed".format(name, result['images_per_sec'], result['speedup'],
+                                                  result['accuracy'], result['accuracy_delta'],
+                                                  result['frames'], result['changed']))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Speed and accuracy of pruned and best path decoding')
+    parser.add_argument('--n', type=int, default=1000, help='Number of test images')
+    parser.add_argument('--blank-threshold', type=float, default=0.999)
+    parser.add_argument('--char-threshold', type=float, default=0.999)
+    parser.add_argument('--fast-threshold', type=float, default=0.99)
+    args = parser.parse_args()
+
+    data = pd.read_csv(os.path.join(csv_path, 'test.csv'), sep=';', dtype=str, keep_default_na=False)
+    images = []
+    labels = []
+    for path, label in zip(data['Image'].values.tolist()[:args.n], data['Label'].values.tolist()[:args.n]):
+        img = read_image(os.path.join(data_path, path))
+        if img is not None:
+            images.append(img)
+            labels.append(label)
+
+    model = CRNNModel(model_path=pretrained_model, initial_state=False)
+    outs = predict_outputs(model, images)
+    print("Benchmark with {} images".format(len(images)))
+    decode_benchmark(model.lm, outs, labels, [
+        ('exact', None, None, None),
+        ('pruned', args.blank_threshold, args.char_threshold, None),
+        ('best path', None, None, args.fast_threshold),
+        ('both', args.blank_threshold, args.char_threshold, args.fast_threshold)
+    ])
+
+
+if __name__ == '__main__':
+    main()
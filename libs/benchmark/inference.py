@@ -0,0 +1,40 @@
+import os
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')  # benchmark on CPU
+
+import pandas as pd
+
+from datetime import datetime
+
+from libs.models.CRNNModel import CRNNModel
+from libs.utils.utils import read_image
+from config import pretrained_model, csv_path, data_path
+
+
+def batch_size_benchmark(model, images, batch_sizes=(1, 2, 4, 8, 16, 32, 64, 128)):
+    """
+    Predict the same decoded images with each batch size and return images/sec of each run
+    """
+    model.predict_batch(images[:max(batch_sizes)], batch_size=max(batch_sizes))  # warm up
+    results = {}
+    for batch_size in batch_sizes:
+        start = datetime.now()
+        model.predict_batch(images, batch_size=batch_size)
+        end = datetime.now()
+        results[batch_size] = len(images) / (end - start).total_seconds()
+        print("Batch size {:4d}: {:8.2f} images/sec".format(batch_size, results[batch_size]))
+    return results
+
+
+def main(n_images=512):
+    data = pd.read_csv(os.path.join(csv_path, 'test.csv'), sep=';')
+    paths = data['Image'].values.tolist()[:n_images]
+    images = [read_image(os.path.join(data_path, path)) for path in paths]
+    images = [img for img in images if img is not None]
+
+    model = CRNNModel(model_path=pretrained_model, initial_state=False)
+    print("Benchmark with {} images".format(len(images)))
+    batch_size_benchmark(model, images)
+
+
+if __name__ == '__main__':
+    main()
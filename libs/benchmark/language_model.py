@@ -0,0 +1,60 @@
+import os
+import re
+import sys
+import json
+import codecs
+import argparse
+import subprocess
+from datetime import datetime
+
+from libs.word_beam_search.prefix_tree import PrefixTree
+from libs.word_beam_search.language_model import LanguageModel, compile_language_model
+from config import data_path, lm_path, letters, word_chars
+
+modes = ('object', 'compiled')
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+
+
+def load(mode):
+    """
+    Load language model the way mode does, return load time in seconds and RSS it added in MB
+    """
+    rss = rss_mb()
+    start = datetime.now()
+    if mode == 'object':
+        # What CRNNModel did before the compiled model: parse corpus into a tree of Node objects
+        corpus = codecs.open(os.path.join(data_path, 'corpus.txt'), 'r', 'utf8').read()
+        words = re.findall('[' + word_chars + ']+', corpus)
+        tree = PrefixTree()
+        tree.add_words(set(words))
+    else:
+        lm = LanguageModel.load(lm_path, letters, word_chars)
+        lm.get_flat_tree().isWord.sum()  # touch the arrays
+    end = datetime.now()
+    return {'mode': mode, 'time': (end - start).total_seconds(), 'rss_mb': rss_mb() - rss}
+
+
+def main():
+    """
+    Compare cold start of the object prefix tree with the compiled language model, each in a fresh process
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=modes)
+    args = parser.parse_args()
+    if args.mode is not None:
+        print(json.dumps(load(args.mode)))
+        return
+
+    compile_language_model(os.path.join(data_path, 'corpus.txt'), lm_path, letters, word_chars)
+    for mode in modes:
+        out = subprocess.check_output([sys.executable, '-m', 'libs.benchmark.language_model', '--mode', mode])
+        result = json.loads(out.decode('utf8').strip().splitlines()[-1])
+        print("{mode:>10}: {time:8.4f} s, {rss_mb:8.2f} MB".format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import os
+import glob
+import json
+import time
+import asyncio
+import argparse
+from collections import Counter
+
+import aiohttp
+
+from libs.benchmark.report import make_result, write_report
+from config import data_path, benchmark_path
+
+demo_path = os.path.join(data_path, 'demo')
+
+
+def parse_server_timing(header):
+    """
+    Milliseconds per stage of a Server-Timing header, e.g. 'predict;dur=12.3, json;dur=0.1'
+    """
+    timings = {}
+    for entry in header.split(','):
+        name, _, params = entry.strip().partition(';')
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'dur':
+                try:
+                    timings[name] = float(value)
+                except ValueError:
+                    pass
+    return timings
+
+
+def peak_rss_mb(pid):
+    """
+    Peak resident memory of the server process pid in MB, None if it can not be read
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_payloads(mode):
+    """
+    Request bodies replaying data/demo/*.jpg, the encoded images or their paths on the server
+    """
+    paths = sorted(glob.glob(os.path.join(demo_path, '*.jpg')))
+    if mode == 'path':
+        return [(json.dumps({'image': path}).encode('utf8'), 'application/json') for path in paths]
+    payloads = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            payloads.append((f.read(), 'image/jpeg'))
+    return payloads
+
+
+async def replay(url, payloads, concurrency, n_requests, timeout=60):
+    """
+    Send n_requests requests from concurrency clients, each sends its next request as soon as its last one
+    is answered. Returns the latency and status of each request, its Server-Timing stages and the wall time
+    """
+    latencies = []
+    statuses = Counter()
+    stages = []
+    requests = iter(range(n_requests))
+
+    async def client(session):
+        for i in requests:
+            body, content_type = payloads[i % len(payloads)]
+            start = time.perf_counter()
+            try:
+                async with session.post(url, data=body, headers={'Content-Type': content_type}) as response:
+                    await response.read()
+                    statuses[response.status] += 1
+                    stages.append(parse_server_timing(response.headers.get('Server-Timing', '')))
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                statuses['error'] += 1
+            latencies.append(time.perf_counter() - start)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*[client(session) for _ in range(concurrency)])
+        seconds = time.perf_counter() - start
+    return latencies, statuses, stages, seconds
+
+
+def run_load(url, mode, concurrency, n_requests, warmup, pid=None):
+    payloads = get_payloads(mode)
+    if not payloads:
+        raise FileNotFoundError('No images in ' + demo_path)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(replay(url, payloads, concurrency, warmup))
+        latencies, statuses, stages, seconds = loop.run_until_complete(
+            replay(url, payloads, concurrency, n_requests))
+    finally:
+        loop.close()
+
+    result = make_result('load', '{} concurrency={}'.format(mode, concurrency), latencies, seconds, 'requests',
+                         url=url, mode=mode, concurrency=concurrency, images=len(payloads))
+    result['statuses'] = {str(status): count for status, count in sorted(statuses.items(), key=str)}
+    result['errors'] = n_requests - statuses[200]
+    names = sorted({name for timings in stages for name in timings})
+    result['server_timing_ms'] = {name: round(sum(t.get(name, 0.0) for t in stages) / len(stages), 4)
+                                  for name in names}
+    rss = peak_rss_mb(pid) if pid is not None else None
+    result['peak_rss_mb'] = round(rss, 1) if rss is not None else None
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay data/demo/*.jpg against the server at fixed concurrency '
+                                                 'levels, written as a JSON report')
+    parser.add_argument('--url', default='http://localhost:8096/predict')
+    parser.add_argument('--mode', choices=('upload', 'path'), default='upload',
+                        help='Send the encoded images, or their paths for a server on this machine')
+    parser.add_argument('--concurrency', default='1,4,16', help='Comma separated numbers of concurrent clients')
+    parser.add_argument('--requests', type=int, default=500, help='Number of requests per concurrency level')
+    parser.add_argument('--warmup', type=int, default=20, help='Number of requests before each level')
+    parser.add_argument('--pid', type=int, default=None, help='Server process id, to report its peak RSS')
+    parser.add_argument('--out', default=os.path.join(benchmark_path, 'load.json'), help='JSON report')
+    parser.add_argument('--baseline', default=None, help='Earlier JSON report to compare with')
+    args = parser.parse_args()
+
+    results = []
+    for concurrency in [int(c) for c in args.concurrency.split(',') if c]:
+        print("Concurrency", concurrency)
+        results.append(run_load(args.url, args.mode, concurrency, args.requests, args.warmup, args.pid))
+    options = {key: value for key, value in vars(args).items() if key not in ('out', 'baseline')}
+    write_report(args.out, 'load', results, options, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import platform
+import resource
+import subprocess
+from datetime import datetime
+
+import numpy as np
+
+import config
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process so far, in MB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarize(latencies, n_items=None, seconds=None):
+    """
+    Throughput in items/sec and latency percentiles in ms of per-call latencies in seconds,
+    n_items and seconds default to one item per call and the sum of the latencies
+    """
+    latencies = np.asarray(latencies, dtype=np.float64)
+    n_items = len(latencies) if n_items is None else n_items
+    seconds = float(latencies.sum()) if seconds is None else seconds
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000 if len(latencies) else (0.0, 0.0, 0.0)
+    return {
+        'n': n_items,
+        'seconds': round(seconds, 6),
+        'throughput': round(n_items / seconds, 3) if seconds else 0.0,
+        'latency_ms': {
+            'mean': round(float(latencies.mean()) * 1000, 4) if len(latencies) else 0.0,
+            'p50': round(float(p50), 4),
+            'p95': round(float(p95), 4),
+            'p99': round(float(p99), 4),
+            'max': round(float(latencies.max()) * 1000, 4) if len(latencies) else 0.0
+        }
+    }
+
+
+def make_result(benchmark, name, latencies, seconds, unit, n_items=None, **params):
+    result = {'benchmark': benchmark, 'name': name, 'unit': unit, 'params': params}
+    result.update(summarize(latencies, n_items, seconds))
+    return result
+
+
+def git_commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=config.dir_path,
+                                      stderr=subprocess.DEVNULL)
+        return out.decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_environment():
+    """
+    Machine, versions and settings a run depends on, so reports are only compared knowingly
+    """
+    return {
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'config': {
+            'beam_width': config.beam_width,
+            'lm_mode': config.lm_mode,
+            'bucket_widths': config.bucket_widths,
+            'inference_backend': config.inference_backend,
+            'inference_precision': config.inference_precision,
+            'decode_blank_threshold': config.decode_blank_threshold,
+            'decode_char_threshold': config.decode_char_threshold,
+            'best_path_threshold': config.best_path_threshold,
+            'batch_max_size': config.batch_max_size,
+            'batch_max_wait': config.batch_max_wait
+        }
+    }
+
+
+def get_key(result):
+    return result['benchmark'], result['name']
+
+
+def compare(results, baseline_results):
+    """
+    Relative change in % of throughput and latency percentiles of each result against the baseline result
+    of the same benchmark and name, positive throughput and negative latency changes are improvements
+    """
+    baseline = {get_key(result): result for result in baseline_results}
+    changes = []
+    for result in results:
+        base = baseline.get(get_key(result))
+        if base is None:
+            continue
+        change = {'benchmark': result['benchmark'], 'name': result['name']}
+        for key, value, base_value in [('throughput', result['throughput'], base['throughput'])] + [
+                ('latency_' + q, result['latency_ms'][q], base['latency_ms'][q]) for q in ('p50', 'p95', 'p99')]:
+            change[key] = round((value - base_value) / base_value * 100, 2) if base_value else None
+        changes.append(change)
+    return changes
+
+
+def print_results(results, changes=None):
+    changes = {get_key(change): change for change in changes or []}
+    print("{:16s} {:34s} {:>12s} {:>10s} {:>10s} {:>10s} {:>9s}".format(
+        'Benchmark', 'Name', 'Items/sec', 'p50 ms', 'p95 ms', 'p99 ms', 'Peak MB'))
+    for result in results:
+        print("{:16s} {:34s} {:12.2f} {:10.3f} {:10.3f} {:10.3f} {:9.1f}".format(
+            result['benchmark'], result['name'], result['throughput'], result['latency_ms']['p50'],
+            result['latency_ms']['p95'], result['latency_ms']['p99'], result.get('peak_rss_mb') or 0.0))
+        change = changes.get(get_key(result))
+        if change is not None:
+            print("{:16s} {:34s} {:>11}% {:>9}% {:>9}% {:>9}%".format(
+                '', 'vs baseline', *(change[key] for key in ('throughput', 'latency_p50', 'latency_p95',
+                                                              'latency_p99'))))
+
+
+def write_report(path, kind, results, args=None, baseline_path=None):
+    """
+    Write results with the environment to a JSON report, compared to the report at baseline_path if given
+    """
+    report = {
+        'kind': kind,
+        'created': datetime.now().isoformat(),
+        'environment': get_environment(),
+        'args': args or {},
+        'results': results
+    }
+    changes = None
+    if baseline_path is not None:
+        with open(baseline_path, encoding='utf8') as f:
+            baseline = json.load(f)
+        changes = compare(results, baseline['results'])
+        report['baseline'] = {'path': baseline_path, 'commit': baseline['environment'].get('commit'),
+                              'changes': changes}
+    print_results(results, changes)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+    print("Report written to", path)
+    return report
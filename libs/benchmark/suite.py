@@ -0,0 +1,275 @@
+import os
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')  # benchmark on CPU
+
+import re
+import sys
+import glob
+import json
+import time
+import codecs
+import argparse
+import subprocess
+
+import numpy as np
+
+from libs.benchmark.report import make_result, peak_rss_mb, write_report
+from libs.utils.cache import ResultCache
+from libs.utils.utils import read_image, decode_image, resize_image
+from libs.word_beam_search.prefix_tree import PrefixTree
+from libs.word_beam_search.language_model import LanguageModel, compile_language_model, check_scoring_mode
+from libs.word_beam_search.word_beam_search import word_beam_search
+from libs.word_beam_search.fast_word_beam_search import fast_word_beam_search
+from config import data_path, csv_path, lm_path, lm_mode, letters, word_chars, n_classes, batch_size, max_length, \
+    benchmark_path
+
+demo_path = os.path.join(data_path, 'demo')
+decoders = {'fast': fast_word_beam_search, 'reference': word_beam_search}
+
+
+def time_calls(fn, items, block=1):
+    """
+    Call fn on each item, returns the latency of each call in seconds and the total time. Calls too short
+    to time one by one are timed in blocks of block calls, each call of a block gets the block mean
+    """
+    latencies = []
+    seconds = 0.0
+    for i in range(0, len(items), block):
+        chunk = items[i:i + block]
+        start = time.perf_counter()
+        for item in chunk:
+            fn(item)
+        elapsed = time.perf_counter() - start
+        seconds += elapsed
+        latencies.extend([elapsed / len(chunk)] * len(chunk))
+    return latencies, seconds
+
+
+def synthetic_matrices(n, seed=0, steps=40):
+    """
+    Seeded softmax matrices spelling corpus words over noise, to benchmark decoding without model weights
+    """
+    corpus = codecs.open(os.path.join(data_path, 'corpus.txt'), 'r', 'utf8').read()
+    words = sorted(set(re.findall('[' + word_chars + ']+', corpus)))
+    rng = np.random.RandomState(seed)
+    mats = []
+    for _ in range(n):
+        text = ' '.join(words[k] for k in rng.randint(len(words), size=rng.randint(1, 3)))[:steps // 2]
+        logits = rng.normal(0, 1 + rng.rand() * 2, (steps, n_classes))
+        logits[:, -1] += 8
+        frame = (steps - 2 * len(text)) // 2
+        for c in text:
+            logits[frame, letters.index(c)] += 12
+            frame += 2
+        mat = np.exp(logits - logits.max(1, keepdims=True))
+        mats.append((mat / mat.sum(1, keepdims=True)).astype(np.float32))
+    return mats
+
+
+def record_matrices(path, n):
+    """
+    Save the softmax outputs of the network for the demo images and the first test.csv images, decoding
+    benchmarks then replay them without running the network
+    """
+    import pandas as pd
+    from libs.models.CRNNModel import CRNNModel
+    from libs.benchmark.decoding import predict_outputs
+    from config import pretrained_model
+
+    paths = sorted(glob.glob(os.path.join(demo_path, '*.jpg')))
+    data = pd.read_csv(os.path.join(csv_path, 'test.csv'), sep=';')
+    paths += [os.path.join(data_path, path) for path in data['Image'].values.tolist()[:max(n - len(paths), 0)]]
+    images = [img for img in (read_image(path) for path in paths) if img is not None]
+
+    model = CRNNModel(model_path=pretrained_model, initial_state=False)
+    outs = predict_outputs(model, images)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    np.savez_compressed(path, *[out[0, 2:] for out in outs])
+    print("Recorded {} matrices to {}".format(len(outs), path))
+
+
+def load_matrices(args):
+    if args.synthetic:
+        return synthetic_matrices(args.n, args.seed)
+    if not os.path.isfile(args.matrices):
+        record_matrices(args.matrices, args.n)
+    with np.load(args.matrices) as f:
+        return [f['arr_{}'.format(i)] for i in range(len(f.files))][:args.n]
+
+
+def load_lm():
+    check_scoring_mode(lm_mode)
+    try:
+        return LanguageModel.load(lm_path, letters, word_chars)
+    except (OSError, ValueError):
+        return compile_language_model(os.path.join(data_path, 'corpus.txt'), lm_path, letters, word_chars)
+
+
+def bench_beam_search(args):
+    """
+    Word beam search over recorded (or synthetic) softmax matrices, for each decoder and beam width
+    """
+    mats = load_matrices(args)
+    lm = load_lm()
+    results = []
+    for decoder in args.decoders:
+        for beam_width in args.beam_widths:
+            decode = decoders[decoder]
+            decode(mats[0], beam_width, lm, lm_mode)  # warm up
+            latencies, seconds = time_calls(lambda mat: decode(mat, beam_width, lm, lm_mode), mats)
+            results.append(make_result('beam_search', '{} beam_width={}'.format(decoder, beam_width), latencies,
+                                       seconds, 'matrices', decoder=decoder, beam_width=beam_width,
+                                       lm_mode=lm_mode, synthetic=args.synthetic))
+    return results
+
+
+def bench_language_model(args):
+    """
+    Build the prefix tree and the language model from the corpus, load the compiled one, and look words
+    and next chars up in both
+    """
+    corpus = codecs.open(os.path.join(data_path, 'corpus.txt'), 'r', 'utf8').read()
+    words = sorted(set(re.findall('[' + word_chars + ']+', corpus)))
+    rng = np.random.RandomState(args.seed)
+    queries = [words[k] for k in rng.randint(len(words), size=args.lookups)]
+    # Half of the queries are no words, they mostly stop early in the tree
+    queries = [w if i % 2 else w[:-1] + letters[rng.randint(1, len(letters))] for i, w in enumerate(queries)]
+    prefixes = [w[:rng.randint(len(w)) + 1] for w in queries]
+
+    def build_tree(_):
+        tree = PrefixTree()
+        tree.add_words(words)
+        return tree
+
+    lm = load_lm()  # Compiled once, if it is not yet
+    results = []
+    for name, fn in (('build prefix tree', build_tree),
+                     ('build language model', lambda _: LanguageModel(corpus, letters, word_chars)),
+                     ('load compiled', lambda _: LanguageModel.load(lm_path, letters, word_chars))):
+        latencies, seconds = time_calls(fn, list(range(args.repeat)))
+        results.append(make_result('language_model', name, latencies, seconds, 'builds', words=len(words)))
+
+    tree = build_tree(None)
+    for name, fn, items in (('prefix tree is_word', tree.is_word, queries),
+                            ('prefix tree get_next_chars', tree.get_next_chars, prefixes),
+                            ('compiled is_word', lm.is_word, queries),
+                            ('compiled get_next_chars', lm.get_next_chars, prefixes)):
+        latencies, seconds = time_calls(fn, items, block=100)
+        results.append(make_result('language_model', name, latencies, seconds, 'lookups'))
+    return results
+
+
+def bench_preprocess(args):
+    """
+    The steps predict_label takes on each image before the network: decoding the upload or reading the file,
+    resizing to its bucket width, scaling and hashing for the result cache
+    """
+    paths = sorted(glob.glob(os.path.join(demo_path, '*.jpg')))
+    buffers = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            buffers.append(f.read())
+    n = args.n
+    items = [i % len(paths) for i in range(n)]
+    decoded = [decode_image(buffer) for buffer in buffers]
+    cache = ResultCache(max_size=0)
+
+    def full(i):
+        img = resize_image(read_image(memoryview(buffers[i])))
+        cache.key(img)
+        return img / 255
+
+    results = []
+    for name, fn in (('read file', lambda i: read_image(paths[i])),
+                     ('decode upload', lambda i: decode_image(buffers[i])),
+                     ('resize', lambda i: resize_image(decoded[i])),
+                     ('cache key', lambda i: cache.key(resize_image(decoded[i]))),
+                     ('upload to input', full)):
+        latencies, seconds = time_calls(fn, items, block=10)
+        results.append(make_result('preprocess', name, latencies, seconds, 'images', images=len(paths)))
+    return results
+
+
+def bench_next_batch(args):
+    """
+    Assembling training batches from the compiled val split, what each loader worker does per step
+    """
+    from libs.prepare.dataset import load_dataset
+    from libs.prepare.generator import DataGenerator
+
+    dataset = load_dataset(os.path.join(csv_path, 'val_final.csv'), train=True)
+    gene = DataGenerator(dataset, batch_size, max_text_len=max_length, seed=args.seed)
+    batches = list(range(min(args.batches, len(gene))))
+    gene[0]  # warm up, maps the shards
+    latencies, seconds = time_calls(lambda i: gene[i], batches)
+    result = make_result('next_batch', 'batch_size={}'.format(batch_size), latencies, seconds, 'images',
+                         n_items=len(batches) * batch_size, batch_size=batch_size, batches=len(batches))
+    return [result]
+
+
+benchmarks = {
+    'beam_search': bench_beam_search,
+    'language_model': bench_language_model,
+    'preprocess': bench_preprocess,
+    'next_batch': bench_next_batch
+}
+
+
+def run_isolated(name, args):
+    """
+    Run one benchmark in a fresh process, so its peak RSS is its own and earlier benchmarks do not warm it up
+    """
+    cmd = [sys.executable, '-m', 'libs.benchmark.suite', '--only', name, '--worker', '--n', str(args.n),
+           '--seed', str(args.seed), '--repeat', str(args.repeat), '--lookups', str(args.lookups),
+           '--batches', str(args.batches), '--matrices', args.matrices,
+           '--beam-widths', ','.join(map(str, args.beam_widths)), '--decoders', ','.join(args.decoders)]
+    if args.synthetic:
+        cmd.append('--synthetic')
+    out = subprocess.check_output(cmd)
+    return json.loads(out.decode('utf8').strip().splitlines()[-1])
+
+
+def parse_list(cast):
+    return lambda value: [cast(v) for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks of decoding, language model, preprocessing '
+                                                 'and batch assembly, written as a JSON report')
+    parser.add_argument('--only', type=parse_list(str), default=list(benchmarks),
+                        help='Comma separated benchmarks: ' + ', '.join(benchmarks))
+    parser.add_argument('--n', type=int, default=200, help='Number of matrices / images')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='Number of language model builds and loads')
+    parser.add_argument('--lookups', type=int, default=10000, help='Number of language model lookups')
+    parser.add_argument('--batches', type=int, default=50, help='Number of training batches assembled')
+    parser.add_argument('--beam-widths', type=parse_list(int), default=[1, 10, 25])
+    parser.add_argument('--decoders', type=parse_list(str), default=list(decoders))
+    parser.add_argument('--matrices', default=os.path.join(benchmark_path, 'matrices.npz'),
+                        help='Recorded softmax matrices, recorded with the pretrained model if missing')
+    parser.add_argument('--synthetic', action='store_true', help='Decode seeded synthetic matrices instead')
+    parser.add_argument('--out', default=os.path.join(benchmark_path, 'suite.json'), help='JSON report')
+    parser.add_argument('--baseline', default=None, help='Earlier JSON report to compare with')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    unknown = set(args.only) - set(benchmarks)
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(sorted(unknown)))
+
+    if args.worker:
+        results = benchmarks[args.only[0]](args)
+        for result in results:
+            result['peak_rss_mb'] = round(peak_rss_mb(), 1)
+        print(json.dumps(results))
+        return
+
+    results = []
+    for name in args.only:
+        print("Running", name)
+        results.extend(run_isolated(name, args))
+    options = {key: value for key, value in vars(args).items() if key not in ('worker', 'out', 'baseline')}
+    write_report(args.out, 'suite', results, options, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
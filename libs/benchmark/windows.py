@@ -0,0 +1,74 @@
+import os
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')  # benchmark on CPU
+
+import cv2
+import argparse
+import pandas as pd
+
+from datetime import datetime
+
+from libs.models.CRNNModel import CRNNModel
+from libs.utils.metrics import compute_metrics
+from libs.utils.utils import read_image, predict_batch
+from config import pretrained_model, csv_path, data_path, img_width, img_height
+
+
+def windows_benchmark(model, images, labels):
+    """
+    Accuracy and speed of squeezing images into img_width against predicting them as overlapping windows
+    """
+    results = {}
+    for name, windowed in (('squeezed', False), ('windowed', True)):
+        predict_batch(model.backend, images[:8], model.lm, windowed=windowed)  # warm up
+        start = datetime.now()
+        predicteds = predict_batch(model.backend, images, model.lm, windowed=windowed)
+        seconds = (datetime.now() - start).total_seconds()
+        results[name] = compute_metrics(predicteds, labels)
+        results[name]['images_per_sec'] = len(images) / seconds
+        print("{:10s} accuracy {accuracy:6.2f} %  CER {cer:6.2f} %  WER {wer:6.2f} %  {images_per_sec:8.2f} images/sec"
+              .format(name, **results[name]))
+    return results
+
+
+def scaling_benchmark(model, image, widths=(170, 340, 680, 1360, 2720), n=20):
+    """
+    Milliseconds per windowed prediction of one image stretched to each width, it should grow linearly
+    """
+    results = {}
+    for width in widths:
+        img = cv2.resize(image, (width, img_height))
+        predict_batch(model.backend, [img], model.lm, windowed=True)  # warm up
+        start = datetime.now()
+        for _ in range(n):
+            predict_batch(model.backend, [img], model.lm, windowed=True)
+        results[width] = (datetime.now() - start).total_seconds() / n * 1000
+        print("Width {:5d}: {:8.2f} ms, {:6.3f} ms per 100 px".format(width, results[width],
+                                                                       results[width] / width * 100))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Accuracy and cost of sliding window prediction of long images')
+    parser.add_argument('--n', type=int, default=1000, help='Number of long test images')
+    args = parser.parse_args()
+
+    data = pd.read_csv(os.path.join(csv_path, 'test.csv'), sep=';', dtype=str, keep_default_na=False)
+    images = []
+    labels = []
+    for path, label in zip(data['Image'].values.tolist(), data['Label'].values.tolist()):
+        # Only images squeezed by resizing to img_width
+        img = read_image(os.path.join(data_path, path))
+        if label and img is not None and img.shape[1] * img_height / img.shape[0] > img_width:
+            images.append(img)
+            labels.append(label)
+        if len(images) >= args.n:
+            break
+
+    model = CRNNModel(model_path=pretrained_model, initial_state=False)
+    print("Benchmark with {} images wider than {} px at height {}".format(len(images), img_width, img_height))
+    windows_benchmark(model, images, labels)
+    scaling_benchmark(model, images[0])
+
+
+if __name__ == '__main__':
+    main()
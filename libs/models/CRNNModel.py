@@ -1,34 +1,43 @@
 import os
 import logging
-import codecs
 from datetime import datetime
 
-import matplotlib.pyplot as plt
-from keras.utils import plot_model
-from keras.callbacks import EarlyStopping, ModelCheckpoint
-from keras import backend as K
-
-from libs.nets.CRNN import CRNN
-from libs.prepare.generator import get_generator
-from libs.utils.callbacks import VizCallback
-from libs.utils.utils import predict_label, ctc_loss_function, predict_data_output
-from libs.word_beam_search.language_model import LanguageModel
-from config import data_path, letters, word_chars, checkpoint_path
+from libs.models.backends import KerasBackend, FrozenGraphBackend, get_frozen_path, is_exported
+from libs.prepare.dataset import load_dataset
+from libs.utils.cache import ResultCache
+from libs.utils.evaluation import run_evaluation
+from libs.utils.utils import predict_label, predict_batch, predict_line
+from libs.word_beam_search.language_model import load_compiled_language_model, compile_language_model, \
+    check_scoring_mode
+from config import data_path, letters, word_chars, checkpoint_path, predict_batch_size, lm_path, lm_mode, beam_width, \
+    loader_workers, loader_multiprocessing, prefetch_batches, bucket_widths, inference_backend, \
+    inference_precision, sliding_window, window_overlap, max_windows
 
 
 class CRNNModel(object):
-    def __init__(self, model_path, initial_state=True):
+    def __init__(self, model_path, initial_state=True, backend=inference_backend, precision=inference_precision):
         self.model_path = model_path
 
         self.chars = letters
         self.lm = self.get_language_model(data_path, word_chars)
+        self.cache = ResultCache()
 
+        self.model = None
         if initial_state:
             self.build_model('train')
+        elif backend == 'frozen' and is_exported(model_path, precision):
+            # Exported inference graph, Keras is not even imported
+            self.load_frozen_model(get_frozen_path(model_path, precision))
         else:
+            if backend == 'frozen':
+                logging.warning('No %s inference graph exported from %s, predicting with Keras', precision, model_path)
             self.build_model('predict')
 
     def build_model(self, mode='train'):
+        from keras import backend as K
+        from libs.nets.CRNN import CRNN
+        from libs.utils.utils import ctc_loss_function
+
         crnn = CRNN(stage=mode, loss_fn=ctc_loss_function)
         if mode == 'train':
             model_input, y_pred, self.model = crnn()
@@ -38,17 +47,36 @@ class CRNNModel(object):
         else:
             self.model = crnn()
             self.load_model()
+            self.model._make_predict_function()  # Build predict function now, so it can be called from other threads
+
+        session = K.get_session()
+        self.backend = KerasBackend(self.model, session, session.graph)
+
+    def load_frozen_model(self, frozen_path):
+        self.backend = FrozenGraphBackend(frozen_path)
+        self.set_cache_fingerprint(frozen_path)
 
     def get_language_model(self, path, word_characters):
-        corpus = codecs.open(os.path.join(path, 'corpus.txt'), 'r', 'utf8').read()
-        lm = LanguageModel(corpus, self.chars, word_characters)
+        check_scoring_mode(lm_mode)
+        corpus_path = os.path.join(path, 'corpus.txt')
+        lm = load_compiled_language_model(corpus_path, lm_path, self.chars, word_characters)
+        if lm is None:
+            logging.info('Compiling language model from %s', corpus_path)
+            lm = compile_language_model(corpus_path, lm_path, self.chars, word_characters)
         return lm
 
     def load_model(self, model_path=None):
         if model_path is None:
-            self.model.load_weights(self.model_path)
-        else:
-            self.model.load_weights(model_path)
+            model_path = self.model_path
+        self.model.load_weights(model_path)
+        self.set_cache_fingerprint(model_path)
+
+    def set_cache_fingerprint(self, model_path):
+        # Cached predictions are only valid for these weights and decoding settings
+        stat = os.stat(model_path)
+        self.cache.set_fingerprint('{}:{}:{}:{}:{}:{}:{}:{}:{}'.format(
+            os.path.abspath(model_path), stat.st_mtime, stat.st_size, lm_mode, beam_width, bucket_widths,
+            sliding_window, window_overlap, max_windows))
 
     def save_model(self, model_save_path=None):
         if model_save_path is None:
@@ -57,6 +85,8 @@ class CRNNModel(object):
             self.model.save(model_save_path)
 
     def get_model_description(self, info_path):
+        from keras.utils import plot_model
+
         try:
             self.model.summary()
             plot_model(self.model, info_path, show_shapes=True)
@@ -64,6 +94,8 @@ class CRNNModel(object):
             logging.exception(err)
 
     def plot_learning_curve(self):
+        import matplotlib.pyplot as plt
+
         try:
             plt.title('Learning Curves')
             plt.xlabel('Epoch')
@@ -75,15 +107,20 @@ class CRNNModel(object):
         except Exception as err:
             logging.exception(err)
 
-    def fit(self, epochs=20, early_stopping=False):
-        callbacks = []
+    def fit(self, epochs=20, early_stopping=False, callbacks=None):
+        from keras.callbacks import EarlyStopping, ModelCheckpoint
+        from libs.prepare.generator import get_generator
+        from libs.utils.callbacks import VizCallback, LoaderStatsCallback
+
+        callbacks = list(callbacks or [])
 
         train_gene, train_n_batches = get_generator(mode='train')
         val_gene, val_n_batches = get_generator(mode='val')
-        callbacks.extend([train_gene, val_gene])
+        callbacks.append(LoaderStatsCallback())
 
-        train_viz_cb = VizCallback(self.test_func, train_gene.next_batch(), True, train_n_batches)
-        val_viz_cb = VizCallback(self.test_func, val_gene.next_batch(), False, val_n_batches)
+        # Metric callbacks get their own sequences, so they never consume batches of the training stream
+        train_viz_cb = VizCallback(self.test_func, train_gene.copy(seed=train_gene.seed + 1), True, train_n_batches)
+        val_viz_cb = VizCallback(self.test_func, val_gene.copy(), False, val_n_batches)
         callbacks.extend([train_viz_cb, val_viz_cb])
 
         if early_stopping:
@@ -99,29 +136,48 @@ class CRNNModel(object):
 
         start = datetime.now()
         self.history = self.model.fit_generator(
-            generator=train_gene.next_batch(),
+            generator=train_gene,
             steps_per_epoch=train_n_batches,
             epochs=epochs,
-            callbacks=[train_viz_cb, val_viz_cb, train_gene, val_gene, model_checkpoint],
-            validation_data=val_gene.next_batch(),
-            validation_steps=val_n_batches
+            callbacks=callbacks,
+            validation_data=val_gene,
+            validation_steps=val_n_batches,
+            workers=loader_workers,
+            use_multiprocessing=loader_multiprocessing,
+            max_queue_size=prefetch_batches
         )
         end = datetime.now()
         print("Time to train: ", end - start)
 
         self.save_model('models/model.h5')
 
-    def evaluate(self, X, y):
-        acc, letter_acc, letter_cnt, mis_match, n_predicteds = predict_data_output(self.model, X, y, self.lm)
+    def evaluate(self, X, y, batch_size=predict_batch_size, progress=None, widths=None):
+        result = self.run_evaluation(X, y, batch_size=batch_size, progress=progress, widths=widths)
 
-        accuracy = round((acc / n_predicteds) * 100, 2)
-        letter_accuracy = round((letter_acc / letter_cnt) * 100, 2)
+        print("Validation Accuracy: ", result['accuracy'], " %")
+        print("Validation Letter Accuracy: ", result['letter_accuracy'], " %")
+        print("Validation CER / WER: ", result['cer'], " % / ", result['wer'], " %")
 
-        print("Validation Accuracy: ", accuracy, " %")
-        print("Validation Letter Accuracy: ", letter_accuracy, " %")
+        return result['accuracy'], result['letter_accuracy']
 
-        return accuracy, letter_accuracy
+    def evaluate_file(self, filename, batch_size=predict_batch_size, progress=None):
+        dataset = load_dataset(filename)
+        return self.evaluate(dataset.images, dataset.texts, batch_size=batch_size, progress=progress,
+                             widths=dataset.widths)
+
+    def run_evaluation(self, X, y, batch_size=predict_batch_size, progress=None, widths=None, names=None, **options):
+        """
+        Streaming evaluation with running metrics, subsampling, early stopping, checkpoints and an error file,
+        see libs/utils/evaluation.run_evaluation for the options
+        """
+        return run_evaluation(self.backend, X, y, self.lm, batch_size=batch_size, widths=widths, names=names,
+                              progress=progress, key=self.cache.fingerprint, **options)
 
     def predict(self, x):
-        predicted = predict_label(self.model, x, self.lm)
-        return predicted
+        return predict_label(self.backend, x, self.lm, cache=self.cache)
+
+    def predict_batch(self, xs, batch_size=predict_batch_size, greedy=None):
+        return predict_batch(self.backend, xs, self.lm, batch_size, cache=self.cache, greedy=greedy)
+
+    def predict_line(self, x, separators=None):
+        return predict_line(self.backend, x, self.lm, separators, cache=self.cache)
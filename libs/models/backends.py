@@ -0,0 +1,71 @@
+import json
+import os
+
+import numpy as np
+
+precision_suffixes = {'float32': '', 'float16': '.fp16', 'int8': '.int8'}  # Variants written by libs/models/quantize.py
+
+
+class KerasBackend(object):
+    """
+    Predict with an in-memory Keras model, from any thread
+    """
+
+    def __init__(self, model, session, graph):
+        self.model = model
+        self.session = session
+        self.graph = graph
+
+    def predict(self, x, batch_size=None):
+        with self.session.as_default(), self.graph.as_default():
+            return self.model.predict(x, batch_size=batch_size)
+
+
+class FrozenGraphBackend(object):
+    """
+    Predict with an exported inference graph (see libs/models/export.py), only TensorFlow is imported
+    """
+
+    def __init__(self, path):
+        import tensorflow as tf
+
+        self.path = path
+        with open(get_meta_path(path), encoding='utf8') as f:
+            self.meta = json.load(f)
+        graph_def = tf.GraphDef()
+        with open(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.session = tf.Session(graph=self.graph)
+        self.input = self.graph.get_tensor_by_name(self.meta['input'])
+        self.output = self.graph.get_tensor_by_name(self.meta['output'])
+
+    def predict(self, x, batch_size=None):
+        if batch_size is None:
+            batch_size = len(x)
+        outs = [self.session.run(self.output, {self.input: x[i:i + batch_size]}) for i in range(0, len(x), batch_size)]
+        return np.concatenate(outs)
+
+
+def get_frozen_path(model_path, precision='float32'):
+    return os.path.splitext(model_path)[0] + precision_suffixes[precision] + '.pb'
+
+
+def get_meta_path(frozen_path):
+    return os.path.splitext(frozen_path)[0] + '.json'
+
+
+def is_exported(model_path, precision='float32'):
+    """
+    Whether an inference graph of precision was exported from the current weights of model_path
+    """
+    frozen_path = get_frozen_path(model_path, precision)
+    try:
+        with open(get_meta_path(frozen_path), encoding='utf8') as f:
+            meta = json.load(f)
+        return os.path.isfile(frozen_path) and meta.get('mtime') == os.path.getmtime(model_path)
+    except (OSError, ValueError):
+        return False
@@ -0,0 +1,130 @@
+import os
+import json
+import argparse
+
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+from keras.layers import Conv2D, BatchNormalization
+
+from libs.nets.CRNN import CRNN
+from libs.models.backends import FrozenGraphBackend, get_frozen_path, get_meta_path
+from config import pretrained_model, img_height, img_width
+
+
+def fold_batch_norms(model):
+    """
+    Kernel and bias of every Conv2D of model with the BatchNormalization following it folded into them
+    """
+    weights = {}
+    conv = None
+    for layer in model.layers:
+        if isinstance(layer, Conv2D):
+            conv = layer
+            weights[layer.name] = layer.get_weights()
+        elif isinstance(layer, BatchNormalization):
+            gamma, beta, mean, variance = layer.get_weights()
+            scale = gamma / np.sqrt(variance + layer.epsilon)
+            kernel, bias = weights[conv.name]
+            weights[conv.name] = [kernel * scale, (bias - mean) * scale + beta]
+            conv = None  # A convolution is followed by one batch norm at most
+    return weights
+
+
+def freeze_graph(session, graph_def, output_names):
+    """
+    Subgraph of graph_def computing output_names, with its resource variables replaced by constants of their
+    values. Unlike tf.graph_util.convert_variables_to_constants of TF 1.14, variable handles are followed into
+    while loops (Enter nodes), which is how the LSTM layers read their weights
+    """
+    graph_def = tf.graph_util.extract_sub_graph(graph_def, output_names)
+    variables = {variable.op.name: variable for variable in tf.global_variables()}
+    handles = [node.name for node in graph_def.node if node.op == 'VarHandleOp']
+    values = dict(zip(handles, session.run([variables[name] for name in handles])))
+
+    # Nodes passing a variable handle on, with the dtype of the variable
+    dtypes = {node.name: node.attr['dtype'] for node in graph_def.node if node.op == 'VarHandleOp'}
+    n_handles = 0
+    while n_handles != len(dtypes):
+        n_handles = len(dtypes)
+        for node in graph_def.node:
+            if node.op in ('Enter', 'Identity') and node.input[0] in dtypes:
+                dtypes[node.name] = dtypes[node.input[0]]
+
+    frozen = tf.GraphDef()
+    for node in graph_def.node:
+        new_node = frozen.node.add()
+        if node.name in values:
+            new_node.op = 'Const'
+            new_node.name = node.name
+            new_node.attr['dtype'].CopyFrom(node.attr['dtype'])
+            new_node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(values[node.name],
+                                                                        dtype=node.attr['dtype'].type))
+            continue
+        new_node.CopyFrom(node)
+        if node.op == 'ReadVariableOp' and node.input[0] in dtypes:
+            new_node.op = 'Identity'
+            del new_node.attr['dtype']
+            new_node.attr['T'].CopyFrom(dtypes[node.input[0]])
+        elif node.name in dtypes:
+            new_node.attr['T'].CopyFrom(dtypes[node.name])
+    frozen.library.CopyFrom(graph_def.library)
+    frozen.versions.CopyFrom(graph_def.versions)
+    return frozen
+
+
+def export_frozen_graph(model_path=pretrained_model, out_path=None):
+    """
+    Export the weights of model_path as a frozen inference graph: batch norm folded into the convolutions,
+    no dropout, no CTC loss and constants instead of variables. Returns the path of the graph
+    """
+    if out_path is None:
+        out_path = get_frozen_path(model_path)
+    K.clear_session()
+
+    model = CRNN(stage='predict', loss_fn=None)()
+    model.load_weights(model_path)
+    folded = fold_batch_norms(model)
+
+    inference_model = CRNN(stage='predict', loss_fn=None, inference=True)()
+    sources = [layer for layer in model.layers if layer.weights and not isinstance(layer, BatchNormalization)]
+    targets = [layer for layer in inference_model.layers if layer.weights]
+    for source, target in zip(sources, targets):
+        target.set_weights(folded.get(source.name, source.get_weights()))
+
+    session = K.get_session()
+    output_name = inference_model.output.op.name
+    graph_def = freeze_graph(session, session.graph.as_graph_def(), [output_name])
+
+    # Write next to the final files first, so a running server never reads half of them
+    with open(out_path + '.tmp', 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    with open(get_meta_path(out_path) + '.tmp', 'w', encoding='utf8') as f:
+        json.dump({
+            'source': os.path.abspath(model_path),
+            'mtime': os.path.getmtime(model_path),
+            'input': inference_model.input.name,
+            'output': inference_model.output.name
+        }, f)
+    os.replace(out_path + '.tmp', out_path)
+    os.replace(get_meta_path(out_path) + '.tmp', get_meta_path(out_path))
+
+    # The exported graph must compute what the Keras model does
+    x = np.random.rand(2, img_width, img_height, 1).astype(np.float32)
+    expected = model.predict(x)
+    diff = np.abs(FrozenGraphBackend(out_path).predict(x) - expected).max()
+    print("Exported {} nodes to {}, max difference to Keras model {:.2e}".format(len(graph_def.node), out_path, diff))
+    K.clear_session()
+    return out_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export CRNN weights as a frozen inference graph')
+    parser.add_argument('--model', default=pretrained_model, help='Keras weights (.h5)')
+    parser.add_argument('--out', default=None, help='Frozen graph (.pb), next to the weights by default')
+    args = parser.parse_args()
+    export_frozen_graph(args.model, args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+import os
+import json
+import argparse
+from datetime import datetime
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.core.framework.tensor_pb2 import TensorProto
+
+from libs.models.backends import FrozenGraphBackend, get_frozen_path, get_meta_path, is_exported
+from libs.prepare.dataset import load_dataset
+from config import pretrained_model, csv_path, predict_batch_size
+
+
+def load_graph_def(path):
+    graph_def = tf.GraphDef()
+    with open(path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+def save_graph_def(graph_def, model_path, precision):
+    """
+    Write a quantized variant of the exported graph of model_path next to it, with the meta of the float32 graph
+    """
+    frozen_path = get_frozen_path(model_path)
+    with open(get_meta_path(frozen_path), encoding='utf8') as f:
+        meta = json.load(f)
+    meta['precision'] = precision
+
+    out_path = get_frozen_path(model_path, precision)
+    with open(out_path + '.tmp', 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    with open(get_meta_path(out_path) + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(meta, f)
+    os.replace(out_path + '.tmp', out_path)
+    os.replace(get_meta_path(out_path) + '.tmp', get_meta_path(out_path))
+    return out_path
+
+
+def make_node(op, name, inputs=(), **attrs):
+    node = tf.NodeDef(op=op, name=name, input=list(inputs))
+    for key, value in attrs.items():
+        node.attr[key].CopyFrom(value)
+    return node
+
+
+def make_type(dtype):
+    return tf.AttrValue(type=dtype.as_datatype_enum)
+
+
+def make_const(name, value, dtype):
+    value = np.asarray(value, order='C')
+    tensor = TensorProto(dtype=dtype.as_datatype_enum, tensor_shape=tf.TensorShape(value.shape).as_proto(),
+                         tensor_content=value.tobytes())
+    return make_node('Const', name, dtype=make_type(dtype), value=tf.AttrValue(tensor=tensor))
+
+
+def get_tensor_name(ref):
+    return ref if ':' in ref else ref + ':0'
+
+
+def find_const(nodes, ref):
+    """
+    Const node feeding input ref, through Identity nodes, None if it is computed
+    """
+    node = nodes.get(ref.split(':')[0])
+    while node is not None and node.op == 'Identity':
+        node = nodes.get(node.input[0].split(':')[0])
+    return node if node is not None and node.op == 'Const' else None
+
+
+def quantize_float16(graph_def, min_size=1024):
+    """
+    Weight only float16 graph: float32 constants of at least min_size values are stored as float16
+    and cast back when the graph runs, so the model is half the size and computes in float32
+    """
+    out = tf.GraphDef()
+    for node in graph_def.node:
+        value = tf.make_ndarray(node.attr['value'].tensor) if node.op == 'Const' else None
+        if value is None or value.dtype != np.float32 or value.size < min_size:
+            out.node.extend([node])
+            continue
+        out.node.extend([
+            make_const(node.name + '/float16', value.astype(np.float16), tf.float16),
+            make_node('Cast', node.name, [node.name + '/float16'], SrcT=make_type(tf.float16), DstT=make_type(tf.float32))
+        ])
+    return out
+
+
+def get_quantizable_nodes(graph_def):
+    """
+    Conv2D and MatMul nodes with constant weights, the recurrent layers compute theirs inside a while loop
+    and stay float32
+    """
+    nodes = {node.name: node for node in graph_def.node}
+    return [node for node in graph_def.node
+            if node.op in ('Conv2D', 'MatMul') and find_const(nodes, node.input[1]) is not None]
+
+
+def calibrate(backend, graph_def, batches):
+    """
+    Min and max of the activations each quantizable node of graph_def, loaded in backend, gets over batches
+    """
+    quantizable = get_quantizable_nodes(graph_def)
+    tensors = [backend.graph.get_tensor_by_name(get_tensor_name(node.input[0])) for node in quantizable]
+    ranges = {node.name: [np.inf, -np.inf] for node in quantizable}
+    for x in batches:
+        for node, value in zip(quantizable, backend.session.run(tensors, {backend.input: x})):
+            ranges[node.name][0] = min(ranges[node.name][0], float(value.min()))
+            ranges[node.name][1] = max(ranges[node.name][1], float(value.max()))
+    return ranges
+
+
+def quantize_range(lo, hi):
+    # Quantized ranges must hold 0 and must not be empty
+    lo, hi = min(lo, 0.0), max(hi, 0.0)
+    return lo, max(hi, lo + 1e-6)
+
+
+def quantize_weights(value):
+    """
+    quint8 MIN_FIRST values of a float array with their float range
+    """
+    lo, hi = quantize_range(float(value.min()), float(value.max()))
+    scale = 255.0 / (hi - lo)
+    quantized = np.round(value * scale) - np.round(lo * scale)
+    return np.clip(quantized, 0, 255).astype(np.uint8), lo, hi
+
+
+def quantize_int8(graph_def, ranges):
+    """
+    8 bit graph: inputs of Conv2D and MatMul nodes are quantized with their calibrated ranges, their weights ahead
+    of time, they run as QuantizedConv2D / QuantizedMatMul with 32 bit accumulators which are dequantized after
+    """
+    nodes = {node.name: node for node in graph_def.node}
+    quantizable = {node.name for node in get_quantizable_nodes(graph_def)}
+    out = tf.GraphDef()
+    for node in graph_def.node:
+        if node.name not in quantizable:
+            out.node.extend([node])
+            continue
+        name = node.name
+        x_min, x_max = quantize_range(*ranges[name])
+        weights, w_min, w_max = quantize_weights(tf.make_ndarray(find_const(nodes, node.input[1]).attr['value'].tensor))
+        quantized = [
+            make_const(name + '/x_min', np.float32(x_min), tf.float32),
+            make_const(name + '/x_max', np.float32(x_max), tf.float32),
+            make_node('QuantizeV2', name + '/x', [node.input[0], name + '/x_min', name + '/x_max'],
+                      T=make_type(tf.quint8), mode=tf.AttrValue(s=b'MIN_FIRST')),
+            make_const(name + '/w', weights, tf.quint8),
+            make_const(name + '/w_min', np.float32(w_min), tf.float32),
+            make_const(name + '/w_max', np.float32(w_max), tf.float32)
+        ]
+        inputs = [name + '/x:0', name + '/w', name + '/x:1', name + '/x:2', name + '/w_min', name + '/w_max']
+        if node.op == 'Conv2D':
+            quantized.append(make_node('QuantizedConv2D', name + '/quantized', inputs, Tinput=make_type(tf.quint8),
+                                       Tfilter=make_type(tf.quint8), out_type=make_type(tf.qint32),
+                                       strides=node.attr['strides'], padding=node.attr['padding'],
+                                       dilations=node.attr['dilations']))
+        else:
+            quantized.append(make_node('QuantizedMatMul', name + '/quantized', inputs, T1=make_type(tf.quint8),
+                                       T2=make_type(tf.quint8), Toutput=make_type(tf.qint32),
+                                       transpose_a=node.attr['transpose_a'], transpose_b=node.attr['transpose_b']))
+        # Keeps the name of the replaced node, so its consumers are unchanged
+        quantized.append(make_node('Dequantize', name, [name + '/quantized:0', name + '/quantized:1',
+                                                        name + '/quantized:2'],
+                                   T=make_type(tf.qint32), mode=tf.AttrValue(s=b'MIN_FIRST')))
+        out.node.extend(quantized)
+    return out
+
+
+def get_batches(dataset, indexes, batch_size=predict_batch_size):
+    """
+    Model inputs of dataset samples at indexes, batched by width
+    """
+    widths = dataset.widths[indexes]
+    batches = []
+    for width in np.unique(widths):
+        bucket = np.sort(indexes[widths == width])
+        for i in range(0, len(bucket), batch_size):
+            batches.append(dataset.images[bucket[i:i + batch_size], :width] / np.float32(255))
+    return batches
+
+
+def quantize_model(model_path=pretrained_model, n_calibration=512, seed=0, batches=None):
+    """
+    Write float16 and int8 variants of the exported graph of model_path, int8 calibrated on batches of model inputs,
+    by default on val_final.csv samples
+    """
+    reference = FrozenGraphBackend(get_frozen_path(model_path))
+    graph_def = load_graph_def(get_frozen_path(model_path))
+    if batches is None:
+        dataset = load_dataset(os.path.join(csv_path, 'val_final.csv'))
+        indexes = np.random.RandomState(seed).permutation(len(dataset))[:n_calibration]
+        batches = get_batches(dataset, indexes)
+
+    paths = {'float16': save_graph_def(quantize_float16(graph_def), model_path, 'float16')}
+    ranges = calibrate(reference, graph_def, batches)
+    # Drop the float weights the quantized nodes replaced
+    int8_graph_def = tf.graph_util.extract_sub_graph(quantize_int8(graph_def, ranges), [reference.output.op.name])
+    paths['int8'] = save_graph_def(int8_graph_def, model_path, 'int8')
+
+    # Quantized graphs must still agree with the float32 one
+    for precision, path in paths.items():
+        backend = FrozenGraphBackend(path)
+        agree = np.mean([np.mean(backend.predict(x).argmax(-1) == reference.predict(x).argmax(-1)) for x in batches])
+        print("{}: {} ({:.2f} MB), {:.2f} % of frames with the float32 top label".format(
+            precision, path, os.path.getsize(path) / 1024 ** 2, agree * 100))
+    return paths
+
+
+def measure_latency(backend, batches, n=100):
+    """
+    Mean ms per image predicting images one by one, and images/sec predicting whole batches
+    """
+    images = [x[i:i + 1] for x in batches for i in range(len(x))][:n]
+    backend.predict(images[0])  # warm up
+    start = datetime.now()
+    for x in images:
+        backend.predict(x)
+    single = (datetime.now() - start).total_seconds() / len(images) * 1000
+
+    start = datetime.now()
+    for x in batches:
+        backend.predict(x)
+    throughput = sum(len(x) for x in batches) / (datetime.now() - start).total_seconds()
+    return single, throughput
+
+
+def quantization_report(model_path=pretrained_model, n_test=None):
+    """
+    Size, accuracy and latency of the Keras model and of every exported precision, on test.csv
+    """
+    from libs.models.CRNNModel import CRNNModel
+
+    dataset = load_dataset(os.path.join(csv_path, 'test.csv'))
+    n = len(dataset) if n_test is None else min(n_test, len(dataset))
+    batches = get_batches(dataset, np.arange(n))
+
+    report = []
+    for backend, precision in (('keras', 'float32'), ('frozen', 'float32'), ('frozen', 'float16'), ('frozen', 'int8')):
+        path = model_path if backend == 'keras' else get_frozen_path(model_path, precision)
+        if backend == 'frozen' and not is_exported(model_path, precision):
+            print("Skip {} {}, not exported".format(backend, precision))
+            continue
+        model = CRNNModel(model_path=model_path, initial_state=False, backend=backend, precision=precision)
+        accuracy, letter_accuracy = model.evaluate(dataset.images[:n], dataset.texts[:n], widths=dataset.widths[:n])
+        latency, throughput = measure_latency(model.backend, batches)
+        report.append({
+            'backend': backend,
+            'precision': precision,
+            'path': path,
+            'size_mb': round(os.path.getsize(path) / 1024 ** 2, 2),
+            'accuracy': accuracy,
+            'letter_accuracy': letter_accuracy,
+            'latency_ms': round(latency, 2),
+            'images_per_sec': round(throughput, 2)
+        })
+
+    print("{:8s} {:9s} {:>9s} {:>9s} {:>9s} {:>11s} {:>12s}".format(
+        'Backend', 'Precision', 'Size MB', 'Accuracy', 'Letter', 'Latency ms', 'Images/sec'))
+    for row in report:
+        print("{backend:8s} {precision:9s} {size_mb:9.2f} {accuracy:9.2f} {letter_accuracy:9.2f} "
+              "{latency_ms:11.2f} {images_per_sec:12.2f}".format(**row))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Quantize the exported inference graph and report accuracy vs speed')
+    parser.add_argument('--model', default=pretrained_model, help='Keras weights (.h5)')
+    parser.add_argument('--calibration', type=int, default=512, help='Number of val_final.csv calibration images')
+    parser.add_argument('--test', type=int, default=None, help='Number of test.csv images in the report')
+    parser.add_argument('--report', default=None, help='JSON file the report is written to')
+    args = parser.parse_args()
+
+    if not is_exported(args.model):
+        from libs.models.export import export_frozen_graph
+        export_frozen_graph(args.model)
+    quantize_model(args.model, args.calibration)
+    report = quantization_report(args.model, args.test)
+    report_path = args.report or os.path.splitext(args.model)[0] + '.quantization.json'
+    with open(report_path, 'w', encoding='utf8') as f:
+        json.dump(report, f, indent=2)
+    print("Report written to", report_path)
+
+
+if __name__ == '__main__':
+    main()
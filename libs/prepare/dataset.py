@@ -0,0 +1,184 @@
+import numpy as np
+import pandas as pd
+import cv2
+from tqdm import tqdm
+
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from libs.utils.utils import word_to_label, resize_image, get_bucket_width, ctc_min_steps
+from config import data_path, dataset_path, img_width, img_height, max_length, loader_workers, bucket_widths
+
+
+class CompiledDataset(object):
+    """
+    Preprocessed split stored as .npy files and memory-mapped, so it is read lazily through the page cache:
+        images: (n, img_width, img_height, 1) uint8 model inputs, zero padded after their width
+        widths: (n,) int16 input width of each image, img_width unless bucketing
+        labels: (n, max_length) int16 label ids padded with -1
+        label_lengths: (n,) int16
+        texts: ground truth words
+        paths: image paths of the csv file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), encoding='utf8') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(path, 'texts.json'), encoding='utf8') as f:
+            self.texts = json.load(f)
+        with open(os.path.join(path, 'paths.json'), encoding='utf8') as f:
+            self.paths = json.load(f)
+        self.n = self.meta['n']
+        self.images = np.load(os.path.join(path, 'images.npy'), mmap_mode='r')[:self.n]
+        self.widths = np.load(os.path.join(path, 'widths.npy'))[:self.n]
+        self.labels = np.load(os.path.join(path, 'labels.npy'), mmap_mode='r')[:self.n]
+        self.label_lengths = np.load(os.path.join(path, 'label_lengths.npy'), mmap_mode='r')[:self.n]
+
+    def __len__(self):
+        return self.n
+
+
+def get_dataset_dir(csv_file, train=False):
+    """
+    Directory of the compiled split of csv_file, named after the file and a hash of its absolute path,
+    so csv files of the same name in other directories do not share it. Training splits get their own
+    """
+    csv_file = os.path.abspath(csv_file)
+    name = os.path.splitext(os.path.basename(csv_file))[0]
+    name = '{}-{}'.format(name, hashlib.sha1(csv_file.encode('utf8')).hexdigest()[:8])
+    return os.path.join(dataset_path, name + '-train' if train else name)
+
+
+def get_max_width():
+    return max(bucket_widths) if bucket_widths else img_width
+
+
+def is_compiled(csv_file, out_dir, train=False):
+    try:
+        with open(os.path.join(out_dir, 'meta.json'), encoding='utf8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return (meta.get('source') == os.path.abspath(csv_file) and meta.get('mtime') == os.path.getmtime(csv_file)
+            and meta.get('img_width') == get_max_width()
+            and meta.get('img_height') == img_height and meta.get('max_length') == max_length
+            and meta.get('bucket_widths', False) == (list(bucket_widths) if bucket_widths else None)
+            and meta.get('train') == train)
+
+
+def read_sample(path, text, train=True):
+    """
+    Decode and resize image of a sample to its bucket width, None if it can not be read. Training samples
+    are None too if their label is no word of 1 to max_length chars, evaluation samples are kept whatever their label.
+    Training buckets are wide enough for CTC to align the label, evaluation buckets only depend on the image
+    as when serving, so evaluation measures what is served
+    """
+    if train and (not text or len(text) > max_length):
+        return path, text, None
+    img = cv2.imread(os.path.join(data_path, path))
+    if img is None:
+        return path, text, None
+    return path, text, resize_image(img, get_bucket_width(img, ctc_min_steps(text)) if train else None)
+
+
+def compile_dataset(csv_file, out_dir=None, n_workers=loader_workers, train=False):
+    """
+    Decode and resize every image of a split once and write the preprocessed tensors to out_dir.
+    Images which can not be read are skipped and counted in meta['skipped'], training splits also skip empty
+    labels and labels longer than max_length. Processes compiling the same split take turns under a file lock,
+    the later ones find it compiled
+    """
+    if out_dir is None:
+        out_dir = get_dataset_dir(csv_file, train)
+    os.makedirs(os.path.dirname(os.path.abspath(out_dir)), exist_ok=True)
+    with open(out_dir + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if not is_compiled(csv_file, out_dir, train):
+            write_dataset(csv_file, out_dir, n_workers, train)
+    return out_dir
+
+
+def write_dataset(csv_file, out_dir, n_workers=loader_workers, train=False):
+    data = pd.read_csv(csv_file, sep=';', dtype=str, keep_default_na=False)  # Labels like '10' or 'NA' are words
+    paths = data['Image'].values.tolist()
+    texts = data['Label'].values.tolist()
+
+    print("Compiling {} images of {}...".format(len(paths), csv_file))
+    start = datetime.now()
+
+    # Write to a temporary directory first, so readers never see a half written split
+    tmp_dir = '{}.tmp{}'.format(out_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    images = np.lib.format.open_memmap(os.path.join(tmp_dir, 'images.npy'), mode='w+', dtype=np.uint8,
+                                       shape=(len(paths), get_max_width(), img_height, 1))
+    widths = np.zeros(len(paths), dtype=np.int16)
+    labels = np.full((len(paths), max_length), -1, dtype=np.int16)
+    label_lengths = np.zeros(len(paths), dtype=np.int16)
+    kept_paths = []
+    kept_texts = []
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        # Images are decoded in parallel (OpenCV releases the GIL) and written in csv order as they are ready
+        for path, text, img in tqdm(executor.map(read_sample, paths, texts, [train] * len(paths)),
+                                    total=len(paths)):
+            if img is None:
+                continue
+            n = len(kept_texts)
+            images[n, :len(img)] = img
+            widths[n] = len(img)
+            if len(text) <= max_length:  # Labels of evaluation samples may not fit, they are only compared as text
+                labels[n, :len(text)] = word_to_label(text)
+                label_lengths[n] = len(text)
+            kept_paths.append(path)
+            kept_texts.append(text)
+    images.flush()
+    del images
+
+    n = len(kept_texts)
+    np.save(os.path.join(tmp_dir, 'widths.npy'), widths[:n])
+    np.save(os.path.join(tmp_dir, 'labels.npy'), labels[:n])
+    np.save(os.path.join(tmp_dir, 'label_lengths.npy'), label_lengths[:n])
+    with open(os.path.join(tmp_dir, 'texts.json'), 'w', encoding='utf8') as f:
+        json.dump(kept_texts, f, ensure_ascii=False)
+    with open(os.path.join(tmp_dir, 'paths.json'), 'w', encoding='utf8') as f:
+        json.dump(kept_paths, f, ensure_ascii=False)
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf8') as f:
+        json.dump({
+            'source': os.path.abspath(csv_file),
+            'mtime': os.path.getmtime(csv_file),
+            'n': n,
+            'skipped': len(paths) - n,
+            'train': train,
+            'img_width': get_max_width(),
+            'img_height': img_height,
+            'max_length': max_length,
+            'bucket_widths': list(bucket_widths) if bucket_widths else None
+        }, f)
+
+    # Only a stale split is replaced, readers which mapped it keep their arrays
+    stale_dir = '{}.stale{}'.format(out_dir, os.getpid())
+    if os.path.exists(out_dir):
+        os.rename(out_dir, stale_dir)
+    os.rename(tmp_dir, out_dir)
+    shutil.rmtree(stale_dir, ignore_errors=True)
+
+    end = datetime.now()
+    print("Compiled {} / {} images in {}".format(n, len(paths), end - start))
+
+
+def load_dataset(csv_file, train=False):
+    """
+    Load compiled split of csv_file, compiling it first if it is missing or older than the csv.
+    Training splits only hold samples with labels the network can learn, evaluation splits every readable image
+    """
+    out_dir = get_dataset_dir(csv_file, train)
+    if not is_compiled(csv_file, out_dir, train):
+        logging.info('Compiling dataset %s', csv_file)
+        compile_dataset(csv_file, out_dir, train=train)
+    return CompiledDataset(out_dir)
@@ -1,98 +1,107 @@
 import numpy as np
-import pandas as pd
-import cv2
-from keras.callbacks import Callback
-from tqdm import tqdm
+from keras.utils import Sequence
 
-import random
-from datetime import datetime
-
-from libs.utils.utils import word_to_label
+from libs.prepare.dataset import load_dataset
+from libs.utils.utils import get_pred_length
 from config import *
 
 
-class DataGenerator(Callback):
+class DataGenerator(Sequence):
+    """
+    Batches of a compiled split, batch i of an epoch only depends on (seed, epoch, i), so batches can be built
+    independently and in any order by several loader threads or processes.
+    All images of a batch share one width bucket, so short words run through a narrower network
+    """
 
-    def __init__(self, img_dirpath, img_width_, img_height_, batch_size_, n, output_labels, max_text_len=15):
-        self.img_width = img_width_
-        self.img_height = img_height_
+    def __init__(self, dataset, batch_size_, n=None, max_text_len=15, shuffle=True, seed=0):
+        self.dataset = dataset  # CompiledDataset, images are read lazily from its memory map
+        self.img_width = dataset.meta['img_width']
+        self.img_height = dataset.meta['img_height']
         self.batch_size = batch_size_
         self.max_text_len = max_text_len
+        self.shuffle = shuffle
+        self.seed = seed
+
+        self.n = len(dataset) if n is None else min(n, len(dataset))
+        self.texts = dataset.texts[:self.n]
+        self.widths = dataset.widths[:self.n]
+        self.epoch = 0
+        self.batches = self.get_batches(self.epoch)
+
+    def get_indexes(self, epoch):
+        """
+        Sample order of an epoch, a permutation seeded by (seed, epoch) when shuffling
+        """
+        if not self.shuffle:
+            return np.arange(self.n)
+        return np.random.RandomState([self.seed, epoch]).permutation(self.n)
+
+    def get_batches(self, epoch):
+        """
+        Split the sample order of an epoch into full batches of one width each, batches are shuffled across widths
+        """
+        indexes = self.get_indexes(epoch)
+        widths = self.widths[indexes]
+        batches = []
+        for width in np.unique(widths):
+            bucket = indexes[widths == width]
+            n_batches = len(bucket) // self.batch_size
+            batches.extend(np.split(bucket[:n_batches * self.batch_size], n_batches) if n_batches else [])
+        if self.shuffle:
+            np.random.RandomState([self.seed, epoch, 1]).shuffle(batches)
+        return batches
 
-        self.n = n
-        self.img_dir = img_dirpath[:self.n]
-        self.indexes = list(range(self.n))
-        self.cur_index = 0
-        self.imgs = np.zeros((self.n, self.img_height, self.img_width))
-        self.texts = output_labels[:self.n]
+    def copy(self, seed=None):
+        """
+        Independent sequence over the same dataset with its own epoch, e.g. for callbacks
+        """
+        return DataGenerator(self.dataset, self.batch_size, self.n, self.max_text_len, self.shuffle,
+                             self.seed if seed is None else seed)
 
-    def build_data(self):
-        print("Image Loading start with {} images...".format(self.n))
-        start = datetime.now()
-        cnt = 0
-        for img_file in tqdm(self.img_dir):
-            img = cv2.imread(os.path.join(data_path, img_file))
-            img = img[:, :, 1]
-            img = cv2.resize(img, (self.img_width, self.img_height))
-            img = img / 255
-            self.imgs[cnt, :, :] = img
-            cnt += 1
-        end = datetime.now()
-        print("Number of Texts matches with Total Number of Images :", len(self.texts) == self.n)
-        print(self.n, "\tImage Loading finish...")
-        print("Total Time: ", end - start)
+    def __len__(self):
+        return len(self.batches)  # Same every epoch, it only depends on the number of samples per width
 
-    def next_data(self):
-        self.cur_index += 1
-        if self.cur_index >= self.n:
-            self.cur_index = 0
-            random.shuffle(self.indexes)
-        return self.imgs[self.indexes[self.cur_index]], self.texts[self.indexes[self.cur_index]]
+    def __getitem__(self, i):
+        return self.build_batch(self.batches[i])
 
-    def next_batch(self):
-        while True:
-            X_data = np.ones([self.batch_size, self.img_width, self.img_height, 1])  # Single channel Gray Size Scale images for input
-            # Initializing with -1 to aid for padding labels of different lengths
-            Y_data = np.ones([self.batch_size, self.max_text_len]) * -1  # Text labels for input
-            # Input_length for CTC which is the number of time-steps of the RNN output
-            input_length = np.ones((self.batch_size, 1)) * pred_length  # Model predicted output length ignore 2 first letter
-            label_length = np.zeros((self.batch_size, 1))  # Label length for CTC
-            source_str = []  # List to store Ground Truth Labels
+    def on_epoch_end(self):
+        self.epoch += 1
+        self.batches = self.get_batches(self.epoch)
 
-            for i in range(self.batch_size):
-                img, text = self.next_data()  # Getting the image and text data pointed by current index
-                # Taking transpose of image
-                img = img.T
-                img = np.expand_dims(img, -1)  # Expanding image to have a single channel
-                X_data[i] = img
-                label = word_to_label(text)  # Encoding label text to integer list and storing in temp label variable
-                lbl_len = len(label)
-                Y_data[i, 0:lbl_len] = label  # Storing the label till its length and padding others
-                label_length[i] = len(label)
-                source_str.append(text)  # Storing Ground Truth Labels which will be accessed as reference for calculating metrics
+    def build_batch(self, idx):
+        """
+        Assemble inputs and outputs of the batch of dataset indexes idx of one width, vectorized over the whole batch
+        """
+        idx = np.sort(idx)  # Read the memory map in file order, samples of a batch are unordered anyway
+        width = int(self.widths[idx[0]])
+        X_data = self.dataset.images[idx, :width] / np.float32(255)  # Single channel Gray Size Scale images for input
+        # Label ids are stored padded with -1 to aid for padding labels of different lengths
+        Y_data = np.ones([len(idx), self.max_text_len]) * -1  # Text labels for input
+        labels = self.dataset.labels[idx, :self.max_text_len]
+        Y_data[:, :labels.shape[1]] = labels
+        # Input_length for CTC which is the number of time-steps of the RNN output
+        input_length = np.ones((len(idx), 1)) * get_pred_length(width)  # Model predicted output length ignore 2 first letter
+        label_length = self.dataset.label_lengths[idx].reshape(-1, 1).astype(np.float64)  # Label length for CTC
+        source_str = [self.texts[i] for i in idx]  # Ground Truth Labels for calculating metrics
 
-            # Preparing the input for the Model
-            inputs = {
-                'img_input': X_data,
-                'ground_truth_labels': Y_data,
-                'input_length': input_length,
-                'label_length': label_length,
-                'source_str': np.array(source_str)  # Used for visualization only
-            }
-            # Preparing output for the Model and initializing to zeros
-            outputs = {'ctc': np.zeros([self.batch_size])}
-            yield inputs, outputs  # Return the Prepared input and output to the Model
+        # Preparing the input for the Model
+        inputs = {
+            'img_input': X_data,
+            'ground_truth_labels': Y_data,
+            'input_length': input_length,
+            'label_length': label_length,
+            'source_str': np.array(source_str)  # Used for visualization only
+        }
+        # Preparing output for the Model and initializing to zeros
+        outputs = {'ctc': np.zeros([len(idx)])}
+        return inputs, outputs
 
 
 def get_generator(mode):
     filename = mode + '_final.csv'
-    data = pd.read_csv(os.path.join(csv_path, filename), sep=';')
-    paths = data['Image'].values.tolist()
-    labels = data['Label'].values.tolist()
+    dataset = load_dataset(os.path.join(csv_path, filename), train=True)
     if mode == 'val':
-        gene = DataGenerator(paths, img_width, img_height, batch_size, val_size, labels, max_text_len=max_length)
+        gene = DataGenerator(dataset, batch_size, val_size, max_text_len=max_length, shuffle=False)
     else:
-        gene = DataGenerator(paths, img_width, img_height, batch_size, train_size, labels, max_text_len=max_length)
-    gene.build_data()
-    n_batches = int(gene.n / gene.batch_size)
-    return gene, n_batches
+        gene = DataGenerator(dataset, batch_size, train_size, max_text_len=max_length)
+    return gene, len(gene)
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from libs.utils.latency import stage_latency
+from config import batch_max_size, batch_max_wait
+
+
+class MicroBatcher(object):
+    """
+    Collect concurrent requests for up to max_wait seconds or max_size items, run them through
+    predict_fn as one batch in an executor and resolve each request with its own result
+    """
+
+    def __init__(self, loop, predict_fn, max_size=batch_max_size, max_wait=batch_max_wait, executor=None):
+        self._loop = loop
+        self.predict_fn = predict_fn  # Takes a list of items and returns a list of results in the same order
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers=1)
+
+        self._queue = asyncio.Queue()
+        self._task = None
+
+        self.n_items = 0
+        self.n_batches = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = self._loop.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def get_metrics(self):
+        return {
+            'queue_depth': self.queue_depth(),
+            'items': self.n_items,
+            'batches': self.n_batches,
+            'last_batch_size': self.last_batch_size,
+            'max_batch_size': self.max_batch_size,
+            'mean_batch_size': self.n_items / self.n_batches if self.n_batches else 0.0
+        }
+
+    async def submit(self, item):
+        """
+        Queue item and wait for its result, returns (result, size of the batch it was predicted in)
+        """
+        self.start()
+        future = self._loop.create_future()
+        await self._queue.put((item, future, self._loop.time()))
+        return await future
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        deadline = self._loop.time() + self.max_wait
+        while len(batch) < self.max_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            items = [item for item, _, _ in batch]
+            futures = [future for _, future, _ in batch]
+            now = self._loop.time()
+            for _, _, queued in batch:
+                stage_latency.observe('queue', now - queued)
+
+            self.n_items += len(batch)
+            self.n_batches += 1
+            self.last_batch_size = len(batch)
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+
+            try:
+                results = await self._loop.run_in_executor(self.executor, self.predict_fn, items)
+            except Exception as err:
+                logging.exception(err)
+                if len(batch) == 1:
+                    if not futures[0].done():
+                        futures[0].set_exception(err)
+                    continue
+                # Retry item by item, so only the item which fails the batch fails
+                for item, future in zip(items, futures):
+                    await self._run_alone(item, future)
+                continue
+
+            for future, result in zip(futures, results):
+                if not future.done():
+                    future.set_result((result, len(batch)))
+
+    async def _run_alone(self, item, future):
+        try:
+            result = (await self._loop.run_in_executor(self.executor, self.predict_fn, [item]))[0]
+        except Exception as err:
+            logging.exception(err)
+            if not future.done():
+                future.set_exception(err)
+            return
+        if not future.done():
+            future.set_result((result, 1))
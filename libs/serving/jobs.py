@@ -0,0 +1,311 @@
+import os
+import re
+import json
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime
+
+from libs.utils.errors import JobCancelled
+from config import job_executor, job_workers, job_path, job_sync_interval, pretrained_model, evaluation_path
+
+_worker_model = None  # Model loaded once per worker process for evaluation jobs
+finished_statuses = ('succeeded', 'failed', 'cancelled')
+
+
+class JobContext(object):
+    """
+    Progress and cancellation flag shared between a job and the server, picklable for process workers
+    """
+
+    def __init__(self, state, cancel_event):
+        self._state = state
+        self._cancel_event = cancel_event
+
+    def start(self):
+        self._state['started'] = datetime.now().isoformat()
+
+    def get_state(self):
+        return dict(self._state)
+
+    def progress(self, done, total, metrics=None):
+        """
+        Record progress and running metrics, raises JobCancelled once cancellation was requested
+        """
+        self._state['progress'] = round(done / total, 4) if total else 1.0
+        if metrics is not None:
+            self._state['metrics'] = metrics
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def is_cancelled(self):
+        return self._cancel_event.is_set()
+
+
+class Job(object):
+    def __init__(self, kind, context):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.context = context
+        self.created = datetime.now()
+        self.finished = None
+        self.status = 'pending'
+        self.result = None
+        self.error = None
+        self.future = None
+
+    def to_dict(self):
+        state = self.context.get_state()
+        status = self.status
+        if status == 'pending' and state.get('started') is not None:
+            status = 'running'
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': status,
+            'progress': state.get('progress', 0.0),
+            'metrics': state.get('metrics'),
+            'created': self.created.isoformat(),
+            'started': state.get('started'),
+            'finished': self.finished.isoformat() if self.finished else None,
+            'result': self.result,
+            'error': self.error
+        }
+
+
+def run_job(fn, context, *args):
+    if context.is_cancelled():
+        raise JobCancelled()
+    context.start()
+    return fn(context, *args)
+
+
+def get_worker_model():
+    global _worker_model
+    if _worker_model is None:
+        from libs.models.CRNNModel import CRNNModel
+        _worker_model = CRNNModel(model_path=pretrained_model, initial_state=False)
+    return _worker_model
+
+
+def train_job(context, epochs):
+    from libs.models.CRNNModel import CRNNModel
+    from libs.utils.callbacks import ProgressCallback
+
+    start = datetime.now()
+    model = CRNNModel(model_path=pretrained_model, initial_state=True)
+    model.fit(epochs=epochs, callbacks=[ProgressCallback(context.progress)])
+    if context.is_cancelled():
+        raise JobCancelled()
+    return {'epochs': len(model.history.epoch), 'time': (datetime.now() - start).total_seconds()}
+
+
+def evaluate_job(context, filename, paths, labels, batch_size, model=None, options=None):
+    """
+    Evaluate a csv file or (paths, labels). Options of run_evaluation come from the request, evaluations of a file
+    are checkpointed under evaluation_path unless 'resume' is false, and may dump their errors there
+    """
+    from libs.prepare.dataset import load_dataset
+
+    if model is None:
+        model = get_worker_model()
+    options = dict(options or {})
+    resume = options.pop('resume', True)
+    dump_errors = options.pop('errors', False)
+
+    if paths is None or labels is None:
+        dataset = load_dataset(filename)
+        images, texts, widths, names = dataset.images, dataset.texts, dataset.widths, dataset.paths
+        source = '{}:{}'.format(os.path.abspath(filename), os.path.getmtime(filename))
+    else:
+        images, texts, widths, names = paths, labels, None, None
+        source = json.dumps([paths, labels])
+
+    # Same file, model, and options: same checkpoint and error file
+    name = hashlib.sha1(json.dumps([source, model.cache.fingerprint, options.get('sample'), options.get('seed', 0),
+                                    options.get('ci_target'), bool(dump_errors)]).encode('utf8')).hexdigest()[:16]
+    os.makedirs(evaluation_path, exist_ok=True)
+    checkpoint_path = os.path.join(evaluation_path, name + '.json')
+    if not resume and os.path.isfile(checkpoint_path):
+        os.remove(checkpoint_path)
+    errors_path = os.path.join(evaluation_path, name + '.errors.csv') if dump_errors else None
+
+    result = model.run_evaluation(images, texts, batch_size=batch_size, progress=context.progress, widths=widths,
+                                  names=names, checkpoint_path=checkpoint_path, errors_path=errors_path, **options)
+    if paths is None or labels is None:
+        result['skipped'] = dataset.meta['skipped']  # Rows of the file whose image can not be read
+    return result
+
+
+class JobManager(object):
+    """
+    Run long training and evaluation work in a thread or process pool and keep track of it by job id.
+    The state of each job is written to a JSON file under path, at most sync_interval seconds behind, so every
+    server worker answers for jobs started by the others. Other workers cancel a job through a marker file
+    its worker picks up at the next sync
+    """
+
+    def __init__(self, loop, executor=job_executor, max_workers=job_workers, path=job_path,
+                 sync_interval=job_sync_interval):
+        self._loop = loop
+        self.executor_type = executor
+        if executor == 'process':
+            # Spawn fresh workers, forking a process with an initialized TensorFlow session is unsafe
+            mp_context = multiprocessing.get_context('spawn')
+            self._manager = mp_context.Manager()
+            self.executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context)
+        else:
+            self._manager = None
+            self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.path = path
+        self.sync_interval = sync_interval
+        self.jobs = {}  # Jobs of this worker
+        self._sync_task = None
+        os.makedirs(path, exist_ok=True)
+
+    def is_process_pool(self):
+        return self.executor_type == 'process'
+
+    def new_context(self):
+        if self._manager is not None:
+            return JobContext(self._manager.dict(), self._manager.Event())
+        return JobContext({}, threading.Event())
+
+    def submit(self, kind, fn, *args):
+        job = Job(kind, self.new_context())
+        job.future = self._loop.run_in_executor(self.executor, run_job, fn, job.context, *args)
+        job.future.add_done_callback(lambda future: self._finish(job, future))
+        self.jobs[job.id] = job
+        self.save(job)
+        if self._sync_task is None:
+            self._sync_task = self._loop.create_task(self._sync())
+        return job
+
+    def _finish(self, job, future):
+        job.finished = datetime.now()
+        if future.cancelled():
+            job.status = 'cancelled'
+        else:
+            err = future.exception()
+            if err is None:
+                job.status = 'succeeded'
+                job.result = future.result()
+            elif isinstance(err, JobCancelled):
+                job.status = 'cancelled'
+            else:
+                logging.error('Job %s failed: %s', job.id, err)
+                job.status = 'failed'
+                job.error = str(err)
+        self.save(job)
+
+    def get_file(self, job_id, extension='.json'):
+        return os.path.join(self.path, job_id + extension)
+
+    def save(self, job):
+        state = job.to_dict()
+        state['pid'] = os.getpid()
+        tmp_path = self.get_file(job.id, '.json.tmp')
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.get_file(job.id))
+        if job.status in finished_statuses and os.path.exists(self.get_file(job.id, '.cancel')):
+            os.remove(self.get_file(job.id, '.cancel'))
+
+    def load(self, job_id):
+        """
+        State of a job of another worker, failed if that worker exited before the job finished
+        """
+        try:
+            with open(self.get_file(job_id), encoding='utf8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        pid = state.pop('pid', None)
+        if state['status'] not in finished_statuses and not is_alive(pid):
+            state['status'] = 'failed'
+            state['error'] = 'Server worker exited before the job finished'
+        return state
+
+    async def _sync(self):
+        """
+        Write the progress of running jobs and cancel those other workers asked to, until all jobs are finished
+        """
+        try:
+            while any(job.status not in finished_statuses for job in self.jobs.values()):
+                await asyncio.sleep(self.sync_interval)
+                for job in self.jobs.values():
+                    if job.status in finished_statuses:
+                        continue
+                    if os.path.exists(self.get_file(job.id, '.cancel')):
+                        job.context.cancel()
+                    self.save(job)
+        finally:
+            self._sync_task = None
+
+    def get(self, job_id):
+        """
+        State of a job of any worker, None if there is no job with this id
+        """
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        if not re.fullmatch('[0-9a-f]{32}', job_id):
+            return None
+        return self.load(job_id)
+
+    def list(self):
+        job_ids = {name[:-len('.json')] for name in os.listdir(self.path) if name.endswith('.json')}
+        states = [self.get(job_id) for job_id in job_ids | set(self.jobs)]
+        return sorted((state for state in states if state is not None), key=lambda state: state['created'])
+
+    def cancel(self, job_id):
+        """
+        Ask a job to stop, pending jobs stop before they start and running ones at their next progress report.
+        Jobs of other workers are asked through a marker file
+        """
+        job = self.jobs.get(job_id)
+        if job is not None:
+            if job.future.done():
+                return False
+            job.context.cancel()
+            return True
+        state = self.get(job_id)
+        if state is None or state['status'] in finished_statuses:
+            return False
+        open(self.get_file(job_id, '.cancel'), 'w').close()
+        return True
+
+    def shutdown(self):
+        for job in self.jobs.values():
+            if not job.future.done():
+                job.context.cancel()
+                job.status = 'cancelled'
+                job.finished = datetime.now()
+                self.save(job)
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+        self.executor.shutdown(wait=False)
+        if self._manager is not None:
+            self._manager.shutdown()
+
+
+def is_alive(pid):
+    """
+    Whether the server worker with process id pid is running, a reused pid of this process is a worker that exited
+    """
+    if pid is None or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -0,0 +1,135 @@
+import time
+from collections import Counter
+
+from aiohttp import web
+
+from libs.utils.latency import LatencyRecorder, stage_latency
+
+
+class RequestMonitor(object):
+    """
+    aiohttp middleware counting in-flight requests, responses per route and status, and timing each route.
+    The total time is added to the Server-Timing header of responses which are not streamed
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+        self.responses = Counter()  # (method, route, status) -> count
+        self.latency = LatencyRecorder()
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else 'unmatched'
+        status = 500
+        self.in_flight += 1
+        start = time.perf_counter()
+        try:
+            response = await handler(request)
+            status = response.status
+            if not response.prepared:
+                add_server_timing(response, {'total': time.perf_counter() - start})
+            return response
+        except web.HTTPException as err:
+            status = err.status
+            raise
+        finally:
+            self.in_flight -= 1
+            self.latency.observe(route, time.perf_counter() - start)
+            self.responses[(request.method, route, status)] += 1
+
+
+def format_server_timing(timings):
+    """
+    Server-Timing header value of stage durations in seconds, e.g. predict;dur=12.3 (ms)
+    """
+    return ', '.join('{};dur={:.3f}'.format(name, seconds * 1000) for name, seconds in timings.items())
+
+
+def add_server_timing(response, timings):
+    value = format_server_timing(timings)
+    if response.headers.get('Server-Timing'):
+        value = response.headers['Server-Timing'] + ', ' + value
+    response.headers['Server-Timing'] = value
+
+
+def format_labels(labels):
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+def format_histograms(name, description, label, snapshot, const_labels=()):
+    """
+    Prometheus text lines of one histogram per label value, and a gauge of their recent p50/p95/p99,
+    const_labels are (key, value) added to every series
+    """
+    lines = ['# HELP {}_seconds {}'.format(name, description), '# TYPE {}_seconds histogram'.format(name)]
+    for value, histogram in sorted(snapshot.items()):
+        labels = list(const_labels) + [(label, value)]
+        for bound, count in histogram['buckets']:
+            lines.append('{}_seconds_bucket{} {}'.format(name, format_labels(labels + [('le', bound)]), count))
+        lines.append('{}_seconds_bucket{} {}'.format(name, format_labels(labels + [('le', '+Inf')]),
+                                                     histogram['count']))
+        lines.append('{}_seconds_sum{} {}'.format(name, format_labels(labels), histogram['sum']))
+        lines.append('{}_seconds_count{} {}'.format(name, format_labels(labels), histogram['count']))
+
+    lines.extend(['# HELP {}_latency_seconds Quantiles of the latest {} durations'.format(name, label),
+                  '# TYPE {}_latency_seconds gauge'.format(name)])
+    for value, histogram in sorted(snapshot.items()):
+        labels = list(const_labels) + [(label, value)]
+        for q, seconds in histogram['quantiles']:
+            lines.append('{}_latency_seconds{} {}'.format(name, format_labels(labels + [('quantile', q)]), seconds))
+    return lines
+
+
+def format_metric(name, kind, description, samples, const_labels=()):
+    """
+    Prometheus text lines of a counter or gauge, samples are (labels, value), const_labels are added to each
+    """
+    lines = ['# HELP {} {}'.format(name, description), '# TYPE {} {}'.format(name, kind)]
+    for labels, value in samples:
+        labels = list(const_labels) + list(labels)
+        lines.append('{}{} {}'.format(name, format_labels(labels) if labels else '', value))
+    return lines
+
+
+def render_metrics(monitor, batcher=None, cache=None, jobs=None, worker=None):
+    """
+    Metrics of this server process in the Prometheus text format. Processes of a multi-worker server
+    each count only what they served, their series are told apart by a worker label
+    """
+    const_labels = [('worker', worker)] if worker is not None else []
+    lines = format_metric('ocr_requests_in_flight', 'gauge', 'Requests being served', [([], monitor.in_flight)],
+                          const_labels)
+    lines += format_metric('ocr_responses_total', 'counter', 'Responses per route and status', [
+        ([('method', method), ('route', route), ('status', status)], count)
+        for (method, route, status), count in sorted(monitor.responses.items())], const_labels)
+    lines += format_histograms('ocr_request', 'Time to serve a request per route', 'route',
+                               monitor.latency.snapshot(), const_labels)
+    lines += format_histograms('ocr_stage', 'Time spent in each prediction stage, per image or forward pass',
+                               'stage', stage_latency.snapshot(), const_labels)
+
+    if batcher is not None:
+        metrics = batcher.get_metrics()
+        lines += format_metric('ocr_batcher_queue_depth', 'gauge', 'Images waiting for a /predict batch',
+                               [([], metrics['queue_depth'])], const_labels)
+        lines += format_metric('ocr_batcher_items_total', 'counter', 'Images predicted by the batcher',
+                               [([], metrics['items'])], const_labels)
+        lines += format_metric('ocr_batcher_batches_total', 'counter', 'Batches predicted by the batcher',
+                               [([], metrics['batches'])], const_labels)
+        lines += format_metric('ocr_batcher_max_batch_size', 'gauge', 'Largest batch predicted',
+                               [([], metrics['max_batch_size'])], const_labels)
+    if cache is not None:
+        metrics = cache.get_metrics()
+        for key, kind, description in (('size', 'gauge', 'Predictions in the result cache'),
+                                       ('hits', 'counter', 'Result cache hits'),
+                                       ('misses', 'counter', 'Result cache misses'),
+                                       ('evictions', 'counter', 'Result cache evictions')):
+            name = 'ocr_cache_' + key + ('_total' if kind == 'counter' else '')
+            lines += format_metric(name, kind, description, [([], metrics[key])], const_labels)
+    if jobs is not None:
+        statuses = Counter(job['status'] for job in jobs.list())
+        lines += format_metric('ocr_jobs', 'gauge', 'Training and evaluation jobs per status',
+                               [([('status', status)], count) for status, count in sorted(statuses.items())],
+                               const_labels)
+    return '\n'.join(lines) + '\n'
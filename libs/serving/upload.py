@@ -0,0 +1,130 @@
+import os
+import base64
+import binascii
+
+import pandas as pd
+
+from libs.utils.errors import ApiBadRequest, ApiPayloadTooLarge
+from config import max_image_size, data_path, predict_batch_size
+
+binary_types = ('application/octet-stream',)  # Content types of a raw encoded image body, besides image/*
+
+
+def is_binary(content_type):
+    return content_type.startswith('image/') or content_type in binary_types
+
+
+def check_size(size, max_size=max_image_size):
+    if size > max_size:
+        raise ApiPayloadTooLarge('Image larger than {} bytes'.format(max_size))
+
+
+def check_not_empty(buffer):
+    if not len(buffer):
+        raise ApiBadRequest('Empty image')
+    return buffer
+
+
+async def read_body(request, max_size=max_image_size):
+    """
+    Raw encoded image of a binary body, as a memoryview of the request buffer
+    """
+    if request.content_length is not None:
+        check_size(request.content_length, max_size)
+    body = await request.read()
+    check_size(len(body), max_size)
+    return memoryview(check_not_empty(body))
+
+
+async def read_part(part, max_size=max_image_size):
+    """
+    Encoded image of a multipart part, read chunk by chunk so a too large image is rejected before it is buffered
+    """
+    buffer = bytearray()
+    while True:
+        chunk = await part.read_chunk()
+        if not chunk:
+            break
+        check_size(len(buffer) + len(chunk), max_size)
+        buffer.extend(chunk)
+    return memoryview(check_not_empty(buffer))
+
+
+async def read_multipart(request, max_images, max_size=max_image_size):
+    """
+    Images of a multipart body: file parts are encoded images, text parts named 'image' are paths
+    """
+    reader = await request.multipart()
+    images = []
+    while True:
+        part = await reader.next()
+        if part is None:
+            break
+        if part.filename is None and part.name == 'image':
+            images.append(await part.text())
+        elif part.filename is not None or is_binary(part.headers.get('Content-Type', '')):
+            images.append(await read_part(part, max_size))
+        else:
+            await part.release()
+            continue
+        if len(images) > max_images:
+            raise ApiBadRequest('At most {} images per request'.format(max_images))
+    return images
+
+
+def decode_base64(text, max_size=max_image_size):
+    """
+    Encoded image of a base64 string, data URLs (data:image/png;base64,...) are accepted too
+    """
+    if not isinstance(text, str):
+        raise ApiBadRequest('Base64 image must be a string')
+    if text.startswith('data:'):
+        text = text.partition(',')[2]
+    check_size(len(text) * 3 // 4, max_size)
+    try:
+        buffer = base64.b64decode(text, validate=True)
+    except (binascii.Error, ValueError):
+        raise ApiBadRequest('Improper base64 image')
+    return memoryview(check_not_empty(buffer))
+
+
+def get_json_images(body, max_images, max_size=max_image_size):
+    """
+    Images of a JSON body: server paths in 'image' / 'images', base64 encoded images in 'image_base64' / 'images_base64'
+    """
+    images = []
+    for field, is_list, encoded in (('image', False, False), ('images', True, False),
+                                    ('image_base64', False, True), ('images_base64', True, True)):
+        values = body.get(field)
+        if values is None:
+            continue
+        if not is_list:
+            values = [values]
+        elif not isinstance(values, list):
+            raise ApiBadRequest("'{}' must be a list".format(field))
+        if len(images) + len(values) > max_images:
+            raise ApiBadRequest('At most {} images per request'.format(max_images))
+        for value in values:
+            if encoded:
+                images.append(decode_base64(value, max_size))
+            elif isinstance(value, str):
+                images.append(value)
+            else:
+                raise ApiBadRequest("Paths in '{}' must be strings".format(field))
+    return images
+
+
+def iter_csv(source, chunk_size=predict_batch_size):
+    """
+    Chunks of (path, name, label) of a csv file or buffer in the Image;Label format of data/csv,
+    read chunk_size rows at a time so a file of any length is streamed. Paths are relative to data_path.
+    Cells are read as text, so labels like '10' or 'NA' stay labels, empty labels are no labels
+    """
+    try:
+        for data in pd.read_csv(source, sep=';', chunksize=chunk_size, dtype=str, keep_default_na=False):
+            if 'Image' not in data:
+                raise ApiBadRequest("CSV must have an 'Image' column")
+            labels = data['Label'] if 'Label' in data else [None] * len(data)
+            yield [(os.path.join(data_path, name), name, label or None) for name, label in zip(data['Image'], labels)]
+    except (ValueError, pd.errors.ParserError) as err:
+        raise ApiBadRequest('Improper CSV: {}'.format(err))
@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from config import cache_size, cache_ttl, cache_path, cache_quantization_bits
+
+
+class ResultCache(object):
+    """
+    LRU cache of decoded texts keyed on a content hash of the resized model input, so repeated images are
+    predicted once whatever their path. Entries belong to a fingerprint of the model weights and decoding
+    settings, setting another fingerprint (when weights are loaded) drops them
+    """
+
+    def __init__(self, max_size=cache_size, ttl=cache_ttl, path=cache_path, quantization_bits=cache_quantization_bits):
+        self.max_size = max_size  # 0 disables the cache
+        self.ttl = ttl  # Seconds an entry stays valid, None for no expiry
+        self.path = path  # JSON file the cache is persisted to, None to keep it in memory only
+        self.quantization_bits = quantization_bits  # Low bits of each pixel ignored, so near-identical images match
+        self.fingerprint = None
+
+        self._entries = OrderedDict()  # key -> (text, time added)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def enabled(self):
+        return self.max_size > 0
+
+    def key(self, img):
+        """
+        Hash of a resized uint8 model input
+        """
+        if self.quantization_bits:
+            img = img >> self.quantization_bits
+        h = hashlib.blake2b(str(img.shape).encode(), digest_size=16)  # Equal bytes at other widths are other images
+        h.update(img.tobytes())
+        return h.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        if not self.enabled():
+            return
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def set_fingerprint(self, fingerprint):
+        """
+        Drop entries of other weights or settings, then load persisted entries of this fingerprint
+        """
+        if fingerprint == self.fingerprint:
+            return
+        self.clear()
+        self.fingerprint = fingerprint
+        self.load()
+
+    def load(self):
+        if self.path is None or not self.enabled() or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as err:
+            logging.warning('Can not load result cache %s: %s', self.path, err)
+            return
+        if data.get('fingerprint') != self.fingerprint:
+            return
+        now = time.time()
+        with self._lock:
+            for key, value, added in data['entries'][-self.max_size:]:
+                if self.ttl is None or now - added <= self.ttl:
+                    self._entries[key] = (value, added)
+
+    def save(self):
+        if self.path is None or not self.enabled():
+            return
+        with self._lock:
+            entries = [[key, value, added] for key, (value, added) in self._entries.items()]
+        tmp_path = '{}.tmp{}'.format(self.path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump({'fingerprint': self.fingerprint, 'entries': entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def get_metrics(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
@@ -1,7 +1,9 @@
-import numpy as np
+import time
+
 from keras.callbacks import Callback
 
-from libs.utils.utils import decode_batch, accuracies
+from libs.utils.utils import decode_batch
+from libs.utils.metrics import MetricCounts
 
 
 class VizCallback(Callback):
@@ -9,36 +11,92 @@ class VizCallback(Callback):
     The Custom Callback created for printing the Accuracy and Letter Accuracy Metrics at the End of Each Epoch
     """
 
-    def __init__(self, test_func, text_img_gen, is_train, acc_compute_batches):
+    def __init__(self, test_func, sequence, is_train, acc_compute_batches):
         self.test_func = test_func
-        self.text_img_gen = text_img_gen
+        self.sequence = sequence                # Own copy of the data sequence, so training batches are not consumed
+        self.cur_batch = 0
         self.is_train = is_train                # Used to indicate whether the callback is called to for Train or Validation Data
         self.acc_batches = acc_compute_batches  # Number of Batches for which the metrics are computed typically equal to steps/epoch
 
+    def next_batch(self):
+        """
+        Gets the next batch from the own data sequence, starting a new epoch of it when all batches were seen
+        """
+        if self.cur_batch >= len(self.sequence):
+            self.cur_batch = 0
+            self.sequence.on_epoch_end()
+        word_batch = self.sequence[self.cur_batch][0]
+        self.cur_batch += 1
+        return word_batch
+
     def show_accuracy_metrics(self, num_batches):
         """
-        Calculates the accuracy and letter accuracy for each batch of inputs,
-        and prints the avarage accuracy and letter accuracy across all the batches
+        Calculates the accuracy, letter accuracy, character and word error rates over all the batches
         """
-        accuracy = 0
-        letter_accuracy = 0
-        batches_cnt = num_batches
-        while batches_cnt > 0:
-            word_batch = next(self.text_img_gen)[0]   # Gets the next batch from the Data generator
+        counts = MetricCounts()
+        for _ in range(num_batches):
+            word_batch = self.next_batch()
             decoded_res = decode_batch(self.test_func, word_batch['img_input'])
-            actual_res = word_batch['source_str']
-            acc, let_acc = accuracies(actual_res, decoded_res)
-            accuracy += acc
-            letter_accuracy += let_acc
-            batches_cnt -= 1
-        accuracy = accuracy / num_batches
-        letter_accuracy = letter_accuracy / num_batches
+            counts.update(decoded_res, [str(text) for text in word_batch['source_str']])
+        metrics = counts.to_dict()
         if self.is_train:
-            print("\nTrain Average Accuracy: \t", np.round(accuracy, 2), " %")
-            print("Train Average Letter Accuracy: \t", np.round(letter_accuracy, 2), " %")
+            print("\nTrain Average Accuracy: \t", metrics['accuracy'], " %")
+            print("Train Average Letter Accuracy: \t", metrics['letter_accuracy'], " %")
+            print("Train CER / WER: \t\t", metrics['cer'], " % / ", metrics['wer'], " %")
         else:
-            print("Validation Average Accuracy: \t\t", np.round(accuracy, 2), " %")
-            print("Validation Average Letter Accuracy: \t", np.round(letter_accuracy, 2), " %")
+            print("Validation Average Accuracy: \t\t", metrics['accuracy'], " %")
+            print("Validation Average Letter Accuracy: \t", metrics['letter_accuracy'], " %")
+            print("Validation CER / WER: \t\t\t", metrics['cer'], " % / ", metrics['wer'], " %")
 
     def on_epoch_end(self, epoch, logs=None):
         self.show_accuracy_metrics(self.acc_batches)
+
+
+class ProgressCallback(Callback):
+    """
+    Report training progress as (done steps, total steps) to a progress function after each batch.
+    JobCancelled raised by the progress function propagates out of fit, so a cancelled training
+    skips validation, the end-of-epoch callbacks and saving the final model
+    """
+
+    def __init__(self, progress):
+        self.progress = progress
+        self.epoch = 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_batch_end(self, batch, logs=None):
+        steps = self.params.get('steps') or 1
+        self.progress(self.epoch * steps + batch + 1, self.params.get('epochs', 1) * steps)
+
+
+class LoaderStatsCallback(Callback):
+    """
+    Print the training images/sec and the time the training loop waited for the data loader at the end of each epoch
+    """
+
+    def __init__(self):
+        self.start = 0.0
+        self.last_batch_end = 0.0
+        self.wait_time = 0.0
+        self.n_images = 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = self.last_batch_end = time.monotonic()
+        self.wait_time = 0.0
+        self.n_images = 0
+
+    def on_batch_begin(self, batch, logs=None):
+        self.wait_time += time.monotonic() - self.last_batch_end
+
+    def on_batch_end(self, batch, logs=None):
+        self.last_batch_end = time.monotonic()
+        self.n_images += (logs or {}).get('size', 0)
+
+    def on_epoch_end(self, epoch, logs=None):
+        elapsed = self.last_batch_end - self.start
+        if elapsed <= 0:
+            return
+        print("Data loader: {:.1f} images/sec, waited {:.2f} s for batches ({:.1f} % of training time)".format(
+            self.n_images / elapsed, self.wait_time, self.wait_time / elapsed * 100))
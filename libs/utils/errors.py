@@ -69,8 +69,19 @@ class ApiNotFound(_ApiError):
         super().__init__()
 
 
+class ApiPayloadTooLarge(_ApiError):
+    def __init__(self, message):
+        self.status_code = 413
+        self.message = 'Payload Too Large: ' + message
+        super().__init__()
+
+
 class ApiUnauthorized(_ApiError):
     def __init__(self, message):
         self.status_code = 401
         self.message = 'Unauthorized: ' + message
-        super().__init__()
\ No newline at end of file
+        super().__init__()
+
+
+class JobCancelled(Exception):
+    """Raised inside a background job when its cancellation was requested."""
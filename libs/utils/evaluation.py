@@ -0,0 +1,198 @@
+import os
+import csv
+import json
+import math
+import logging
+from collections import Counter
+from datetime import datetime
+
+import numpy as np
+
+from libs.utils.metrics import MetricCounts, confusion_counts, top_confusions
+from libs.utils.utils import predict_indexes
+from config import predict_batch_size
+
+
+class RunningMetrics(MetricCounts):
+    """
+    Metric counts updated chunk by chunk, with letter confusions and a confidence interval of the accuracy
+    """
+
+    def __init__(self, failed=0, confusions=(), **counts):
+        super().__init__(**counts)
+        self.failed = failed  # Images which could not be read, not counted in the metrics
+        self.confusions = Counter({(label, predicted): count for label, predicted, count in confusions})
+
+    def update(self, predicteds, labels):
+        """
+        Count a chunk of predictions, returns the letter distance of each to its label, None for unread images
+        """
+        kept = [i for i, predicted in enumerate(predicteds) if predicted is not None]
+        self.failed += len(predicteds) - len(kept)
+        kept_predicteds = [predicteds[i] for i in kept]
+        kept_labels = [labels[i] for i in kept]
+        kept_distances = super().update(kept_predicteds, kept_labels)
+        self.confusions.update(confusion_counts(kept_predicteds, kept_labels, kept_distances))
+
+        distances = [None] * len(predicteds)
+        for i, distance in zip(kept, kept_distances):
+            distances[i] = int(distance)
+        return distances
+
+    def confidence_interval(self, z=1.96):
+        """
+        Half width in % of the Wilson score interval of the accuracy, z = 1.96 for 95 % confidence
+        """
+        if not self.n:
+            return 100.0
+        p = self.matches / self.n
+        n = self.n
+        return z * math.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / (1 + z ** 2 / n) * 100
+
+    def state(self):
+        state = super().state()
+        state['failed'] = self.failed
+        state['confusions'] = [[label, predicted, count] for (label, predicted), count in self.confusions.items()]
+        return state
+
+    def to_dict(self):
+        result = super().to_dict()
+        result.update({
+            'confidence_interval': round(self.confidence_interval(), 2),
+            'evaluated': self.n,
+            'failed': self.failed
+        })
+        return result
+
+
+def get_order(n, sample=None, seed=0):
+    """
+    Indexes of the images to evaluate: all in order, or a random subsample of size sample in random order,
+    so every prefix of it is a random sample too
+    """
+    if sample is None:
+        return np.arange(n)
+    return np.random.RandomState(seed).permutation(n)[:min(sample, n)]
+
+
+def iter_evaluation(model, images, labels, lm, order, batch_size=predict_batch_size, widths=None, names=None,
+                    metrics=None, position=0):
+    """
+    Predict images of order from position on, chunk by chunk, yielding after each chunk its end position,
+    the running metrics and the (index, name, label, predicted, letter distance) of its wrong predictions
+    """
+    if metrics is None:
+        metrics = RunningMetrics()
+    for i in range(position, len(order), batch_size):
+        indexes = order[i:i + batch_size]
+        predicteds = predict_indexes(model, images, lm, indexes, batch_size, widths)
+        chunk_labels = [labels[k] for k in indexes]
+        distances = metrics.update(predicteds, chunk_labels)
+        errors = []
+        for k, predicted, label, distance in zip(indexes, predicteds, chunk_labels, distances):
+            if distance != 0:
+                name = names[k] if names is not None else (images[k] if not isinstance(images, np.ndarray) else k)
+                errors.append((int(k), name, label, predicted, distance))
+        yield min(i + batch_size, len(order)), metrics, errors
+
+
+def save_checkpoint(path, checkpoint):
+    with open(path + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.tmp', path)
+
+
+def load_checkpoint(path, key, errors_path=None):
+    """
+    Checkpoint at path of an evaluation with the same key, None if there is none or its error file
+    is missing or shorter than the part of it the checkpoint covers
+    """
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, encoding='utf8') as f:
+            checkpoint = json.load(f)
+        if checkpoint['key'] != key:
+            return None
+        if errors_path is not None and (not os.path.isfile(errors_path)
+                                        or os.path.getsize(errors_path) < checkpoint['errors_size']):
+            logging.warning('Error file of the evaluation checkpoint is missing or truncated, start over')
+            return None
+        return checkpoint
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        logging.warning('Evaluation checkpoint not usable: %s', err)
+        return None
+
+
+def run_evaluation(model, images, labels, lm, batch_size=predict_batch_size, widths=None, names=None, progress=None,
+                   sample=None, seed=0, ci_target=None, min_samples=100, checkpoint_path=None, errors_path=None,
+                   key=None):
+    """
+    Evaluate images chunk by chunk, on all of them or a random subsample of size sample, stopping early once the
+    accuracy's 95 % confidence interval is at most +-ci_target % after at least min_samples images.
+    With checkpoint_path, progress is saved after each chunk and an evaluation with the same key resumes there.
+    With errors_path, every wrong prediction is written to a csv file for later analysis
+    """
+    start = datetime.now()
+    if sample is None and ci_target is not None:
+        sample = len(images)  # Stopping early needs every prefix to be a random sample
+    order = get_order(len(images), sample, seed)
+    key = {'key': key, 'n': len(images), 'sample': sample, 'seed': seed, 'errors': errors_path is not None}
+
+    metrics = RunningMetrics()
+    position = 0
+    errors_size = 0  # Bytes of the error file covered by the checkpoint
+    checkpoint = load_checkpoint(checkpoint_path, key, errors_path) if checkpoint_path is not None else None
+    if checkpoint is not None:
+        metrics = RunningMetrics(**checkpoint['metrics'])
+        position = checkpoint['position']
+        errors_size = checkpoint['errors_size']
+        logging.info('Resume evaluation at %s / %s', position, len(order))
+
+    errors_file = None
+    if errors_path is not None:
+        # Drop errors written after the checkpoint, their chunk is evaluated again
+        resume_errors = position > 0 and os.path.isfile(errors_path)
+        errors_file = open(errors_path, 'r+' if resume_errors else 'w', encoding='utf8', newline='')
+        if resume_errors:
+            errors_file.seek(errors_size)
+            errors_file.truncate()
+        else:
+            csv.writer(errors_file, delimiter=';').writerow(['Index', 'Image', 'Label', 'Predicted', 'Distance'])
+
+    stopped_early = False
+    try:
+        for position, metrics, errors in iter_evaluation(model, images, labels, lm, order, batch_size, widths, names,
+                                                         metrics, position):
+            if errors_file is not None:
+                csv.writer(errors_file, delimiter=';').writerows(
+                    (k, name, label, '' if predicted is None else predicted, '' if distance is None else distance)
+                    for k, name, label, predicted, distance in errors)
+                errors_file.flush()
+            if checkpoint_path is not None:
+                save_checkpoint(checkpoint_path, {
+                    'key': key,
+                    'position': position,
+                    'metrics': metrics.state(),
+                    'errors_size': errors_file.tell() if errors_file is not None else 0
+                })
+            if progress is not None:
+                progress(position, len(order), metrics.to_dict())
+            if ci_target is not None and metrics.n >= min_samples and metrics.confidence_interval() <= ci_target:
+                stopped_early = position < len(order)
+                break
+    finally:
+        if errors_file is not None:
+            errors_file.close()
+
+    if checkpoint_path is not None and os.path.isfile(checkpoint_path):
+        os.remove(checkpoint_path)  # Done, a new evaluation starts from scratch
+    result = metrics.to_dict()
+    result.update({
+        'confusions': top_confusions(metrics.confusions),
+        'total': len(order),
+        'stopped_early': stopped_early,
+        'errors_path': errors_path,
+        'time': (datetime.now() - start).total_seconds()
+    })
+    return result
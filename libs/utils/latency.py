@@ -0,0 +1,102 @@
+import time
+import bisect
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+from config import latency_metrics, latency_buckets, latency_window
+
+_local = threading.local()
+
+
+class Histogram(object):
+    """
+    Durations in seconds: cumulative counts per bucket for Prometheus, and the latest window of them
+    for quantiles of the recent latency
+    """
+
+    def __init__(self, buckets=latency_buckets, window=latency_window):
+        self.buckets = tuple(buckets)  # Upper bounds in seconds, sorted
+        self.counts = [0] * (len(self.buckets) + 1)  # Last one counts durations above every bound
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def quantiles(self, qs=(0.5, 0.95, 0.99)):
+        if not self.recent:
+            return [0.0] * len(qs)
+        return np.percentile(np.fromiter(self.recent, dtype=np.float64), [q * 100 for q in qs]).tolist()
+
+    def snapshot(self, qs=(0.5, 0.95, 0.99)):
+        return {
+            'buckets': list(zip(self.buckets, np.cumsum(self.counts[:-1]).tolist())),
+            'count': self.count,
+            'sum': self.sum,
+            'quantiles': list(zip(qs, self.quantiles(qs)))
+        }
+
+
+class LatencyRecorder(object):
+    """
+    Histograms of named stages, filled from any thread. Stage durations are also summed into the timings
+    collected by the current thread, see collect_timings
+    """
+
+    def __init__(self, buckets=latency_buckets, window=latency_window, enabled=latency_metrics):
+        self.buckets = buckets
+        self.window = window
+        self.enabled = enabled
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        timings = getattr(_local, 'timings', None)
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + seconds
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.buckets, self.window)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Time the enclosed block on the monotonic clock and record it as stage name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self._lock:
+            return {name: histogram.snapshot() for name, histogram in self.histograms.items()}
+
+
+@contextmanager
+def collect_timings():
+    """
+    Sum the durations of the stages this thread records while active, per stage, into the yielded dict
+    """
+    previous = getattr(_local, 'timings', None)
+    _local.timings = timings = {}
+    try:
+        yield timings
+    finally:
+        _local.timings = previous
+
+
+stage_latency = LatencyRecorder()  # Stages of predict_batch and decode_label
+timer = stage_latency.timer
@@ -0,0 +1,126 @@
+from collections import Counter
+
+import editdistance
+import numpy as np
+
+
+def char_distances(predicteds, labels):
+    """
+    Levenshtein distance between each prediction and its label, in letters
+    """
+    return np.fromiter((editdistance.eval(p, l) for p, l in zip(predicteds, labels)), dtype=np.int64,
+                       count=len(labels))
+
+
+def word_distances(predicteds, labels):
+    """
+    Levenshtein distance between each prediction and its label, in words
+    """
+    return np.fromiter((editdistance.eval(p.split(), l.split()) for p, l in zip(predicteds, labels)), dtype=np.int64,
+                       count=len(labels))
+
+
+class MetricCounts(object):
+    """
+    Sums behind exact match accuracy, character error rate and word error rate, which batches add up to
+    """
+
+    def __init__(self, n=0, matches=0, char_errors=0, chars=0, word_errors=0, words=0):
+        self.n = n
+        self.matches = matches
+        self.char_errors = char_errors
+        self.chars = chars  # Letters of the labels
+        self.word_errors = word_errors
+        self.words = words  # Words of the labels
+
+    def update(self, predicteds, labels):
+        """
+        Add a batch of predictions, returns the letter distance of each of them to its label
+        """
+        distances = char_distances(predicteds, labels)
+        self.n += len(labels)
+        self.matches += int(np.count_nonzero(distances == 0))
+        self.char_errors += int(distances.sum())
+        self.chars += sum(len(label) for label in labels)
+        self.word_errors += int(word_distances(predicteds, labels).sum())
+        self.words += sum(len(label.split()) for label in labels)
+        return distances
+
+    def accuracy(self):
+        return self.matches / self.n * 100 if self.n else 0.0
+
+    def cer(self):
+        return self.char_errors / self.chars * 100 if self.chars else 0.0
+
+    def wer(self):
+        return self.word_errors / self.words * 100 if self.words else 0.0
+
+    def letter_accuracy(self):
+        return max(0.0, 100 - self.cer())
+
+    def state(self):
+        return {'n': self.n, 'matches': self.matches, 'char_errors': self.char_errors, 'chars': self.chars,
+                'word_errors': self.word_errors, 'words': self.words}
+
+    def to_dict(self):
+        return {
+            'accuracy': round(self.accuracy(), 2),
+            'letter_accuracy': round(self.letter_accuracy(), 2),
+            'cer': round(self.cer(), 2),
+            'wer': round(self.wer(), 2)
+        }
+
+
+def compute_metrics(predicteds, labels):
+    """
+    Exact match accuracy, letter accuracy (100 - CER), CER and WER in % of predictions against labels
+    """
+    counts = MetricCounts()
+    counts.update(predicteds, labels)
+    return counts.to_dict()
+
+
+def align(predicted, label):
+    """
+    (label letter, predicted letter) of every edit turning label into predicted with the fewest edits,
+    '' stands for the missing side of insertions and deletions
+    """
+    n, m = len(label), len(predicted)
+    cost = np.zeros((n + 1, m + 1), dtype=np.int64)
+    cost[:, 0] = np.arange(n + 1)
+    cost[0, :] = np.arange(m + 1)
+    for i in range(1, n + 1):
+        for j in range(1, m + 1):
+            cost[i, j] = min(cost[i - 1, j] + 1, cost[i, j - 1] + 1,
+                             cost[i - 1, j - 1] + (label[i - 1] != predicted[j - 1]))
+    edits = []
+    i, j = n, m
+    while i > 0 or j > 0:
+        if i > 0 and j > 0 and cost[i, j] == cost[i - 1, j - 1] + (label[i - 1] != predicted[j - 1]):
+            if label[i - 1] != predicted[j - 1]:
+                edits.append((label[i - 1], predicted[j - 1]))
+            i, j = i - 1, j - 1
+        elif i > 0 and cost[i, j] == cost[i - 1, j] + 1:
+            edits.append((label[i - 1], ''))
+            i -= 1
+        else:
+            edits.append(('', predicted[j - 1]))
+            j -= 1
+    return edits[::-1]
+
+
+def confusion_counts(predicteds, labels, distances=None):
+    """
+    Counter of (label letter, predicted letter) edits over all predictions, only wrong ones are aligned
+    """
+    if distances is None:
+        distances = char_distances(predicteds, labels)
+    counts = Counter()
+    for k in np.flatnonzero(distances):
+        counts.update(align(predicteds[k], labels[k]))
+    return counts
+
+
+def top_confusions(counts, k=20):
+    return [{'label': label, 'predicted': predicted, 'count': count}
+            for (label, predicted), count in counts.most_common(k)]
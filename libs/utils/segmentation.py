@@ -0,0 +1,67 @@
+import json
+import math
+
+import cv2
+import numpy as np
+
+from config import line_min_gap, line_ink_threshold, line_max_separators
+
+
+def parse_separators(value, max_separators=line_max_separators):
+    """
+    Word separators of a line as sorted x-coordinates, from a list or a string like the Sep column of
+    data/csv/detect.csv ('[0, 58, 107]' or '0,58,107'). Raises ValueError if they are no finite, non-negative
+    numbers or more than max_separators
+    """
+    try:
+        if isinstance(value, str):
+            value = value.strip()
+            value = json.loads(value) if value.startswith('[') else [v for v in value.split(',') if v.strip()]
+        if not isinstance(value, (list, tuple)):
+            raise ValueError()
+        xs = [float(x) for x in value]
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError("'separators' must be a list of x-coordinates")
+    if not all(math.isfinite(x) and x >= 0 for x in xs):
+        raise ValueError("'separators' must be finite and not negative")
+    separators = sorted({int(x) for x in xs})
+    if len(separators) > max_separators:
+        raise ValueError("At most {} 'separators'".format(max_separators))
+    return separators
+
+
+def get_ink(img):
+    """
+    Binary mask of the dark-on-light or light-on-dark text of a decoded image, by Otsu's threshold
+    """
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    _, ink = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    if ink.mean() > 0.5:
+        ink = 1 - ink  # Light text on a dark background, text is the minority
+    return ink
+
+
+def find_separators(img, min_gap=line_min_gap, ink_threshold=line_ink_threshold):
+    """
+    Word separators of a line image from its vertical projection profile: columns with at most ink_threshold
+    of their pixels inked are blank, and the middle of every blank run of at least min_gap times the line height
+    between two inked columns starts a new word. The first separator is 0, as in data/csv/detect.csv
+    """
+    ink = get_ink(img)
+    blank = ink.sum(axis=0) <= ink_threshold * ink.shape[0]
+    # Starts and ends of the runs of blank columns
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], blank.astype(np.int8), [0]])))
+    starts, ends = edges[::2], edges[1::2]
+    inner = (starts > 0) & (ends < len(blank)) & (ends - starts >= max(min_gap * ink.shape[0], 1))
+    return [0] + ((starts[inner] + ends[inner]) // 2).tolist()
+
+
+def crop_words(img, separators):
+    """
+    (x, crop) of every word region of a line image, each spans from its separator to the next one, the first
+    from 0 and the last to the right edge. Separators outside of the image are ignored
+    """
+    width = img.shape[1]
+    starts = sorted({0} | {x for x in separators if 0 <= x < width})
+    ends = starts[1:] + [width]
+    return [(x0, img[:, x0:x1]) for x0, x1 in zip(starts, ends) if x1 - x0 > 1]
@@ -1,15 +1,13 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import cv2
-from keras import backend as K
-import itertools
-from tqdm import tqdm
-
 from config import *
-from libs.word_beam_search.word_beam_search import word_beam_search
+from libs.word_beam_search.fast_word_beam_search import fast_word_beam_search
+from libs.utils.metrics import compute_metrics
+from libs.utils.latency import timer
+from libs.utils.segmentation import find_separators, crop_words
 
 import logging
-from datetime import datetime
 
 
 def word_to_label(word):
@@ -30,19 +28,98 @@ def label_to_word(label):
 
 
 def ctc_loss_function(args):
+    from keras import backend as K  # Imported here, prediction with an exported graph runs without Keras
+
     y_pred, y_true, input_length, label_length = args
     y_pred = y_pred[:, 2:, :]
     return K.ctc_batch_cost(y_true, y_pred, input_length, label_length)
 
 
-def decode_label(lm, out, word=True):
+label_chars = np.array(list(letters) + [''], dtype=object)  # Text of every label, '' for the blank
+
+
+def best_path_batch(mats):
+    """
+    Best path decoding of NxTxC matrices at once: top labels, repeats collapsed and blanks removed by masks over
+    the whole batch. Returns the label array of each matrix and its lowest top probability over all frames
+    """
+    best = np.argmax(mats, axis=2)
+    if not best.shape[1]:
+        return [best[i] for i in range(len(best))], np.zeros(len(best))
+    confidences = np.take_along_axis(mats, best[:, :, np.newaxis], axis=2)[:, :, 0].min(axis=1)
+    keep = best != mats.shape[2] - 1
+    keep[:, 1:] &= best[:, 1:] != best[:, :-1]
+    return np.split(best[keep], np.cumsum(keep.sum(axis=1))[:-1]), confidences
+
+
+def labels_to_text(labels):
+    return ''.join(label_chars[labels])
+
+
+def decode_best_path(outs):
+    """
+    Texts of output matrices (TxC, time steps of the whole input) by best path, matrices with the same number
+    of time steps are decoded together
+    """
+    texts = [None] * len(outs)
+    groups = {}
+    for i, out in enumerate(outs):
+        groups.setdefault(out.shape, []).append(i)
+    for indexes in groups.values():
+        with timer('best_path'):
+            labels, _ = best_path_batch(np.stack([outs[i][2:] for i in indexes]))
+            for i, label in zip(indexes, labels):
+                texts[i] = labels_to_text(label)
+    return texts
+
+
+def is_dictionary_text(lm, text):
+    """
+    Whether text has at least one word and all of its words are in the language model
+    """
+    word_characters = lm.get_word_chars()
+    words = ''.join(c if c in word_characters else ' ' for c in text).split()
+    return len(words) > 0 and all(lm.is_word(w) for w in words)
+
+
+def prune_frames(mat, blank_threshold=None, char_threshold=None):
+    """
+    Keep one frame of each run of frames with the same confident top label, a blank above blank_threshold
+    or a letter above char_threshold. Decoding the rest only rescales all beams alike
+    """
+    best = np.argmax(mat, axis=1)
+    top = mat[np.arange(len(best)), best]
+    is_blank = best == mat.shape[1] - 1
+    confident = np.zeros(len(best), dtype=bool)
+    if blank_threshold is not None:
+        confident |= is_blank & (top >= blank_threshold)
+    if char_threshold is not None:
+        confident |= ~is_blank & (top >= char_threshold)
+    repeated = np.zeros(len(best), dtype=bool)
+    repeated[1:] = confident[1:] & confident[:-1] & (best[1:] == best[:-1])
+    return mat[~repeated]
+
+
+def decode_label(lm, out, word=True, blank_threshold=decode_blank_threshold, char_threshold=decode_char_threshold,
+                 fast_threshold=best_path_threshold):
     mat = out[0, 2:, :]
     if word:
-        out_str = word_beam_search(mat, beam_width, lm)
+        if fast_threshold is not None:
+            # Fast path: confident best path made of dictionary words
+            with timer('best_path'):
+                labels, confidences = best_path_batch(mat[np.newaxis])
+                out_str = labels_to_text(labels[0])
+                is_fast = confidences[0] >= fast_threshold and is_dictionary_text(lm, out_str)
+            if is_fast:
+                return out_str
+        if blank_threshold is not None or char_threshold is not None:
+            with timer('prune'):
+                mat = prune_frames(mat, blank_threshold, char_threshold)
+        with timer('beam_search'):
+            out_str = fast_word_beam_search(mat, beam_width, lm, lm_mode)
     else:
-        out_best = list(np.argmax(mat, axis=1))
-        out_best = [k for k, g in itertools.groupby(out_best)]
-        out_str = label_to_word(out_best)
+        labels, _ = best_path_batch(mat[np.newaxis])
+        out_str = labels_to_text(labels[0])
     return out_str
 
 
@@ -51,92 +128,268 @@ def decode_batch(test_function, word_batch):
     Decode batch labels to words
     """
     out = test_function([word_batch])[0]
-    ret = []
-    for i in range(out.shape[0]):
-        out_best = list(np.argmax(out[i, 2:], axis=1))
-        out_best = [k for k, _ in itertools.groupby(out_best)]
-        out_str = label_to_word(out_best)
-        ret.append(out_str)
-    return ret
+    labels, _ = best_path_batch(out[:, 2:])
+    return [labels_to_text(label) for label in labels]
 
 
 def accuracies(actual_labels, predicted_labels):
     """
-    Calculate the accuracy and letter accuracy on a batch
-    """
-    acc = 0
-    letter_acc = 0
-    letter_cnt = 0
-    cnt = 0
-    for i in range(len(actual_labels)):
-        predicted_output = predicted_labels[i]
-        actual_output = actual_labels[i]
-        cnt += 1
-        for j in range(min(len(predicted_output), len(actual_output))):
-            if predicted_output[j] == actual_output[j]:
-                letter_acc += 1
-        letter_cnt += max(len(predicted_output), len(actual_output))
-        if actual_output == predicted_output:
-            acc += 1
-    final_accuracy = np.round((acc / len(actual_labels)) * 100, 2)
-    final_letter_accuracy = np.round((letter_acc / letter_cnt) * 100, 2)
-    return final_accuracy, final_letter_accuracy
-
-
-def predict_label(model, image, lm):
+    Calculate the accuracy and letter accuracy (100 - character error rate) on a batch
+    """
+    metrics = compute_metrics(predicted_labels, actual_labels)
+    return metrics['accuracy'], metrics['letter_accuracy']
+
+
+def decode_image(buffer):
+    """
+    Decode an encoded image (bytes, bytearray or memoryview) in place, without copying or writing it to a file.
+    None if it can not be decoded
+    """
     try:
-        img = cv2.imread(image)
-        if img is None:
-            logging.warning('Image not found')
-            return None
-        img = cv2.resize(img, (img_width, img_height))
+        return cv2.imdecode(np.frombuffer(buffer, dtype=np.uint8), cv2.IMREAD_COLOR)
+    except cv2.error:
+        return None  # OpenCV raises on empty buffers instead of returning None
+
+
+def read_image(image):
+    """
+    Read image from path or decode an encoded image buffer, decoded images are returned unchanged
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return decode_image(image)
+    return cv2.imread(image)
+
+
+def get_pred_length(width):
+    """
+    Number of RNN time steps decoded for an input of width, the first 2 outputs are ignored
+    """
+    return width // width_stride - 2
+
+
+def ctc_min_steps(text):
+    """
+    Min number of time steps CTC needs for text, repeated letters must be separated by a blank
+    """
+    return len(text) + sum(1 for a, b in zip(text, text[1:]) if a == b)
+
+
+def get_bucket_width(img, min_steps=0):
+    """
+    Smallest of bucket_widths holding decoded image at its aspect ratio with at least min_steps time steps,
+    img_width when bucketing is off
+    """
+    if not bucket_widths:
+        return img_width
+    natural_width = img.shape[1] * img_height / img.shape[0]
+    for width in bucket_widths:
+        if width >= natural_width and get_pred_length(width) >= min_steps:
+            return width
+    return bucket_widths[-1]
+
+
+def resize_image(img, width=None):
+    """
+    Resize decoded BGR image to a (width, img_height, 1) uint8 array, width defaults to the bucket width of the image
+    """
+    if width is None:
+        width = get_bucket_width(img)
+    img = cv2.resize(img, (width, img_height))
+    if img.ndim == 3:
         img = img[:, :, 1]
-        img = img.T
-        img = np.expand_dims(img, axis=-1)
-        img = np.expand_dims(img, axis=0)
-        img = img / 255
-        out = model.predict(img)
-        predicted = decode_label(lm, out)
-        return predicted
+    img = img.T
+    return np.expand_dims(img, axis=-1)
+
+
+def get_window_stride(window=img_width, overlap=window_overlap):
+    return max((window - overlap) // width_stride * width_stride, width_stride)
+
+
+def get_window_starts(width, window=img_width, overlap=window_overlap):
+    """
+    Starts of the overlapping windows covering an input of width, multiples of width_stride so the time steps
+    of all windows line up
+    """
+    stride = get_window_stride(window, overlap)
+    n_windows = 1 + max(-(-(width - window) // stride), 0)
+    return [k * stride for k in range(n_windows)]
+
+
+def resize_windows(img, max_n_windows=max_windows):
+    """
+    Resize decoded BGR image wider than img_width to img_height at its aspect ratio, instead of squeezing it, and pad
+    it on the right to the end of its last window. Returns the (width, img_height, 1) uint8 input and the start of
+    each window, None if the image fits in one img_width input. Images needing more than max_n_windows windows
+    are squeezed to the width of max_n_windows, so an extreme aspect ratio can not blow up the batch
+    """
+    natural_width = int(round(img.shape[1] * img_height / img.shape[0]))
+    if natural_width <= img_width:
+        return None
+    natural_width = min(natural_width, img_width + (max_n_windows - 1) * get_window_stride())
+    starts = get_window_starts(natural_width)
+    img = resize_image(img, natural_width)
+    return np.pad(img, ((0, starts[-1] + img_width - natural_width), (0, 0), (0, 0)), mode='edge'), starts
+
+
+def stitch_windows(outs, starts):
+    """
+    Output matrix of a whole input from the output matrices of its windows: each time step is taken from the window
+    it is most central in, frames near window edges only see parts of letters
+    """
+    steps = outs[0].shape[0]
+    offsets = [start // width_stride for start in starts]
+    bounds = [0] + [(offset + previous + steps) // 2 for previous, offset in zip(offsets, offsets[1:])] + \
+        [offsets[-1] + steps]
+    return np.concatenate([out[lo - offset:hi - offset]
+                           for out, offset, lo, hi in zip(outs, offsets, bounds, bounds[1:])])
+
+
+def preprocess_image(img):
+    """
+    Resize decoded BGR image and convert it to a (width, img_height, 1) model input
+    """
+    return resize_image(img) / 255
+
+
+def predict_outputs(model, inputs):
+    """
+    Run one forward pass per input width over stacked model inputs, returns the output matrix of each input
+    with only the time steps of its own width
+    """
+    outs = [None] * len(inputs)
+    groups = {}
+    for i, x in enumerate(inputs):
+        groups.setdefault(x.shape, []).append(i)
+    for indexes in groups.values():
+        with timer('predict'):
+            out = model.predict(np.stack([inputs[i] for i in indexes]), batch_size=len(indexes))
+        for i, row in zip(indexes, out):
+            outs[i] = row
+    return outs
+
+
+def predict_inputs(model, inputs, lm):
+    """
+    Predict and decode stacked model inputs, one forward pass per input width
+    """
+    return [decode_label(lm, out[np.newaxis]) for out in predict_outputs(model, inputs)]
+
+
+def predict_batch(model, images, lm, batch_size=predict_batch_size, cache=None, windowed=sliding_window, greedy=None):
+    """
+    Predict images (paths or decoded arrays) in chunks of batch_size, None for images which can not be read
+    or fail to be preprocessed or decoded, the error is logged and the other images are predicted.
+    Images found in the result cache are not predicted again. When windowed, images wider than img_width
+    are predicted as overlapping windows at their aspect ratio, all windows of a chunk in one batch.
+    Images flagged in greedy (one flag per image) are decoded by best path instead of beam search, faster but
+    without the dictionary, their texts are not cached
+    """
+    predicteds = [None] * len(images)
+    for start in range(0, len(images), batch_size):
+        inputs = []
+        items = []  # (image index, index of its first input, window starts or None, cache key or None)
+        for i in range(start, min(start + batch_size, len(images))):
+            # A bad image fails alone, not the other images of its chunk
+            try:
+                prepared = prepare_image(images[i], cache, windowed)
+            except Exception as err:
+                logging.exception(err)
+                continue
+            if prepared is None:
+                continue
+            img, starts, key, predicteds[i] = prepared
+            if predicteds[i] is not None:
+                continue
+            items.append((i, len(inputs), starts, key))
+            if starts is None:
+                inputs.append(img / 255)
+            else:
+                inputs.extend(img[x:x + img_width] / 255 for x in starts)
+        if not inputs:
+            continue
+        outs = predict_outputs(model, inputs)
+        greedy_outs = []
+        for i, first, starts, key in items:
+            try:
+                out = outs[first] if starts is None else stitch_windows(outs[first:first + len(starts)], starts)
+                if greedy is not None and greedy[i]:
+                    greedy_outs.append((i, out))
+                    continue
+                predicteds[i] = decode_label(lm, out[np.newaxis])
+            except Exception as err:
+                logging.exception(err)
+                continue
+            if key is not None:
+                cache.put(key, predicteds[i])
+        try:
+            texts = decode_best_path([out for _, out in greedy_outs])
+        except Exception as err:
+            logging.exception(err)
+            texts = [None] * len(greedy_outs)
+        for (i, _), text in zip(greedy_outs, texts):
+            predicteds[i] = text
+    return predicteds
+
+
+def prepare_image(image, cache=None, windowed=sliding_window):
+    """
+    Read and resize an image for predict_batch, returns (input, window starts or None, cache key or None,
+    cached text or None), None if the image can not be read
+    """
+    with timer('image_decode'):
+        img = read_image(image)
+    if img is None:
+        logging.warning('Image not found or not decodable')
+        return None
+    with timer('preprocess'):
+        windows = resize_windows(img) if windowed else None
+        img, starts = (resize_image(img), None) if windows is None else windows
+    if cache is None or not cache.enabled():
+        return img, starts, None, None
+    with timer('cache'):
+        key = cache.key(img)
+        return img, starts, key, cache.get(key)
+
+
+def predict_label(model, image, lm, cache=None):
+    try:
+        return predict_batch(model, [image], lm, cache=cache)[0]
     except Exception as e:
         logging.exception(e)
 
 
-def predict_data_output(model, images, labels, lm, n=None):
-    if n is None or n > len(images):
-        n = len(images)
-    start = datetime.now()
-    acc = 0
-    letter_acc = 0
-    letter_cnt = 0
-    cnt = 0
-    letter_mis = []  # Count miss match letter for each images
-    predicteds = []
-    for i in tqdm(range(n)):
-        img_path = os.path.join(data_path, images[i])
-        predicted = predict_label(model, img_path, lm)
-        if predicted is None:
-            continue
-        predicteds.append(predicted)
-        actual = labels[i]
-
-        cnt += 1
-        mis = 0
-        for j in range(min(len(predicted), len(actual))):
-            if predicted[j] == actual[j]:
-                letter_acc += 1
-            else:
-                mis += 1
-        letter_cnt += max(len(predicted), len(actual))
-        letter_mis.append(mis)
-
-        if predicted == actual:
-            acc += 1
-        # if cnt % 100 == 0:
-        #     print("Processed {} images".format(cnt))
-    end = datetime.now()
-    print("Total Times: ", end - start)
-    return acc, letter_acc, letter_cnt, letter_mis, cnt
+def predict_line(model, image, lm, separators=None, cache=None):
+    """
+    Predict every word of a line image (path, encoded or decoded) in batches of predict_batch_size, separators
+    are the x-coordinates words start at, found from the projection profile if None. Returns [(x, width, text)]
+    of the words, None if the image can not be read
+    """
+    img = read_image(image)
+    if img is None:
+        logging.warning('Image not found or not decodable')
+        return None
+    if separators is None:
+        with timer('segment'):
+            separators = find_separators(img)
+    crops = crop_words(img, separators)
+    predicteds = predict_batch(model, [crop for _, crop in crops], lm, cache=cache)
+    return [(x, crop.shape[1], text) for (x, crop), text in zip(crops, predicteds)]
+
+
+def predict_indexes(model, images, lm, indexes, batch_size=predict_batch_size, widths=None):
+    """
+    Predict images at indexes, images are paths relative to data_path or uint8 inputs of a compiled dataset
+    padded to their widths. None for images which can not be read
+    """
+    if isinstance(images, np.ndarray):
+        # Compiled dataset, images are resized uint8 model inputs
+        if widths is None:
+            return predict_inputs(model, [images[k] / 255 for k in indexes], lm)
+        return predict_inputs(model, [images[k, :widths[k]] / 255 for k in indexes], lm)
+    img_paths = [os.path.join(data_path, images[k]) for k in indexes]
+    return predict_batch(model, img_paths, lm, batch_size)
 
 
 def plot_cdf(x, title='CDF Plot', xlabel='Values', ylabel='CDF'):
@@ -1,4 +1,4 @@
-import copy
+import numpy as np
 
 
 class Optical:
@@ -18,16 +18,31 @@ class Textual:
         self.wordDev = ''  # developing word
         self.prUnnormalized = 1.0
         self.prTotal = 1.0
+        self.node = 0  # prefix tree node of developing word
+        self.lastLabel = -1  # label of last char, -1 if text is empty
+        self.lastWord = -1  # prefix tree node of last word in wordHist
+
+    def copy(self):
+        textual = Textual(self.text)
+        textual.wordHist = list(self.wordHist)
+        textual.wordDev = self.wordDev
+        textual.prUnnormalized = self.prUnnormalized
+        textual.prTotal = self.prTotal
+        textual.node = self.node
+        textual.lastLabel = self.lastLabel
+        textual.lastWord = self.lastWord
+        return textual
 
 
 class Beam:
     """beam with text, optical and textual score"""
 
-    def __init__(self, lm):
-        """creates genesis beam"""
+    def __init__(self, lm, mode='Words'):
+        """creates genesis beam, mode is one of the LM scoring modes 'Words', 'NGrams' and 'NGramsForecast'"""
         self.optical = Optical(1.0, 0.0)
         self.textual = Textual('')
         self.lm = lm
+        self.mode = mode
 
     def merge_beam(self, beam):
         """merge probabilities of two beams with same text"""
@@ -56,23 +71,43 @@ class Beam:
     def get_score(self):
         return self.get_pr_total() * self.get_pr_textual()
 
-    def get_next_chars(self):
-        return self.lm.get_next_chars(self.textual.wordDev)
+    def get_node(self):
+        return self.textual.node
 
-    def create_child_beam(self, newChar, prBlank, prNonBlank):
-        """extend beam by new character and set optical score"""
-        beam = Beam(self.lm)
+    def get_last_label(self):
+        return self.textual.lastLabel
+
+    def get_next(self):
+        """labels which may extend beam and the prefix tree nodes they lead to"""
+        return self.lm.get_next(self.textual.node)
+
+    def create_child_beam(self, label, node, prBlank, prNonBlank):
+        """extend beam by label (-1 keeps the text) leading to prefix tree node and set optical score"""
+        beam = Beam(self.lm, self.mode)
 
         # copy textual information
-        beam.textual = copy.deepcopy(self.textual)
-        beam.textual.text += newChar
+        beam.textual = self.textual.copy()
 
         # do textual calculations only if beam gets extended
-        if newChar != '':
-            if newChar in beam.lm.get_word_chars():
-                beam.textual.wordDev += newChar
+        if label >= 0:
+            textual = beam.textual
+            newChar = self.lm.get_all_chars()[label]
+            textual.text += newChar
+            textual.lastLabel = label
+            textual.node = node
+            if self.mode != 'Words':
+                scores = self.lm.score_extensions(
+                    self.mode, np.array([self.textual.node]), np.array([node]), np.array([len(textual.wordHist)]),
+                    np.array([textual.lastWord]), np.array([textual.prUnnormalized]))
+                textual.lastWord = int(scores[1][0])
+                textual.prUnnormalized = float(scores[2][0])
+                textual.prTotal = float(scores[3][0])
+            if node != 0:  # word chars lead away from the root
+                textual.wordDev += newChar
             else:
-                beam.textual.wordDev = ''
+                if textual.wordDev != '':
+                    textual.wordHist.append(textual.wordDev)
+                textual.wordDev = ''
 
         # set optical information
         beam.optical.prBlank = prBlank
@@ -107,16 +142,16 @@ class BeamList:
 
     def delete_partial_beams(self, lm):
         """delete beams for which last word is not finished"""
-        for (k, v) in self.beams.items():
-            lastWord = v.textual.wordDev
-            if (lastWord != '') and (not lm.is_word(lastWord)):
+        for (k, v) in list(self.beams.items()):
+            node = v.textual.node
+            if (node != 0) and (not lm.is_word_node(node)):
                 del self.beams[k]
 
     def complete_beams(self, lm):
         """complete beams such that last word is complete word"""
         for (_, v) in self.beams.items():
             lastPrefix = v.textual.wordDev
-            if lastPrefix == '' or lm.is_word(lastPrefix):
+            if v.textual.node == 0 or lm.is_word_node(v.textual.node):
                 continue
 
             # get word candidates for this prefix
@@ -0,0 +1,123 @@
+import numpy as np
+
+
+def expand_beams(lm, nodes):
+    """get (beam index, label, child node) of every extension the language model allows for the given beam nodes"""
+    offsets, labels, children = lm.get_next_arrays()
+    starts = offsets[nodes]
+    counts = offsets[nodes + 1] - starts
+    rows = np.repeat(np.arange(len(nodes)), counts)
+    pos = np.arange(rows.size) - np.repeat(np.cumsum(counts) - counts, counts) + starts[rows]
+    return rows, labels[pos], children[pos]
+
+
+def fast_word_beam_search(mat, beamWidth, lm, mode='Words'):
+    """decode matrix like word_beam_search, but keep beams in arrays and extend all of them in one step,
+    mode is one of the LM scoring modes 'Words', 'NGrams' and 'NGramsForecast'"""
+    chars = lm.get_all_chars()
+    blankIdx = len(chars)  # blank label is supposed to be last label in RNN output
+    maxT, nClasses = mat.shape  # shape of RNN output: TxC
+    mat = mat.astype(np.float64)
+
+    # every text ever seen is stored once as (parent text id, last label), so equal texts share one id
+    textParents = [-1]
+    textLabels = [-1]
+    textKeys = np.empty(0, dtype=np.int64)  # sorted parent * nClasses + label of all texts but the empty one
+    textIds = np.empty(0, dtype=np.int64)
+
+    # beams at time-step before beginning of RNN output, preallocated for the largest possible step
+    capacity = beamWidth * (nClasses + 1)
+    ids = np.zeros(capacity, dtype=np.int64)  # text id
+    prBlank = np.zeros(capacity)  # prob of ending with a blank
+    prNonBlank = np.zeros(capacity)  # prob of ending with a non-blank
+    nodes = np.zeros(capacity, dtype=np.int64)  # prefix tree node of the developing word
+    lastLabels = np.full(capacity, -1, dtype=np.int64)  # last label of text, -1 if empty
+    nWords = np.zeros(capacity, dtype=np.int64)  # number of completed words
+    lastWords = np.full(capacity, -1, dtype=np.int64)  # prefix tree node of last completed word
+    prUnnormalized = np.ones(capacity)  # product of the LM probs of completed words
+    prTextual = np.ones(capacity)  # normalized textual score
+    prBlank[0] = 1.0  # start with genesis beam
+    n = 1
+
+    # go over all time-steps
+    for t in range(maxT):
+        # get best beams
+        if n > beamWidth:
+            scores = (prBlank[:n] + prNonBlank[:n]) * prTextual[:n]
+            best = np.argpartition(-scores, beamWidth - 1)[:beamWidth]
+            best.sort()
+        else:
+            best = np.arange(n)
+        bIds, bBlank, bNonBlank = ids[best], prBlank[best], prNonBlank[best]
+        bNodes, bLast = nodes[best], lastLabels[best]
+        bWords, bLastWords = nWords[best], lastWords[best]
+        bUnnormalized, bTextual = prUnnormalized[best], prTextual[best]
+        bTotal = bBlank + bNonBlank
+        k = len(best)
+
+        # keep text: char at time-step t must also occur at t-1, or beam ends with blank
+        keepNonBlank = np.where(bLast >= 0, bNonBlank * mat[t, bLast], 0.0)
+        keepBlank = bTotal * mat[t, blankIdx]
+
+        # extend texts with characters according to language model, same chars must be separated by blank
+        rows, labels, children = expand_beams(lm, bNodes)
+        extNonBlank = mat[t, labels] * np.where(bLast[rows] == labels, bBlank[rows], bTotal[rows])
+        if mode == 'Words':
+            extWords, extLastWords = bWords[rows], bLastWords[rows]
+            extUnnormalized, extTextual = bUnnormalized[rows], bTextual[rows]
+        else:
+            extWords, extLastWords, extUnnormalized, extTextual = lm.score_extensions(
+                mode, bNodes[rows], children, bWords[rows], bLastWords[rows], bUnnormalized[rows])
+
+        # look up ids of the extended texts, register the ones never seen before
+        extKeys = bIds[rows] * nClasses + labels
+        pos = np.searchsorted(textKeys, extKeys)
+        found = pos < len(textKeys)
+        found[found] = textKeys[pos[found]] == extKeys[found]
+        extIds = np.empty(len(extKeys), dtype=np.int64)
+        extIds[found] = textIds[pos[found]]
+        newIds = np.arange(len(textParents), len(textParents) + np.count_nonzero(~found))
+        extIds[~found] = newIds
+        textParents.extend(bIds[rows[~found]].tolist())
+        textLabels.extend(labels[~found].tolist())
+        textKeys = np.concatenate([textKeys, extKeys[~found]])
+        textIds = np.concatenate([textIds, newIds])
+        order = np.argsort(textKeys, kind='stable')
+        textKeys, textIds = textKeys[order], textIds[order]
+
+        # an extended text can only equal a kept text, merge those into the kept beam
+        order = np.argsort(bIds)
+        pos = np.minimum(np.searchsorted(bIds, extIds, sorter=order), k - 1)
+        merged = bIds[order[pos]] == extIds
+        np.add.at(keepNonBlank, order[pos[merged]], extNonBlank[merged])
+
+        # move current beams to next time-step
+        fresh = ~merged
+        n = k + np.count_nonzero(fresh)
+        ids[:k], ids[k:n] = bIds, extIds[fresh]
+        prBlank[:k], prBlank[k:n] = keepBlank, 0.0
+        prNonBlank[:k], prNonBlank[k:n] = keepNonBlank, extNonBlank[fresh]
+        nodes[:k], nodes[k:n] = bNodes, children[fresh]
+        lastLabels[:k], lastLabels[k:n] = bLast, labels[fresh]
+        nWords[:k], nWords[k:n] = bWords, extWords[fresh]
+        lastWords[:k], lastWords[k:n] = bLastWords, extLastWords[fresh]
+        prUnnormalized[:k], prUnnormalized[k:n] = bUnnormalized, extUnnormalized[fresh]
+        prTextual[:k], prTextual[k:n] = bTextual, extTextual[fresh]
+
+    # most probable beam
+    best = int(np.argmax((prBlank[:n] + prNonBlank[:n]) * prTextual[:n]))
+    labels = []
+    textId = ids[best]
+    while textId > 0:
+        labels.append(textLabels[textId])
+        textId = textParents[textId]
+    text = str().join(chars[c] for c in reversed(labels))
+
+    # complete beam such that last word is complete word, if there is just one candidate
+    node = nodes[best]
+    if node != 0 and not lm.is_word_node(node):
+        lastPrefix = text[len(text.rstrip(lm.get_word_chars())):]
+        words = lm.get_next_words(lastPrefix)
+        if len(words) == 1:
+            text += words[0][len(lastPrefix):]
+    return text
@@ -1,41 +1,154 @@
+import os
 import re
+import json
+import fcntl
+import codecs
+import shutil
+from collections import Counter
 
-from libs.word_beam_search.prefix_tree import PrefixTree
+import numpy as np
+
+from libs.word_beam_search.prefix_tree import PrefixTree, FlatTree
+
+# scoring modes: only constrain text to dictionary words, score completed words with unigrams/bigrams,
+# or also forecast the score of the developing word from all words it may become
+scoringModes = ('Words', 'NGrams', 'NGramsForecast')
+
+
+def check_scoring_mode(mode):
+    """raise ValueError if mode is not one of the scoring modes, decoding would silently treat it like 'NGrams'"""
+    if mode not in scoringModes:
+        raise ValueError('unknown LM scoring mode {!r}, expected one of {}'.format(mode, ', '.join(scoringModes)))
 
 
 class LanguageModel:
     """unigrams/bigrams LM, add-k smoothing"""
 
-    def __init__(self, corpus, chars, wordChars):
-        """read text from filename, specify chars which are contained in dataset, specify chars which form words"""
+    def __init__(self, corpus, chars, wordChars, flatTree=None):
+        """read text from filename, specify chars which are contained in dataset, specify chars which form words,
+        a compiled flatTree is used instead of the corpus if given"""
         self.wordCharPattern = '[' + wordChars + ']'
         self.wordPattern = self.wordCharPattern + '+'
-        words = re.findall(self.wordPattern, corpus)
-        uniqueWords = list(set(words))  # make unique
 
-        # create prefix tree
-        self.tree = PrefixTree()  # create empty tree
-        self.tree.add_words(uniqueWords)  # add all unique words to tree
+        if flatTree is None:
+            words = re.findall(self.wordPattern, corpus)
+            uniqueWords = list(set(words))  # make unique
+
+            # count bigrams of neighbouring words on the same line
+            bigrams = Counter()
+            for line in corpus.splitlines():
+                lineWords = re.findall(self.wordPattern, line)
+                bigrams.update(zip(lineWords, lineWords[1:]))
+
+            # create prefix tree and flatten it into arrays
+            tree = PrefixTree()  # create empty tree
+            tree.add_words(uniqueWords)  # add all unique words to tree
+            flatTree = tree.flatten(chars, Counter(words), bigrams)
+        self.flatTree = flatTree
 
         # list of all chars, word chars and non-word chars
         self.allChars = chars
         self.wordChars = wordChars
         self.nonWordChars = str().join(
             set(chars) - set(re.findall(self.wordCharPattern, chars)))  # else calculate those chars
+        self.charIdx = {c: i for i, c in enumerate(chars)}
+        self.nonWordLabels = np.array(sorted(self.charIdx[c] for c in self.nonWordChars), dtype=np.int64)
+
+        # labels which may follow each prefix tree node and the nodes they lead to, so beams extend in O(1) per label
+        self.nextOffsets, self.nextLabels, self.nextNodes = self.flatTree.get_next_arrays(self.nonWordLabels)
+
+        # cumulative counts in depth-first order, the sum over a subtree is the difference of two entries
+        self.addK = 1.0
+        self.numWords = max(int(self.flatTree.wordCounts.sum()), 1)
+        self.numUniqueWords = max(int(np.count_nonzero(self.flatTree.isWord)), 1)
+        byPreorder = np.argsort(self.flatTree.preorder)
+        self.cumWordCounts = np.concatenate([[0], np.cumsum(self.flatTree.wordCounts[byPreorder], dtype=np.int64)])
+        self.cumIsWord = np.concatenate([[0], np.cumsum(self.flatTree.isWord[byPreorder], dtype=np.int64)])
+        self.cumBigramCounts = np.concatenate([[0], np.cumsum(self.flatTree.bigramCounts, dtype=np.int64)])
+
+    def save(self, path):
+        """save compiled language model to directory path"""
+        self.flatTree.save(path)
+        with open(os.path.join(path, 'meta.json'), 'w', encoding='utf8') as f:
+            json.dump({'chars': self.allChars, 'wordChars': self.wordChars}, f, ensure_ascii=False)
+
+    @staticmethod
+    def load(path, chars, wordChars):
+        """load compiled language model from directory path, its arrays are memory-mapped"""
+        with open(os.path.join(path, 'meta.json'), encoding='utf8') as f:
+            meta = json.load(f)
+        if meta['chars'] != chars or meta['wordChars'] != wordChars:
+            raise ValueError('compiled language model in {} was built for other chars'.format(path))
+        return LanguageModel(None, chars, wordChars, FlatTree.load(path))
+
+    def get_node(self, text):
+        """get prefix tree node of text, -1 if text is no prefix of a word"""
+        return self.flatTree.get_node(self.charIdx.get(c, -1) for c in text)
 
     def get_next_words(self, text):
         """text must be prefix of a word"""
-        return self.tree.get_next_words(text)
+        node = self.get_node(text)
+        if node < 0:
+            return []
+        return [text + str().join(self.allChars[c] for c in suffix) for suffix in self.flatTree.get_next_words(node)]
 
     def get_next_chars(self, text):
         """text must be prefix of a word"""
-        nextChars = str().join(self.tree.get_next_chars(text))
+        node = self.get_node(text)
+        if node < 0:
+            return ''
+        return str().join(self.allChars[c] for c in self.get_next(node)[0])
+
+    def get_next(self, node):
+        """get labels which may follow node and the nodes they lead to,
+        non-word labels are included if node is the root (in between two words) or a word"""
+        start, end = self.nextOffsets[node], self.nextOffsets[node + 1]
+        return self.nextLabels[start:end], self.nextNodes[start:end]
+
+    def get_next_arrays(self):
+        return self.nextOffsets, self.nextLabels, self.nextNodes
 
-        # if in between two words or if word ends, add non-word chars
-        if (text == '') or (self.is_word(text)):
-            nextChars += self.get_non_word_chars()
+    def get_bigram_counts(self, prevWords, lo, hi):
+        """sum counts of bigrams (prevWords, w) with preorder[w] in [lo, hi)"""
+        keys = self.flatTree.bigramKeys
+        base = self.flatTree.preorder[prevWords].astype(np.int64) * self.flatTree.get_n_nodes()
+        cum = self.cumBigramCounts
+        return cum[np.searchsorted(keys, base + hi)] - cum[np.searchsorted(keys, base + lo)]
 
-        return nextChars
+    def get_unigram_probs(self, words):
+        return self.flatTree.wordCounts[words] / self.numWords
+
+    def get_bigram_probs(self, prevWords, words):
+        """prob of words following prevWords, add-k smoothing"""
+        lo = self.flatTree.preorder[words]
+        counts = self.get_bigram_counts(prevWords, lo, lo + 1)
+        totals = self.get_bigram_counts(prevWords, 0, self.flatTree.get_n_nodes())
+        return (counts + self.addK) / (totals + self.addK * self.numUniqueWords)
+
+    def get_forecast_probs(self, prevWords, nodes):
+        """prob of the next word being any word which nodes are prefixes of, unigrams where prevWords is -1"""
+        lo = self.flatTree.preorder[nodes]
+        hi = lo + self.flatTree.subtreeSizes[nodes]
+        unigrams = (self.cumWordCounts[hi] - self.cumWordCounts[lo]) / self.numWords
+        counts = self.get_bigram_counts(prevWords, lo, hi) + self.addK * (self.cumIsWord[hi] - self.cumIsWord[lo])
+        totals = self.get_bigram_counts(prevWords, 0, self.flatTree.get_n_nodes())
+        return np.where(prevWords < 0, unigrams, counts / (totals + self.addK * self.numUniqueWords))
+
+    def score_extensions(self, mode, nodes, children, nWords, lastWords, prUnnormalized):
+        """textual scores of beams at prefix tree nodes extended to children, a non-word char (child 0) completes
+        the developing word. Scores are normalized per word, returns (nWords, lastWords, prUnnormalized, prTotal)"""
+        complete = (children == 0) & (nodes != 0)
+        prWord = np.where(nWords == 0, self.get_unigram_probs(nodes), self.get_bigram_probs(lastWords, nodes))
+        prUnnormalized = np.where(complete, prUnnormalized * prWord, prUnnormalized)
+        lastWords = np.where(complete, nodes, lastWords)
+        nWords = nWords + complete
+        prTotal = np.where(nWords > 0, prUnnormalized ** (1 / np.maximum(nWords, 1)), 1.0)
+
+        if mode == 'NGramsForecast':
+            developing = children != 0
+            prNext = self.get_forecast_probs(lastWords, children)
+            prTotal = np.where(developing, (prUnnormalized * prNext) ** (1 / (nWords + 1)), prTotal)
+        return nWords, lastWords, prUnnormalized, prTotal
 
     def get_word_chars(self):
         return self.wordChars
@@ -46,5 +159,50 @@ class LanguageModel:
     def get_all_chars(self):
         return self.allChars
 
+    def get_flat_tree(self):
+        return self.flatTree
+
+    def get_non_word_labels(self):
+        return self.nonWordLabels
+
     def is_word(self, text):
-        return self.tree.is_word(text)
+        node = self.get_node(text)
+        return node >= 0 and self.is_word_node(node)
+
+    def is_word_node(self, node):
+        return bool(self.flatTree.isWord[node])
+
+
+def load_compiled_language_model(corpusPath, path, chars, wordChars):
+    """load compiled language model from directory path if it is newer than the corpus and built for chars,
+    None otherwise"""
+    try:
+        if os.path.getmtime(os.path.join(path, 'meta.json')) >= os.path.getmtime(corpusPath):
+            return LanguageModel.load(path, chars, wordChars)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def compile_language_model(corpusPath, path, chars, wordChars):
+    """build language model from corpus, save it to directory path and return it loaded from there.
+    Processes compiling at once take turns under a file lock, the later ones load the model the first one saved"""
+    with open(path + '.lock', 'a') as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        lm = load_compiled_language_model(corpusPath, path, chars, wordChars)
+        if lm is not None:
+            return lm
+
+        corpus = codecs.open(corpusPath, 'r', 'utf8').read()
+        lm = LanguageModel(corpus, chars, wordChars)
+
+        # write to a temporary directory first, so other processes never see a half written model. Only a stale
+        # model is replaced, processes which loaded it keep their memory-mapped arrays
+        tmpPath = '{}.tmp{}'.format(path, os.getpid())
+        lm.save(tmpPath)
+        stalePath = '{}.stale{}'.format(path, os.getpid())
+        if os.path.exists(path):
+            os.rename(path, stalePath)
+        os.rename(tmpPath, path)
+        shutil.rmtree(stalePath, ignore_errors=True)
+        return LanguageModel.load(path, chars, wordChars)
@@ -1,3 +1,8 @@
+import os
+
+import numpy as np
+
+
 class Node:
     """class representing nodes in a prefix tree"""
 
@@ -6,6 +11,101 @@ class Node:
         self.isWord = False  # does this prefix represent a word
 
 
+class FlatTree:
+    """prefix tree flattened into arrays indexed by node id, root is node 0, nodes are numbered breadth-first"""
+
+    fileNames = ('offsets', 'labels', 'isWord', 'wordCounts', 'preorder', 'subtreeSizes', 'bigramKeys', 'bigramCounts')
+
+    def __init__(self, offsets, labels, isWord, wordCounts, preorder, subtreeSizes, bigramKeys, bigramCounts):
+        self.offsets = offsets  # children of node i are stored at [offsets[i], offsets[i + 1]), child at j is node j + 1
+        self.labels = labels  # label index of the char leading to each child, sorted per node
+        self.isWord = isWord  # does node i represent a word
+        self.wordCounts = wordCounts  # how often the word of node i occurs in the corpus
+        self.preorder = preorder  # depth-first index of node i, the subtree of i is [preorder[i], preorder[i] + size)
+        self.subtreeSizes = subtreeSizes  # number of nodes in the subtree of node i, including i
+        self.bigramKeys = bigramKeys  # sorted preorder[w1] * nNodes + preorder[w2] of word pairs seen in the corpus
+        self.bigramCounts = bigramCounts  # how often each word pair occurs
+
+    def get_n_nodes(self):
+        return len(self.isWord)
+
+    def get_child(self, node, label):
+        """get child of node reached by label, -1 if there is none"""
+        start, end = self.offsets[node], self.offsets[node + 1]
+        pos = start + np.searchsorted(self.labels[start:end], label)
+        if pos < end and self.labels[pos] == label:
+            return int(pos) + 1
+        return -1
+
+    def get_node(self, labels):
+        """get node representing given label sequence, -1 if it is not in the tree"""
+        node = 0
+        for label in labels:
+            node = self.get_child(node, label)
+            if node < 0:
+                break
+        return node
+
+    def get_next_labels(self, node):
+        """get all labels which may directly follow node"""
+        return self.labels[self.offsets[node]:self.offsets[node + 1]]
+
+    def get_next_words(self, node):
+        """get label sequences which extend node to a word (the empty one, if node is a word itself)"""
+        words = []
+        nodes = [node]
+        suffixes = [()]
+        while len(nodes) > 0:
+            node, suffix = nodes.pop(), suffixes.pop()
+            if self.isWord[node]:
+                words.append(suffix)
+            for pos in range(self.offsets[node], self.offsets[node + 1]):
+                nodes.append(pos + 1)
+                suffixes.append(suffix + (int(self.labels[pos]),))
+        return words
+
+    def get_next_arrays(self, nonWordLabels):
+        """for every node, precompute the labels which may follow it and the nodes they lead to,
+        non-word labels (leading back to the root) are merged in for the root and all word nodes.
+        Returns (offsets, labels, nodes), entries of node i are stored at [offsets[i], offsets[i + 1])"""
+        nNodes = self.get_n_nodes()
+        nNonWord = len(nonWordLabels)
+        childCounts = np.diff(self.offsets).astype(np.int64)
+        isOpen = np.array(self.isWord, dtype=bool)
+        isOpen[0] = True
+        counts = childCounts + isOpen * nNonWord
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int32)
+        labels = np.empty(offsets[-1], dtype=np.int16)
+        nodes = np.empty(offsets[-1], dtype=np.int32)
+
+        # children in the prefix tree come first
+        owners = np.repeat(np.arange(nNodes), childCounts)
+        childPos = np.arange(len(self.labels))
+        dest = offsets[owners] + childPos - self.offsets[owners]
+        labels[dest] = self.labels
+        nodes[dest] = childPos + 1
+
+        # then non-word labels
+        openNodes = np.flatnonzero(isOpen)
+        dest = np.repeat(offsets[openNodes] + childCounts[openNodes], nNonWord)
+        dest += np.tile(np.arange(nNonWord), len(openNodes))
+        labels[dest] = np.tile(nonWordLabels, len(openNodes))
+        nodes[dest] = 0
+        return offsets, labels, nodes
+
+    def save(self, path):
+        """save arrays as .npy files in directory path"""
+        os.makedirs(path, exist_ok=True)
+        for name in self.fileNames:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    @staticmethod
+    def load(path, mmapMode='r'):
+        """load arrays saved in directory path, memory-mapped so processes on one host share one physical copy"""
+        arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode=mmapMode) for name in FlatTree.fileNames]
+        return FlatTree(*arrays)
+
+
 class PrefixTree:
     """prefix tree"""
 
@@ -22,7 +122,7 @@ class PrefixTree:
             node = node.children[c]
             isLast = (i + 1 == len(text))
             if isLast:
-                node.is_word = True
+                node.isWord = True
 
     def add_words(self, words):
         for w in words:
@@ -75,3 +175,57 @@ class PrefixTree:
                 del prefixes[0]
 
         return words
+
+    def flatten(self, chars, wordCounts=None, bigramCounts=None):
+        """number nodes in breadth-first order and store them in a FlatTree, chars maps chars to label indices,
+        wordCounts maps words and bigramCounts (word, word) pairs to their counts"""
+        charIdx = {c: i for i, c in enumerate(chars)}
+        wordCounts = wordCounts or {}
+        bigramCounts = bigramCounts or {}
+        nodes = [(self.root, '')]
+        offsets = [0]
+        labels = []
+        isWord = []
+        counts = []
+        wordNodes = {}
+        i = 0
+        while i < len(nodes):
+            node, text = nodes[i]
+            for label, c in sorted((charIdx[c], c) for c in node.children):
+                labels.append(label)
+                nodes.append((node.children[c], text + c))
+            offsets.append(len(labels))
+            isWord.append(node.isWord)
+            counts.append(wordCounts.get(text, 0) if node.isWord else 0)
+            if node.isWord:
+                wordNodes[text] = i
+            i += 1
+
+        # depth-first numbering, so every subtree is a contiguous range
+        nNodes = len(nodes)
+        preorder = np.zeros(nNodes, dtype=np.int32)
+        stack = [0]
+        cnt = 0
+        while len(stack) > 0:
+            node = stack.pop()
+            preorder[node] = cnt
+            cnt += 1
+            stack.extend(range(offsets[node + 1], offsets[node], -1))  # children in label order
+
+        # children have larger ids than their parents, so subtree sizes can be summed up backwards
+        parents = np.repeat(np.arange(nNodes), np.diff(offsets)).tolist()  # parent of node j is parents[j - 1]
+        sizes = [1] * nNodes
+        for node in range(nNodes - 1, 0, -1):
+            sizes[parents[node - 1]] += sizes[node]
+        subtreeSizes = np.array(sizes, dtype=np.int32)
+
+        # bigrams keyed by the depth-first indices of both words
+        bigrams = {}
+        for (w1, w2), count in bigramCounts.items():
+            if w1 in wordNodes and w2 in wordNodes:
+                bigrams[int(preorder[wordNodes[w1]]) * nNodes + int(preorder[wordNodes[w2]])] = count
+        bigramKeys = np.array(sorted(bigrams), dtype=np.int64)
+
+        return FlatTree(np.array(offsets, dtype=np.int32), np.array(labels, dtype=np.int16),
+                        np.array(isWord, dtype=bool), np.array(counts, dtype=np.int32), preorder, subtreeSizes,
+                        bigramKeys, np.array([bigrams[k] for k in bigramKeys], dtype=np.int32))
@@ -1,9 +1,14 @@
 import logging
 import sys
+import time
+import signal
 import asyncio
+import argparse
+import multiprocessing
 from aiohttp import web
 from zmq.asyncio import ZMQEventLoop
-from router_handler import RouterHandler
+
+from config import max_image_size, worker_startup_grace
 
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s: %(message)s')
 
@@ -11,36 +16,119 @@ LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.INFO)
 
 
-def start_server(host, port):
+def start_server(host, port, reuse_port=False, worker=None):
+    # Imported here so the supervisor process of a multi-worker server does not load Keras
+    from router_handler import RouterHandler
+
     _loop = asyncio.get_event_loop()
-    app = web.Application(loop=_loop, client_max_size=20*1024**2)
+    handler = RouterHandler(_loop, worker)
 
-    handler = RouterHandler(_loop)
+    # Room for one base64 encoded image, each image is checked against max_image_size itself
+    app = web.Application(loop=_loop, client_max_size=2*max_image_size, middlewares=[handler.monitor.middleware])
+    app.on_shutdown.append(handler.close)
 
     app.router.add_get('/train', handler.train)
     app.router.add_post('/evaluate', handler.evaluation)
     app.router.add_post('/predict', handler.prediction)
+    app.router.add_post('/predict_batch', handler.batch_prediction)
+    app.router.add_post('/predict_line', handler.line_prediction)
+    app.router.add_get('/jobs', handler.list_jobs)
+    app.router.add_get('/jobs/{job_id}', handler.job_status)
+    app.router.add_delete('/jobs/{job_id}', handler.cancel_job)
+    app.router.add_get('/metrics', handler.metrics)
 
     LOGGER.info('Starting Server on %s:%s', host, port)
     web.run_app(
         app,
         host=host,
         port=port,
+        reuse_port=reuse_port or None,
         access_log=LOGGER,
         access_log_format='%r: %s status, %b size, in %Tf s'
     )
 
 
-def main():
+def run_worker(host, port, reuse_port=False, worker=None):
     loop = ZMQEventLoop()
     asyncio.set_event_loop(loop=loop)
 
     try:
-        start_server('localhost', 8096)
+        start_server(host, port, reuse_port, worker)
     except Exception as err:
         LOGGER.exception(err)
         sys.exit(1)
 
 
+def start_workers(host, port, n_workers, shutdown_timeout=30, startup_grace=worker_startup_grace):
+    """
+    Run n_workers server processes, each with its own model, which share host:port through SO_REUSEPORT.
+    A worker failing within startup_grace seconds of its start, e.g. on a missing model, stops the server.
+    Workers crashing later are restarted, SIGINT or SIGTERM stops all of them gracefully
+    """
+    # Spawn instead of fork, so workers never inherit TensorFlow state
+    mp_context = multiprocessing.get_context('spawn')
+    workers = {}
+    started = {}  # Monotonic start time of each worker
+    stopping = []
+
+    def spawn(idx):
+        worker = mp_context.Process(target=run_worker, args=(host, port, True, idx), name='worker-{}'.format(idx))
+        worker.start()
+        workers[idx] = worker
+        started[idx] = time.monotonic()
+        LOGGER.info('Started worker %s with pid %s', idx, worker.pid)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for idx in range(n_workers):
+        spawn(idx)
+
+    while not stopping:
+        time.sleep(1)
+        for idx, worker in list(workers.items()):
+            if stopping or worker.is_alive():
+                continue
+            uptime = time.monotonic() - started[idx]
+            if worker.exitcode == 1 and uptime < startup_grace:
+                LOGGER.error('Worker %s failed to start, stopping server', idx)
+                stopping.append(None)
+                break
+            LOGGER.warning('Worker %s exited with code %s after %.0f s, restarting', idx, worker.exitcode, uptime)
+            spawn(idx)
+
+    LOGGER.info('Stopping %s workers', len(workers))
+    for worker in workers.values():
+        if worker.is_alive():
+            worker.terminate()  # SIGTERM, aiohttp finishes running requests before exiting
+    deadline = time.monotonic() + shutdown_timeout
+    for worker in workers.values():
+        worker.join(max(deadline - time.monotonic(), 0))
+        if worker.is_alive():
+            LOGGER.warning('Worker %s did not stop in time, killing it', worker.name)
+            worker.kill()
+            worker.join()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Vietnamese OCR server')
+    parser.add_argument('--host', default='localhost', help='Host to listen on')
+    parser.add_argument('--port', type=int, default=8096, help='Port to listen on')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of server processes, each loads its own model and shares the port')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.workers > 1:
+        start_workers(args.host, args.port, args.workers)
+    else:
+        run_worker(args.host, args.port)
+
+
 if __name__ == '__main__':
     main()
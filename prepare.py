@@ -1,6 +1,15 @@
+import os
+
 from libs.prepare.prepare import download_data, split_dataset
+from libs.prepare.dataset import compile_dataset
+from libs.word_beam_search.language_model import compile_language_model
+from config import data_path, csv_path, lm_path, letters, word_chars
 
 
 if __name__ == '__main__':
     download_data()
     split_dataset()
+    compile_language_model(os.path.join(data_path, 'corpus.txt'), lm_path, letters, word_chars)
+    for split in ['train_final.csv', 'val_final.csv']:
+        compile_dataset(os.path.join(csv_path, split), train=True)
+    compile_dataset(os.path.join(csv_path, 'test.csv'))
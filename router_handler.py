@@ -1,22 +1,58 @@
-from aiohttp.web import json_response
+from aiohttp.web import json_response, Response, StreamResponse
 from json.decoder import JSONDecodeError
-import pandas as pd
 
+import io
 import os
+import json
+import itertools
+import time
 import logging
 from datetime import datetime
 
-from libs.utils.errors import ApiBadRequest
+from libs.utils.errors import ApiBadRequest, ApiInternalError, ApiNotFound
 from libs.models.CRNNModel import CRNNModel
-from config import pretrained_model, n_epochs, csv_path
+from libs.serving.batcher import MicroBatcher
+from libs.serving.monitoring import RequestMonitor, add_server_timing, render_metrics
+from libs.serving.jobs import JobManager, train_job, evaluate_job
+from libs.serving.upload import is_binary, read_body, read_multipart, get_json_images, iter_csv
+from libs.utils.latency import collect_timings, stage_latency
+from libs.utils.segmentation import parse_separators
+from config import pretrained_model, n_epochs, csv_path, predict_batch_size, predict_batch_max_images, \
+    best_path_queue_depth
+
+decoders = ('beam_search', 'best_path')
 
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s: %(message)s')
 
 
 class RouterHandler(object):
-    def __init__(self, loop):
+    def __init__(self, loop, worker=None):
         self._loop = loop
+        self.worker = worker  # Index of this process in a multi-worker server
         self.model = CRNNModel(model_path=pretrained_model, initial_state=False)
+        self.batcher = MicroBatcher(loop, self.predict_timed)
+        self.jobs = JobManager(loop)
+        self.monitor = RequestMonitor()
+
+    async def close(self, app):
+        await self.batcher.stop()
+        self.jobs.shutdown()
+        self.model.cache.save()
+
+    def predict_timed(self, items):
+        """
+        Predict a batch of (image, greedy) items, each with the time spent in every stage by its batch.
+        Greedy images are decoded by best path
+        """
+        images = [image for image, _ in items]
+        greedy = [is_greedy for _, is_greedy in items]
+        with collect_timings() as timings:
+            predicteds = self.model.predict_batch(images, batch_size=len(images), greedy=greedy)
+        return [(predicted, timings) for predicted in predicteds]
+
+    async def metrics(self, request):
+        return Response(text=render_metrics(self.monitor, self.batcher, self.model.cache, self.jobs, self.worker),
+                        content_type='text/plain; version=0.0.4')
 
     async def train(self, request):
         try:
@@ -25,75 +61,274 @@ class RouterHandler(object):
             print(err)
             epochs = n_epochs
 
-        start = datetime.now()
-        self.model.build_model('train')
-        self.model.fit(epochs=epochs)
-        end = datetime.now()
+        job = self.jobs.submit('train', train_job, epochs)
         return json_response({
-            "status": "Success",
-            "time": str(end - start)
-        })
+            "status": "Accepted",
+            "job": job.to_dict()
+        }, status=202)
 
     async def evaluation(self, request):
-        start = datetime.now()
-        body = await decode_request(request)
-        able_fields = ['filename']
-        body = filter_fields(able_fields, body)
+        raw_body = await decode_request(request)
+        able_fields = ['filename', 'batch_size']
+        body = filter_fields(able_fields, raw_body)
+        options = get_evaluation_options(raw_body)
+
+        try:
+            batch_size = int(body.get('batch_size', predict_batch_size))
+        except (TypeError, ValueError):
+            batch_size = 0
+        if batch_size < 1:
+            raise ApiBadRequest("'batch_size' must be a positive integer")
 
         file = os.path.join(csv_path, 'test.csv')
         if body.get('filename') is not None:
             file = body.get('filename')
 
-        try:
-            data = pd.read_csv(file, sep=';')
-        except FileNotFoundError as err:
-            logging.exception(err)
+        paths = body.get('paths')
+        labels = body.get('labels')
+
+        if (paths is None or labels is None) and not os.path.isfile(file):
+            logging.warning('File not found: %s', file)
             return json_response({
                 "status": "Fail",
                 "detail": "File not found"
             })
 
-        paths = body.get('paths')
-        labels = body.get('labels')
-
-        if paths is None or labels is None:
-            paths = data['Image'].values.tolist()
-            labels = data['Label'].values.tolist()
+        # Images of the file are decoded once into a compiled dataset, which later evaluations reuse.
+        # Thread workers share the served model, process workers load their own
+        if self.jobs.is_process_pool():
+            job = self.jobs.submit('evaluate', evaluate_job, file, paths, labels, batch_size, None, options)
+        else:
+            job = self.jobs.submit('evaluate', evaluate_job, file, paths, labels, batch_size, self.model, options)
+        return json_response({
+            "status": "Accepted",
+            "job": job.to_dict()
+        }, status=202)
 
-        accuracy, letter_accuracy = self.model.evaluate(paths, labels)
-        end = datetime.now()
-        time = end - start
+    async def list_jobs(self, request):
+        return json_response({
+            "status": "Success",
+            "jobs": self.jobs.list()
+        })
 
+    async def job_status(self, request):
+        job = self.jobs.get(request.match_info['job_id'])
+        if job is None:
+            raise ApiNotFound('No job with this id')
         return json_response({
             "status": "Success",
-            "accuracy": accuracy,
-            "letter_accuracy": letter_accuracy,
-            "time": time.total_seconds()
+            "job": job
+        })
+
+    async def cancel_job(self, request):
+        job_id = request.match_info['job_id']
+        if self.jobs.get(job_id) is None:
+            raise ApiNotFound('No job with this id')
+        cancelled = self.jobs.cancel(job_id)
+        return json_response({
+            "status": "Success" if cancelled else "Fail",
+            "job": self.jobs.get(job_id)
         })
 
     async def prediction(self, request):
         start = datetime.now()
-        body = await decode_request(request)
-        required_fields = ['image']
-        validate_fields(required_fields, body)
+        # Timed by hand, timings collected per thread do not survive awaits of the event loop
+        upload_start = time.perf_counter()
+        images = await read_images(request, max_images=1)
+        timings = {'upload': time.perf_counter() - upload_start}
+        stage_latency.observe('upload', timings['upload'])
+        if not images:
+            raise ApiBadRequest("'image' parameter is required")
+
+        decoder = await read_option(request, 'decoder')
+        if decoder is not None and decoder not in decoders:
+            raise ApiBadRequest("'decoder' must be one of " + ', '.join(decoders))
 
-        img = body.get('image')
-        predicted = self.model.predict(img)
+        img = images[0]
+        queue_depth = self.batcher.queue_depth()
+        if decoder is None:
+            # Under load, best path decoding keeps the latency low at the cost of the dictionary
+            overloaded = best_path_queue_depth is not None and queue_depth >= best_path_queue_depth
+            decoder = 'best_path' if overloaded else 'beam_search'
+        submitted = time.perf_counter()
+        try:
+            (predicted, batch_timings), batch_size = await self.batcher.submit((img, decoder == 'best_path'))
+        except Exception:
+            raise ApiInternalError('Prediction failed')
+        # Waiting for the batch to start, the batcher records it per image in the queue stage
+        timings['queue'] = max(time.perf_counter() - submitted - sum(batch_timings.values()), 0.0)
+        timings.update(batch_timings)
         end = datetime.now()
-        time = end - start
 
         if predicted is None:
+            body = {
+                "status": "Fail",
+                "detail": "Image not found" if isinstance(img, str) else "Image can not be decoded"
+            }
+        else:
+            body = {
+                "status": "Success",
+                "predicted": predicted,
+                "time": (end - start).total_seconds(),
+                "batch_size": batch_size,
+                "queue_depth": queue_depth,
+                "decoder": decoder
+            }
+        json_start = time.perf_counter()
+        text = json.dumps(body)
+        timings['json'] = time.perf_counter() - json_start
+        stage_latency.observe('json', timings['json'])
+
+        response = json_response(text=text)
+        add_server_timing(response, timings)
+        return response
+
+    async def line_prediction(self, request):
+        """
+        Predict every word of a line image in one batch, at the given word separators or at the ones found
+        from the projection profile of the image
+        """
+        start = datetime.now()
+        images = await read_images(request, max_images=1)
+        if not images:
+            raise ApiBadRequest("'image' parameter is required")
+        separators = await read_option(request, 'separators')
+        if separators is not None:
+            try:
+                separators = parse_separators(separators)
+            except ValueError as err:
+                raise ApiBadRequest(str(err))
+
+        img = images[0]
+        try:
+            words = await self._loop.run_in_executor(None, self.model.predict_line, img, separators)
+        except Exception as err:
+            logging.exception(err)
+            raise ApiInternalError('Prediction failed')
+
+        if words is None:
             return json_response({
                 "status": "Fail",
-                "detail": "Image not found"
+                "detail": "Image not found" if isinstance(img, str) else "Image can not be decoded"
             })
 
         return json_response({
             "status": "Success",
-            "predicted": predicted,
-            "time": time.total_seconds()
+            "predicted": ' '.join(text for _, _, text in words if text),
+            "words": [{"x": x, "width": width, "predicted": text} for x, width, text in words],
+            "separators": [x for x, _, _ in words],
+            "time": (datetime.now() - start).total_seconds()
         })
 
+    async def batch_prediction(self, request):
+        """
+        Predict a list of images or the images of an Image;Label csv, streaming one NDJSON line per image
+        as soon as its chunk is predicted. The next chunk is predicted while the current one is sent
+        """
+        start = datetime.now()
+        chunks = await read_batch(request)
+
+        response = StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+
+        def predict_chunk():
+            chunk = next(chunks, None)
+            if chunk is None:
+                return None
+            return chunk, self.model.predict_batch([image for image, _, _ in chunk], batch_size=predict_batch_size)
+
+        n = 0
+        n_labeled = 0
+        n_correct = 0
+        status = "Success"
+        detail = None
+        try:
+            pending = self._loop.run_in_executor(None, predict_chunk)
+            while True:
+                result = await pending
+                if result is None:
+                    break
+                pending = self._loop.run_in_executor(None, predict_chunk)
+                lines = []
+                for (image, name, label), predicted in zip(*result):
+                    line = {"index": n, "image": name, "predicted": predicted}
+                    if predicted is None:
+                        line["detail"] = "Image not found" if isinstance(image, str) else "Image can not be decoded"
+                    if label is not None:
+                        line["label"] = label
+                        line["correct"] = predicted == label
+                        n_labeled += 1
+                        n_correct += predicted == label
+                    lines.append(json.dumps(line, ensure_ascii=False))
+                    n += 1
+                await response.write(('\n'.join(lines) + '\n').encode('utf8'))
+        except ConnectionResetError:
+            raise
+        except Exception as err:
+            # Headers are sent already, the error is reported in the last line
+            logging.exception(err)
+            status = "Fail"
+            detail = err.message if isinstance(err, ApiBadRequest) else 'Prediction failed'
+        summary = {"status": status, "count": n, "time": (datetime.now() - start).total_seconds()}
+        if detail is not None:
+            summary["detail"] = detail
+        if n_labeled:
+            summary["accuracy"] = round(n_correct / n_labeled * 100, 2)
+        await response.write((json.dumps(summary) + '\n').encode('utf8'))
+        await response.write_eof()
+        return response
+
+
+async def read_batch(request, chunk_size=predict_batch_size):
+    """
+    Chunks of (image, name, label) of a /predict_batch request: a csv body, a JSON body naming a csv file
+    on the server in 'filename', or images as accepted by read_images. The first chunk of a csv is read here,
+    so an improper csv is rejected before the response starts
+    """
+    if request.content_type == 'text/csv':
+        return read_first_chunk(iter_csv(io.StringIO(await request.text()), chunk_size))
+    if request.content_type.startswith('multipart/') or is_binary(request.content_type):
+        images = await read_images(request, predict_batch_max_images)
+    else:
+        body = await decode_request(request)
+        if body.get('filename') is not None:
+            if not os.path.isfile(body['filename']):
+                raise ApiNotFound('File not found')
+            return read_first_chunk(iter_csv(body['filename'], chunk_size))
+        images = get_json_images(body, predict_batch_max_images)
+    if not images:
+        raise ApiBadRequest("'images' parameter is required")
+    items = [(image, image if isinstance(image, str) else None, None) for image in images]
+    return iter(items[i:i + chunk_size] for i in range(0, len(items), chunk_size))
+
+
+def read_first_chunk(chunks):
+    first = next(chunks, None)
+    return iter([]) if first is None else itertools.chain([first], chunks)
+
+
+async def read_option(request, name):
+    """
+    Option of a prediction request from its query parameter or, for JSON requests, its JSON field, None if not given
+    """
+    value = request.rel_url.query.get(name)
+    if value is None and not request.content_type.startswith('multipart/') and not is_binary(request.content_type):
+        value = (await decode_request(request)).get(name)
+    return value
+
+
+async def read_images(request, max_images):
+    """
+    Images of a request, server paths or encoded images sent as multipart parts, a binary body or base64 JSON.
+    Encoded images are memoryviews of the request buffer, they are decoded where they are predicted
+    """
+    if request.content_type.startswith('multipart/'):
+        return await read_multipart(request, max_images)
+    if is_binary(request.content_type):
+        return [await read_body(request)]
+    return get_json_images(await decode_request(request), max_images)
+
 
 async def decode_request(request):
     try:
@@ -102,6 +337,30 @@ async def decode_request(request):
         raise ApiBadRequest('Improper JSON format')
 
 
+def get_evaluation_options(body):
+    """
+    Options of a streaming evaluation: subsample size, its seed, target confidence interval in % for stopping
+    early, min images before stopping, whether to resume from a checkpoint and to dump wrong predictions
+    """
+    options = {}
+    for field, option, cast, minimum in (('sample', 'sample', int, 1), ('seed', 'seed', int, 0),
+                                         ('ci', 'ci_target', float, 0), ('min_samples', 'min_samples', int, 1)):
+        if body.get(field) is None:
+            continue
+        try:
+            options[option] = cast(body[field])
+        except (TypeError, ValueError):
+            options[option] = None
+        if options[option] is None or options[option] < minimum:
+            raise ApiBadRequest("'{}' must be a number of at least {}".format(field, minimum))
+    for field in ('resume', 'errors'):
+        if body.get(field) is not None:
+            if not isinstance(body[field], bool):
+                raise ApiBadRequest("'{}' must be true or false".format(field))
+            options[field] = body[field]
+    return options
+
+
 def validate_fields(required_fields, body):
     for field in required_fields:
         if body.get(field) is None:
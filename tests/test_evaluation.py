@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from libs.utils.evaluation import RunningMetrics, run_evaluation
+
+LABELS = ['word{}'.format(k) for k in range(23)]
+
+
+def fake_predict_indexes(model, images, lm, indexes, batch_size=None, widths=None):
+    """
+    Every third image is read wrong, every seventh can not be read
+    """
+    return [None if k % 7 == 6 else images[k] + 'x' if k % 3 == 0 else images[k] for k in indexes]
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt_after(n_chunks):
+    calls = []
+
+    def predict_indexes(*args, **kwargs):
+        if len(calls) == n_chunks:
+            raise Interrupted()
+        calls.append(None)
+        return fake_predict_indexes(*args, **kwargs)
+    return predict_indexes
+
+
+class WilsonIntervalTest(unittest.TestCase):
+    def test_no_samples(self):
+        self.assertEqual(RunningMetrics().confidence_interval(), 100.0)
+
+    def test_known_values(self):
+        self.assertAlmostEqual(RunningMetrics(n=100, matches=50).confidence_interval(), 9.617, places=3)
+        # Unlike the normal approximation, the interval is not empty when every image matches
+        self.assertAlmostEqual(RunningMetrics(n=10, matches=10).confidence_interval(), 13.877, places=3)
+
+    def test_shrinks_with_samples(self):
+        widths = [RunningMetrics(n=n, matches=n * 9 // 10).confidence_interval() for n in (10, 100, 1000)]
+        self.assertEqual(widths, sorted(widths, reverse=True))
+
+
+class RunEvaluationTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.checkpoint_path = os.path.join(self.tmp_dir, 'evaluation.json')
+        self.errors_path = os.path.join(self.tmp_dir, 'evaluation.errors.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def evaluate(self, predict_indexes=fake_predict_indexes, errors=True, **options):
+        with mock.patch('libs.utils.evaluation.predict_indexes', predict_indexes):
+            result = run_evaluation(None, LABELS, LABELS, None, batch_size=4, checkpoint_path=self.checkpoint_path,
+                                    errors_path=self.errors_path if errors else None, **options)
+        result.pop('time')
+        return result
+
+    def read_errors(self):
+        with open(self.errors_path, encoding='utf8') as f:
+            return f.read()
+
+    def test_metrics(self):
+        result = self.evaluate()
+        self.assertEqual(result['evaluated'], 20)
+        self.assertEqual(result['failed'], 3)
+        self.assertEqual(result['accuracy'], 65.0)
+        self.assertEqual(self.read_errors().count('\n'), 1 + 7 + 3)
+        self.assertFalse(os.path.isfile(self.checkpoint_path))
+
+    def test_resumed_run_equals_uninterrupted_run(self):
+        expected = self.evaluate()
+        expected_errors = self.read_errors()
+        with self.assertRaises(Interrupted):
+            self.evaluate(interrupt_after(3))
+        self.assertTrue(os.path.isfile(self.checkpoint_path))
+        predict_indexes = mock.Mock(side_effect=fake_predict_indexes)
+        self.assertEqual(self.evaluate(predict_indexes), expected)
+        self.assertEqual(predict_indexes.call_count, 6 - 3)  # Only the chunks after the checkpoint
+        self.assertEqual(self.read_errors(), expected_errors)
+
+    def test_resume_truncates_errors_after_checkpoint(self):
+        expected = self.evaluate()
+        expected_errors = self.read_errors()
+        with self.assertRaises(Interrupted):
+            self.evaluate(interrupt_after(2))
+        # Errors of a chunk written after its checkpoint
+        with open(self.errors_path, 'a', encoding='utf8') as f:
+            f.write('8;word8;word8;word8x;1\n')
+        self.assertEqual(self.evaluate(), expected)
+        self.assertEqual(self.read_errors(), expected_errors)
+
+    def test_resume_without_error_file_starts_over(self):
+        expected = self.evaluate()
+        expected_errors = self.read_errors()
+        with self.assertRaises(Interrupted):
+            self.evaluate(interrupt_after(2), errors=False)
+        self.assertEqual(self.evaluate(), expected)
+        self.assertEqual(self.read_errors(), expected_errors)
+
+        with self.assertRaises(Interrupted):
+            self.evaluate(interrupt_after(2))
+        os.remove(self.errors_path)
+        self.assertEqual(self.evaluate(), expected)
+        self.assertEqual(self.read_errors(), expected_errors)
+
+    def test_checkpoint_of_other_options_is_ignored(self):
+        expected = self.evaluate(sample=10, seed=2)
+        with self.assertRaises(Interrupted):
+            self.evaluate(interrupt_after(2), sample=10, seed=1)
+        self.assertEqual(self.evaluate(sample=10, seed=2), expected)
+        self.assertEqual(expected['evaluated'] + expected['failed'], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import glob
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+try:
+    import tensorflow  # noqa: F401
+    import keras  # noqa: F401
+except ImportError:
+    keras = None
+
+from libs.utils.utils import resize_image
+from config import data_path
+
+
+def save_random_weights(path, seed=0):
+    """
+    Save random CRNN weights with batch norm statistics far from the identity, so folding them is tested
+    """
+    from keras import backend as K
+    from keras.layers import BatchNormalization
+    from libs.nets.CRNN import CRNN
+
+    rng = np.random.RandomState(seed)
+    K.clear_session()
+    np.random.seed(seed)
+    model = CRNN(stage='predict', loss_fn=None)()
+    for layer in model.layers:
+        if isinstance(layer, BatchNormalization):
+            shape = layer.get_weights()[0].shape
+            layer.set_weights([1 + 0.2 * rng.randn(*shape), 0.1 * rng.randn(*shape), 0.1 * rng.randn(*shape),
+                               0.5 + rng.rand(*shape)])
+    model.save_weights(path)
+    K.clear_session()
+
+
+def get_demo_inputs():
+    paths = sorted(glob.glob(os.path.join(data_path, 'demo', '*.jpg')))
+    return np.stack([resize_image(cv2.imread(path)) / 255 for path in paths]).astype(np.float32)
+
+
+@unittest.skipIf(keras is None, 'TensorFlow and Keras are not installed')
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_frozen_graph_matches_keras(self):
+        from keras import backend as K
+        from libs.nets.CRNN import CRNN
+        from libs.models.backends import KerasBackend, FrozenGraphBackend
+        from libs.models.export import export_frozen_graph
+
+        weights_path = os.path.join(self.tmp_dir, 'model.h5')
+        save_random_weights(weights_path)
+        frozen_path = export_frozen_graph(weights_path)
+
+        K.clear_session()
+        model = CRNN(stage='predict', loss_fn=None)()
+        model.load_weights(weights_path)
+        session = K.get_session()
+        x = get_demo_inputs()
+        expected = KerasBackend(model, session, session.graph).predict(x)
+        actual = FrozenGraphBackend(frozen_path).predict(x)
+        K.clear_session()
+
+        np.testing.assert_allclose(actual, expected, atol=1e-5)
+        np.testing.assert_array_equal(actual.argmax(axis=-1), expected.argmax(axis=-1))
+
+
+if __name__ == '__main__':
+    unittest.main()
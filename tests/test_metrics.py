@@ -0,0 +1,81 @@
+import unittest
+from collections import Counter
+
+from libs.utils.metrics import MetricCounts, char_distances, word_distances, compute_metrics, align, \
+    confusion_counts
+
+
+def is_subsequence(letters, text):
+    remaining = iter(text)
+    return all(letter in remaining for letter in letters)
+
+
+class DistanceTest(unittest.TestCase):
+    def test_insertion_is_one_edit(self):
+        self.assertEqual(char_distances(['abxc'], ['abc']).tolist(), [1])
+        self.assertEqual(compute_metrics(['abxc'], ['abc'])['cer'], round(1 / 3 * 100, 2))
+
+    def test_deletion_and_substitution_are_one_edit(self):
+        self.assertEqual(char_distances(['ac', 'axc', 'abc'], ['abc', 'abc', 'abc']).tolist(), [1, 1, 0])
+
+    def test_word_distances(self):
+        self.assertEqual(word_distances(['a b c', 'a c', ''], ['a b c', 'a b c', 'a b']).tolist(), [0, 1, 2])
+
+
+class MetricCountsTest(unittest.TestCase):
+    predicteds = ['hello world', 'helo', '', 'abc', 'a b']
+    labels = ['hello world', 'hello', 'x', 'abd', 'a c']
+
+    def test_batches_add_up(self):
+        whole = MetricCounts()
+        whole.update(self.predicteds, self.labels)
+        batched = MetricCounts()
+        for i in range(0, len(self.labels), 2):
+            batched.update(self.predicteds[i:i + 2], self.labels[i:i + 2])
+        self.assertEqual(batched.state(), whole.state())
+        self.assertEqual(batched.to_dict(), compute_metrics(self.predicteds, self.labels))
+
+    def test_state_round_trip(self):
+        counts = MetricCounts()
+        counts.update(self.predicteds[:2], self.labels[:2])
+        resumed = MetricCounts(**counts.state())
+        resumed.update(self.predicteds[2:], self.labels[2:])
+        counts.update(self.predicteds[2:], self.labels[2:])
+        self.assertEqual(resumed.state(), counts.state())
+
+    def test_counts(self):
+        counts = MetricCounts()
+        counts.update(self.predicteds, self.labels)
+        self.assertEqual(counts.state(), {'n': 5, 'matches': 1, 'char_errors': 4, 'chars': 23,
+                                          'word_errors': 4, 'words': 7})
+        self.assertEqual(counts.to_dict()['accuracy'], 20.0)
+
+    def test_empty(self):
+        self.assertEqual(MetricCounts().to_dict(), {'accuracy': 0.0, 'letter_accuracy': 100.0, 'cer': 0.0, 'wer': 0.0})
+
+
+class AlignTest(unittest.TestCase):
+    def test_edits(self):
+        self.assertEqual(align('abc', 'abc'), [])
+        self.assertEqual(align('axc', 'abc'), [('b', 'x')])
+        self.assertEqual(align('abxc', 'abc'), [('', 'x')])
+        self.assertEqual(align('ac', 'abc'), [('b', '')])
+        self.assertEqual(align('', 'ab'), [('a', ''), ('b', '')])
+        self.assertEqual(align('ab', ''), [('', 'a'), ('', 'b')])
+
+    def test_fewest_edits(self):
+        self.assertEqual(align('sitting', 'kitten'), [('k', 's'), ('e', 'i'), ('', 'g')])
+        for predicted, label in [('sitting', 'kitten'), ('flaw', 'lawn'), ('intention', 'execution')]:
+            edits = align(predicted, label)
+            self.assertEqual(len(edits), char_distances([predicted], [label])[0])
+            # Edits are in order, their letters are subsequences of the label and the prediction
+            self.assertTrue(is_subsequence(''.join(edit[0] for edit in edits), label))
+            self.assertTrue(is_subsequence(''.join(edit[1] for edit in edits), predicted))
+
+    def test_confusion_counts(self):
+        counts = confusion_counts(['axc', 'abc', 'ac', 'axx'], ['abc', 'abc', 'abc', 'abc'])
+        self.assertEqual(counts, Counter({('b', 'x'): 2, ('b', ''): 1, ('c', 'x'): 1}))
+
+
+if __name__ == '__main__':
+    unittest.main()
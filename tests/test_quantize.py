@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+try:
+    import tensorflow  # noqa: F401
+    import keras  # noqa: F401
+except ImportError:
+    keras = None
+
+from tests.test_export import save_random_weights, get_demo_inputs
+
+
+@unittest.skipIf(keras is None, 'TensorFlow and Keras are not installed')
+class QuantizeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_quantized_graphs_agree_with_float32(self):
+        from libs.models.backends import FrozenGraphBackend, get_frozen_path, is_exported
+        from libs.models.export import export_frozen_graph
+        from libs.models.quantize import quantize_model
+
+        weights_path = os.path.join(self.tmp_dir, 'model.h5')
+        save_random_weights(weights_path)
+        export_frozen_graph(weights_path)
+        x = get_demo_inputs()
+        paths = quantize_model(weights_path, batches=[x])
+
+        reference = FrozenGraphBackend(get_frozen_path(weights_path)).predict(x)
+        for precision, min_agreement in (('float16', 0.99), ('int8', 0.9)):
+            self.assertEqual(paths[precision], get_frozen_path(weights_path, precision))
+            self.assertTrue(is_exported(weights_path, precision))
+            out = FrozenGraphBackend(paths[precision]).predict(x)
+            self.assertEqual(out.shape, reference.shape)
+            np.testing.assert_allclose(out.sum(axis=-1), 1, atol=1e-3)
+            agreement = np.mean(out.argmax(axis=-1) == reference.argmax(axis=-1))
+            self.assertGreaterEqual(agreement, min_agreement, precision)
+
+
+if __name__ == '__main__':
+    unittest.main()
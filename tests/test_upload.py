@@ -0,0 +1,62 @@
+import base64
+import asyncio
+import unittest
+
+import cv2
+import numpy as np
+
+from libs.utils.errors import ApiBadRequest
+from libs.utils.utils import decode_image, read_image
+from libs.serving.upload import read_body, read_part, decode_base64
+
+
+class FakeRequest(object):
+    def __init__(self, body):
+        self.body = body
+        self.content_length = len(body)
+
+    async def read(self):
+        return self.body
+
+
+class FakePart(object):
+    def __init__(self, body, chunk_size=4):
+        self.chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+
+    async def read_chunk(self):
+        return self.chunks.pop(0) if self.chunks else b''
+
+
+def run(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+
+class EmptyUploadTest(unittest.TestCase):
+    def setUp(self):
+        img = (np.random.RandomState(0).rand(8, 16, 3) * 255).astype(np.uint8)
+        self.png = cv2.imencode('.png', img)[1].tobytes()
+
+    def test_empty_payloads_are_rejected(self):
+        with self.assertRaises(ApiBadRequest):
+            decode_base64('')
+        with self.assertRaises(ApiBadRequest):
+            decode_base64('data:image/png;base64,')
+        with self.assertRaises(ApiBadRequest):
+            run(read_body(FakeRequest(b'')))
+        with self.assertRaises(ApiBadRequest):
+            run(read_part(FakePart(b'')))
+
+    def test_payloads_are_read(self):
+        self.assertEqual(bytes(decode_base64(base64.b64encode(self.png).decode())), self.png)
+        self.assertEqual(bytes(run(read_body(FakeRequest(self.png)))), self.png)
+        self.assertEqual(bytes(run(read_part(FakePart(self.png)))), self.png)
+
+    def test_undecodable_images_are_none(self):
+        for buffer in (b'', bytearray(), memoryview(b''), b'not an image'):
+            self.assertIsNone(decode_image(buffer))
+            self.assertIsNone(read_image(buffer))
+        self.assertEqual(decode_image(memoryview(self.png)).shape, (8, 16, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()